@@ -13,6 +13,9 @@ import os
 import pwd
 import grp
 import json
+import hashlib
+import socket
+import tempfile
 import logging
 import ipaddress
 import subprocess
@@ -33,7 +36,13 @@ __all__ = [
     "umount",
     "add_source",
     "GPGKeyError",
-    "get_address_in_network"
+    "get_address_in_network",
+    "get_interface_networks",
+    "unit_state_path",
+    "write_file",
+    "file_changed",
+    "get_changed_files",
+    "reset_changed_files"
 ]
 
 
@@ -60,6 +69,21 @@ def ns_query(address):
         return str(answers[0])
     return None
 
+
+def unit_state_path(filename):
+    """Returns the path of filename in the unit's state directory.
+
+    The state directory sits alongside the charm directory, e.g.:
+    /var/lib/juju/agents/unit-kafka-0/{charm,state}
+    Returns None if not running within a Juju hook.
+    """
+    charm_dir = os.environ.get("JUJU_CHARM_DIR", None)
+    if not charm_dir:
+        return None
+    return os.path.join(
+        os.path.dirname(os.path.abspath(charm_dir)), "state", filename)
+
+
 def is_ip(address):
     """
     Returns True if address is a valid IP address.
@@ -165,10 +189,25 @@ def _charmhelper_mkdir(path, owner='root', group='root', perms=0o555, force=Fals
     os.chmod(realpath, perms)
 
 
+# Files whose content changed since the last reset_changed_files call.
+# Allows the charm to decide if a reload or restart is actually needed.
+_changed_files = []
+
+
 def _charmhelper_write_file(path, content, owner='root', group='root', perms=0o444):
-    """Create or overwrite a file with the contents of a byte string."""
+    """Create or overwrite a file with the contents of a byte string.
+
+    The file is only written if its content differs. In this case, the new
+    content is written to a temporary file on the same folder, synced to
+    disk and then renamed over the target, so readers never observe a
+    partially written file.
+
+    Returns True if the content of the file has changed.
+    """
     uid = pwd.getpwnam(owner).pw_uid
     gid = grp.getgrnam(group).gr_gid
+    if isinstance(content, str):
+        content = content.encode('UTF-8')
     # lets see if we can grab the file and compare the context, to avoid doing
     # a write.
     existing_content = None
@@ -178,19 +217,30 @@ def _charmhelper_write_file(path, content, owner='root', group='root', perms=0o4
             existing_content = target.read()
         stat = os.stat(path)
         existing_uid, existing_gid, existing_perms = (
-            stat.st_uid, stat.st_gid, stat.st_mode
+            stat.st_uid, stat.st_gid, stat.st_mode & 0o7777
         )
     except Exception:
         pass
     if content != existing_content:
         logger.debug("Writing file {} {}:{} {:o}".format(path, owner, group, perms))
-        with open(path, 'wb') as target:
-            os.fchown(target.fileno(), uid, gid)
-            os.fchmod(target.fileno(), perms)
-            if isinstance(content, str):
-                content = content.encode('UTF-8')
-            target.write(content)
-        return
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=".{}.".format(os.path.basename(path)))
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                os.fchown(target.fileno(), uid, gid)
+                os.fchmod(target.fileno(), perms)
+                target.write(content)
+                target.flush()
+                os.fsync(target.fileno())
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        if path not in _changed_files:
+            _changed_files.append(path)
+        return True
     # the contents were the same, but we might still need to change the
     # ownership or permissions.
     if existing_uid != uid:
@@ -205,6 +255,67 @@ def _charmhelper_write_file(path, content, owner='root', group='root', perms=0o4
         logger.debug("Changing permissions on existing content: {} -> {}"
             .format(existing_perms, perms))
         os.chmod(path, perms)
+    return False
+
+
+def write_file(path, content, owner='root', group='root', perms=0o444):
+    """Atomically writes content to path, only if it has changed.
+
+    Returns True if the content of the file has changed.
+    """
+    target_dir = os.path.dirname(path)
+    if target_dir and not os.path.exists(target_dir):
+        _charmhelper_mkdir(target_dir, owner, group, perms=0o755)
+    return _charmhelper_write_file(path, content, owner, group, perms)
+
+
+def file_changed(path):
+    """Returns True if path was written since the last reset."""
+    return path in _changed_files
+
+
+def get_changed_files():
+    """Returns the list of files written since the last reset."""
+    return list(_changed_files)
+
+
+def reset_changed_files():
+    """Clears the list of files written so far."""
+    del _changed_files[:]
+
+
+# Jinja environments and compiled templates are cached at module level, so
+# they are shared across all the render calls of a given dispatch.
+# File templates are cached by the environment itself, string templates are
+# keyed by the hash of their source.
+_template_envs = {}
+_string_templates = {}
+
+
+def _get_template_env(templates_dir=None, template_loader=None):
+    """Returns the cached environment for a loader or templates folder."""
+    from jinja2 import FileSystemLoader, Environment
+
+    if template_loader:
+        key = template_loader
+    else:
+        if templates_dir is None:
+            templates_dir = os.path.join(
+                os.environ.get('CHARM_DIR', ''), 'templates')
+        key = templates_dir
+    if key not in _template_envs:
+        _template_envs[key] = Environment(
+            loader=template_loader or FileSystemLoader(templates_dir))
+    return _template_envs[key]
+
+
+def _get_string_template(template_env, source):
+    """Returns the compiled template of source, compiling it only once."""
+    key = (id(template_env),
+           hashlib.sha256(source.encode("utf-8")).hexdigest())
+    if key not in _string_templates:
+        _string_templates[key] = template_env.from_string(source)
+    return _string_templates[key]
 
 
 def render(source, target, context, owner='root', group='root',
@@ -227,18 +338,13 @@ def render(source, target, context, owner='root', group='root',
     this will attempt to use charmhelpers.fetch.apt_install to install it.
     """
 
-    from jinja2 import FileSystemLoader, Environment, exceptions
+    from jinja2 import exceptions
 
-    if template_loader:
-        template_env = Environment(loader=template_loader)
-    else:
-        if templates_dir is None:
-            templates_dir = os.path.join(os.environ.get('CHARM_DIR', ''), 'templates')
-        template_env = Environment(loader=FileSystemLoader(templates_dir))
+    template_env = _get_template_env(templates_dir, template_loader)
 
     # load from a string if provided explicitly
     if config_template is not None:
-        template = template_env.from_string(config_template)
+        template = _get_string_template(template_env, config_template)
     else:
         try:
             source = source
@@ -276,22 +382,17 @@ def render_from_string(source, target, context, owner='root', group='root',
     this will attempt to use charmhelpers.fetch.apt_install to install it.
     """
 
-    from jinja2 import FileSystemLoader, Environment, exceptions
+    from jinja2 import exceptions
 
-    if template_loader:
-        template_env = Environment(loader=template_loader)
-    else:
-        if templates_dir is None:
-            templates_dir = os.path.join(os.environ.get('CHARM_DIR', ''), 'templates')
-        template_env = Environment(loader=FileSystemLoader(templates_dir))
+    template_env = _get_template_env(templates_dir, template_loader)
 
     # load from a string if provided explicitly
     if config_template is not None:
-        template = template_env.from_string(config_template)
+        template = _get_string_template(template_env, config_template)
     else:
         try:
             source = source
-            template = template_env.from_string(source)
+            template = _get_string_template(template_env, source)
         except exceptions.TemplateNotFound as e:
             raise e
     content = template.render(context)
@@ -511,12 +612,58 @@ class Fstab(io.FileIO):
                                                     options=options))
 
 
-def get_address_in_network(network):
+def _get_ipv6_network_from_address(address):
+    """Get an netaddr.IPNetwork for the given IPv6 address
+    :param address: a dict as returned by netifaces.ifaddresses
+    :returns netaddr.IPNetwork: None if the address is a link local or loopback
+    address
+    """
+    import netaddr
+
+    if address['addr'].startswith('fe80') or address['addr'] == "::1":
+        return None
+    prefix = address['netmask'].split("/")
+    if len(prefix) > 1:
+        netmask = prefix[1]
+    else:
+        netmask = address['netmask']
+    return netaddr.IPNetwork("%s/%s" % (address['addr'], netmask))
+
+
+def get_interface_networks():
+    """Returns the list of netaddr.IPNetwork configured on the host.
+
+    Enumerates all the interfaces once, so the result can be reused across
+    several get_address_in_network calls.
+    """
+    import netifaces
+    import netaddr
+
+    result = []
+    for iface in netifaces.interfaces():
+        try:
+            addresses = netifaces.ifaddresses(iface)
+        except ValueError:
+            # If an instance was deleted between
+            # netifaces.interfaces() run and now, its interfaces are gone
+            continue
+        for addr in addresses.get(netifaces.AF_INET, []):
+            result.append(netaddr.IPNetwork("%s/%s" % (addr['addr'],
+                                                       addr['netmask'])))
+        for addr in addresses.get(netifaces.AF_INET6, []):
+            cidr = _get_ipv6_network_from_address(addr)
+            if cidr:
+                result.append(cidr)
+    return result
+
+
+def get_address_in_network(network, interface_networks=None):
     """Get an IPv4 or IPv6 address within the network from the host.
     :param network (str): CIDR presentation format. For example,
         '192.168.1.0/24'. Supports multiple networks as a space-delimited list.
+    :param interface_networks (list): optional, output of
+        get_interface_networks. If not set, enumerate the interfaces.
     """
-    import netifaces
     import netaddr
 
     def _validate_cidr(network):
@@ -529,29 +676,15 @@ def get_address_in_network(network):
     if network is None or len(network) == 0:
         return None
 
+    if interface_networks is None:
+        interface_networks = get_interface_networks()
     networks = network.split() or [network]
     for network in networks:
         _validate_cidr(network)
         network = netaddr.IPNetwork(network)
-        for iface in netifaces.interfaces():
-            try:
-                addresses = netifaces.ifaddresses(iface)
-            except ValueError:
-                # If an instance was deleted between
-                # netifaces.interfaces() run and now, its interfaces are gone
-                continue
-            if network.version == 4 and netifaces.AF_INET in addresses:
-                for addr in addresses[netifaces.AF_INET]:
-                    cidr = netaddr.IPNetwork("%s/%s" % (addr['addr'],
-                                                        addr['netmask']))
-                    if cidr in network:
-                        return str(cidr.ip)
-
-            if network.version == 6 and netifaces.AF_INET6 in addresses:
-                for addr in addresses[netifaces.AF_INET6]:
-                    cidr = _get_ipv6_network_from_address(addr)
-                    if cidr and cidr in network:
-                        return str(cidr.ip)
+        for cidr in interface_networks:
+            if cidr.version == network.version and cidr in network:
+                return str(cidr.ip)
 
     return None
 
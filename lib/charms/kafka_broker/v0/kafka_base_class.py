@@ -59,7 +59,6 @@ final charm should use:
 
 """
 
-import time
 import base64
 import os
 import shutil
@@ -70,8 +69,7 @@ import socket
 
 import pwd
 import grp
-
-import cryptography.hazmat.primitives.serialization as serialization
+from collections.abc import Mapping
 
 from charms.kafka_broker.v0.java_class import JavaCharmBase
 from charms.kafka_broker.v0.kafka_linux import (
@@ -100,12 +98,15 @@ from charms.kafka_broker.v0.charmhelper import (
     add_source,
     mount,
     render,
-    render_from_string
+    render_from_string,
+    write_file
 )
 
-from charms.kafka_broker.v0.kafka_security import setFilePermissions
-
-import interface_tls_certificates.ca_client as ca_client
+from charms.kafka_broker.v0.kafka_security import (
+    setFilePermissions,
+    merge_certificates
+)
+from charms.kafka_broker.v0.kafka_endpoint_probe import probe_endpoints
 
 from charms.kafka_broker.v0.charmhelper import (
     get_hostname
@@ -432,9 +433,18 @@ class KafkaJavaCharmBase(JavaCharmBase):
         # This list will be used to iterate over each of the methods on
         # is_ssl_enabled
         self.get_ssl_methods_list = []
+        # Cert and key material, cached per dispatch. Check _get_ssl_cert
+        self._cert_cache = {}
         self._kerberos_principal = None
         self.ks.set_default(keytab="")
-        self.ks.set_default(ssl_certs=[])
+        # Extra CAs to be trusted, as a {fingerprint: pem} map
+        self.ks.set_default(ssl_certs={})
+        if not isinstance(self.ks.ssl_certs, Mapping):
+            # Older versions of the charm saved the CAs as a list
+            certs = {}
+            for c in self.ks.ssl_certs:
+                merge_certificates(certs, c)
+            self.ks.ssl_certs = certs
         self._sasl_protocol = None
         # Save the internal content of keytab file from the action.
         # use it as part of the context in the config_changed
@@ -556,11 +566,13 @@ class KafkaJavaCharmBase(JavaCharmBase):
     def _recover_certificates_from_file(self, cert_files):
         """Implements a helper method for the certificate actions.
 
-        Recovers all the certs from cert_files."""
-        certs = []
+        Recovers all the certs from cert_files, as a {fingerprint: pem}
+        map. Each file can contain a bundle of several PEM certs or a
+        single DER cert."""
+        certs = {}
         for crt in cert_files if isinstance(cert_files,list) else [cert_files]:
-            with open(crt) as f:
-                certs.append("".join(f.readlines()))
+            with open(crt, "rb") as f:
+                merge_certificates(certs, f.read())
         return certs
 
     def add_certificates_action(self, cert_files):
@@ -574,13 +586,14 @@ class KafkaJavaCharmBase(JavaCharmBase):
         if len(certs) == 0:
             # No new cert to add
             return
-        to_add = [c for c in certs if c not in self.ks.ssl_certs]
-        self.ks.ssl_certs.extend(to_add)
-        return self.ks.ssl_certs
+        ssl_certs = dict(self.ks.ssl_certs)
+        ssl_certs.update(certs)
+        self.ks.ssl_certs = ssl_certs
+        return list(ssl_certs.values())
 
     def list_certificates_action(self):
         """Returns the list of certs added to the keystore."""
-        return self.ks.ssl_certs
+        return list(self.ks.ssl_certs.values())
 
     def remove_certificates_action(self, cert_files):
         """Empties out all the certs passed via action"""
@@ -588,8 +601,8 @@ class KafkaJavaCharmBase(JavaCharmBase):
         if len(certs) == 0:
             # No new cert to add
             return
-        new_ssl_certs = [c for c in self.ks.ssl_certs if c not in certs]
-        self.ks.ssl_certs = new_ssl_certs
+        self.ks.ssl_certs = {
+            fp: c for fp, c in self.ks.ssl_certs.items() if fp not in certs}
 
     def _upload_keytab_base64(self, k, filename="kafka.keytab"):
         """Receives the keytab in base64 format and saves to correct file"""
@@ -607,36 +620,34 @@ class KafkaJavaCharmBase(JavaCharmBase):
         self.keytab = filename
 
     def check_ports_are_open(self, endpoints,
-                             retrials=3, backoff=60):
+                             retrials=3, backoff=60,
+                             tls_endpoints=None, ssl_context=None):
         """Check if a list of ports is open. Should be used with RestartEvent
         processing. That way, one can separate the restart worked or not.
 
-        The idea is to iterate over the port list and check if they are all
-        open. If yes, return True. If not, wait for "backoff" seconds and
-        retry. If reached "retrials" and still not all the ports are open,
-        return False.
+        All the endpoints are probed concurrently, each one retried with a
+        jittered exponential backoff, until all are open or the deadline
+        of retrials * backoff seconds expires. The results per endpoint,
+        including the time until each one was ready, are kept in
+        self.endpoint_probe_results.
 
         Args:
         - endpoints: list of strings - endpoints in format hostname/IP:PORT
-        - retrials: Number of retries that will be executed
-        - backoff: Amount of time to wait after a failed trial, in seconds
+        - retrials, backoff: the probe gives up after retrials * backoff
+          seconds
+        - tls_endpoints: optional, endpoints that must also complete a TLS
+          handshake
+        - ssl_context: optional, client SSLContext for the TLS handshakes
         """
-        for c in range(retrials):
-            success = True
-            for ep in endpoints:
-                sock = socket.socket(
-                    socket.AF_INET, socket.SOCK_STREAM)
-                port = int(ep.split(":")[1])
-                ip = ep.split(":")[0]
-                if sock.connect_ex((ip, port)) != 0:
-                    success = False
-                    break
-            if success:
-                # We were successful in checking each endpoint
-                return True
-            # Otherwise, we've failed, sleep for some time and retry
-            time.sleep(backoff)
-        return False
+        self.endpoint_probe_results = probe_endpoints(
+            endpoints, deadline=retrials * backoff,
+            tls_endpoints=tls_endpoints, ssl_context=ssl_context)
+        failed = {ep: r["error"]
+                  for ep, r in self.endpoint_probe_results.items()
+                  if not r["ready"]}
+        if failed:
+            logger.warning("Endpoints not ready: {}".format(failed))
+        return len(failed) == 0
 
     @property
     def snap(self):
@@ -787,6 +798,24 @@ class KafkaJavaCharmBase(JavaCharmBase):
             self.config["mds_user"], self.config["mds_password"],
             mds_urls)
 
+    def _cert_cache_key(self, cn, kind, crt_config, key_config):
+        """Returns the key of the cert material cache.
+
+        Entries are keyed by CN, kind (cert or key) and source. Config
+        sources also carry the config values, so a config change is
+        picked up immediately. Relation sources are dropped with
+        invalidate_cert_cache once the certificates relation changes.
+        """
+        if len(self.config.get(crt_config)) > 0 and \
+           len(self.config.get(key_config)) > 0:
+            return (cn, kind, "config",
+                    self.config[crt_config], self.config[key_config])
+        return (cn, kind, "relation")
+
+    def invalidate_cert_cache(self):
+        """Drops all the cached cert and key material."""
+        self._cert_cache = {}
+
     def _get_ssl_cert(self, cn=None, crt_config="ssl_cert", key_config="ssl_key"):
         """Recovers the TLS certificate based either if the cert has been passed
         as a configuration parameter (based on crt_config and key_config names)
@@ -801,10 +830,26 @@ class KafkaJavaCharmBase(JavaCharmBase):
             return ""
         if self.config["generate-root-ca"]:
             return self.ks.ssl_cert
+        cache_key = self._cert_cache_key(cn, "cert", crt_config, key_config)
+        if cache_key not in self._cert_cache:
+            c = self._load_ssl_cert(cn, crt_config, key_config)
+            if not c:
+                # Certificates not ready yet, do not cache it
+                return c
+            self._cert_cache[cache_key] = c
+        return self._cert_cache[cache_key]
+
+    def _load_ssl_cert(self, cn, crt_config, key_config):
+        """Loads the certificate from the config or the relation."""
         if len(self.config.get(crt_config)) > 0 and \
            len(self.config.get(key_config)) > 0:
             return base64.b64decode(self.config[crt_config]).decode("ascii")
         # Not a config option, check the certificates relation
+        if not self.certificates:
+            return ""
+        # Imported only when needed, as cryptography is expensive to load
+        import cryptography.hazmat.primitives.serialization as serialization
+        import interface_tls_certificates.ca_client as ca_client
         root_ca_chain = None
         ca_cert = None
         try:
@@ -852,9 +897,24 @@ class KafkaJavaCharmBase(JavaCharmBase):
             return ""
         if self.config["generate-root-ca"]:
             return self.ks.ssl_key
+        cache_key = self._cert_cache_key(cn, "key", crt_config, key_config)
+        if cache_key not in self._cert_cache:
+            k = self._load_ssl_key(cn, crt_config, key_config)
+            if not k:
+                # Certificates not ready yet, do not cache it
+                return k
+            self._cert_cache[cache_key] = k
+        return self._cert_cache[cache_key]
+
+    def _load_ssl_key(self, cn, crt_config, key_config):
+        """Loads the key from the config or the relation."""
         if len(self.config.get(crt_config)) > 0 and \
            len(self.config.get(key_config)) > 0:
             return base64.b64decode(self.config[key_config]).decode("ascii")
+        if not self.certificates:
+            return ""
+        import cryptography.hazmat.primitives.serialization as serialization
+        import interface_tls_certificates.ca_client as ca_client
         try:
             certs = self.certificates._get_certs_and_keys(request_type='server')
             k = certs[cn]["key"].private_bytes(
@@ -867,6 +927,12 @@ class KafkaJavaCharmBase(JavaCharmBase):
         return k.decode("utf-8")
 
     def _cert_relation_set(self, event, rel=None, extra_sans=[]):
+        # CAClientError can only be raised with the certificates relation
+        cert_errors = (KeyError,)
+        if self.certificates:
+            import interface_tls_certificates.ca_client as ca_client
+            cert_errors += (ca_client.CAClientError,)
+
         # Will introduce this CN format later
         def __get_cn():
             return "*." + ".".join(socket.getfqdn().split(".")[1:])
@@ -875,7 +941,7 @@ class KafkaJavaCharmBase(JavaCharmBase):
         # or install events. In these cases, the goal is to run
         # the validation at the end of this method
         if rel:
-            if self.certificates.is_joined:
+            if self.certificates and self.certificates.is_joined:
                 sans = [
                     socket.gethostname(),
                     socket.getfqdn()
@@ -916,8 +982,7 @@ class KafkaJavaCharmBase(JavaCharmBase):
         # but the relation is not ready yet
         # KeyError is also a possibility, if get_ssl_cert is called before any
         # event that actually submits a request for a cert is done
-        except (ca_client.CAClientError,
-                KeyError):
+        except cert_errors:
             self.model.unit.status = \
                 BlockedStatus("There is no certificate option or "
                               "relation set, waiting...")
@@ -1122,6 +1187,22 @@ class KafkaJavaCharmBase(JavaCharmBase):
             return self.config.get("confluent_license_topic")
         return None
 
+    def tls_performance_jvm_opts(self):
+        """Returns the JVM flags of the TLS performance profile.
+
+        Clients reconnecting within the session cache lifetime resume
+        their sessions instead of running a full handshake. Session tickets
+        allow resumption without keeping state on the broker, on Java 13+.
+        Returns an empty list if tls-performance-profile is not set.
+        """
+        if not self.config.get("tls-performance-profile", False):
+            return []
+        return [
+            "-Djavax.net.ssl.sessionCacheSize={}".format(
+                self.config.get("tls-session-cache-size", 20480)),
+            "-Djdk.tls.server.enableSessionTicketExtension=true"
+        ]
+
     def render_service_override_file(
             self, target,
             jmx_jar_folder="/opt/prometheus/",
@@ -1154,6 +1235,7 @@ class KafkaJavaCharmBase(JavaCharmBase):
         kafka_opts = []
         if self.is_ssl_enabled():
             kafka_opts.append("-Djdk.tls.ephemeralDHKeySize=2048")
+            kafka_opts.extend(self.tls_performance_jvm_opts())
         if self.is_sasl_enabled():
             kafka_opts.append(
                 "-Djava.security.auth.login.config="
@@ -1242,10 +1324,10 @@ class KafkaJavaCharmBase(JavaCharmBase):
 """.format(self.keytab, self.kerberos_principal) # noqa
             content += krb
         self.set_folders_and_permissions([os.path.dirname(jaas_path)])
-        with open(jaas_path, "w") as f:
-            f.write(content)
-        setFilePermissions(jaas_path, self.config.get("user", "root"),
-                           self.config.get("group", "root"), 0o640)
+        write_file(jaas_path, content,
+                   owner=self.config.get("user", "root"),
+                   group=self.config.get("group", "root"),
+                   perms=0o640)
         return content
 
     def _render_krb5_conf(self):
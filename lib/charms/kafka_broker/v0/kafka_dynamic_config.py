@@ -0,0 +1,390 @@
+"""
+
+Implements dynamic broker reconfiguration through kafka-configs.
+
+Some of the broker configs can be updated on a running broker, without a
+restart. That is the case of the per-listener keystore, which allows TLS
+certificates to be rotated with:
+
+    kafka-configs --bootstrap-server <broker> --entity-type brokers \\
+        --entity-name <broker.id> --alter \\
+        --add-config listener.name.<L>.ssl.keystore.location=<new path>
+
+The keystore must be written to a new path, as Kafka only reloads it if
+the config value changes. Use versioned_store_path to get such a path.
+
+Each broker config has a dynamic update mode:
+
+    read-only: needs a broker restart
+    per-broker: can be updated per broker
+    cluster-wide: can be updated as a cluster-wide default (or per broker)
+
+classify_changes diffs two versions of server.properties and groups the
+changes per mode. Only the read-only changes need a restart, the others
+can be applied with alter_broker_configs.
+
+Listeners other than the inter-broker one can also be added or removed
+per broker, together with their listener.name.<listener>.* configs. If
+classify_changes receives the inter-broker listener, those changes are
+grouped as LISTENERS. Listeners whose endpoint or security protocol
+changed still need a restart.
+
+How to use:
+
+    path = versioned_store_path(ks_path, fingerprint)
+    PKCS12CreateKeystore(path, ...)
+    alter_broker_configs(
+        {"listener.name.broker.ssl.keystore.location": path},
+        broker_id=read_broker_id(log_dirs),
+        bootstrap_server="broker-0.maas:9092",
+        command_config="/etc/kafka/client.properties")
+    if not wait_for_certificate("broker-0.maas", 9092, new_cert_pem):
+        # Fallback to a restart
+        ...
+
+    changes = classify_changes(old_props, new_props)
+    if not changes[READ_ONLY]:
+        alter_broker_configs(changes[PER_BROKER], broker_id=..., ...)
+        alter_broker_configs(changes[CLUSTER_WIDE], broker_id=None,
+                             entity_default=True, ...)
+
+"""
+
+import os
+import re
+import ssl
+import time
+import socket
+import logging
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "KafkaDynamicConfigError",
+    "versioned_store_path",
+    "read_broker_id",
+    "alter_broker_configs",
+    "get_served_certificate",
+    "wait_for_certificate",
+    "kafka_configs_command",
+    "config_update_mode",
+    "diff_properties",
+    "classify_changes",
+    "listener_changes",
+    "READ_ONLY",
+    "PER_BROKER",
+    "CLUSTER_WIDE",
+    "LISTENERS",
+    "LISTENER_CONFIGS"
+]
+
+# Time to wait for the broker to serve the new certificate
+CERT_VERIFY_TIMEOUT = 30
+CERT_VERIFY_INTERVAL = 2
+
+READ_ONLY = "read-only"
+PER_BROKER = "per-broker"
+CLUSTER_WIDE = "cluster-wide"
+# Listeners added or removed, updated per broker
+LISTENERS = "listeners"
+
+# Configs describing the listeners, see listener_changes
+LISTENER_CONFIGS = [
+    "listeners",
+    "advertised.listeners",
+    "listener.security.protocol.map"
+]
+
+# Dynamic update mode of the broker configs, as in the "Dynamic Update
+# Mode" column of Kafka's broker configs documentation. Configs not listed
+# here are read-only. LISTENER_CONFIGS are left out: they are only updated
+# dynamically to add or remove listeners, see listener_changes.
+DYNAMIC_CONFIGS = {
+    # Threads and connections
+    "background.threads": CLUSTER_WIDE,
+    "num.io.threads": CLUSTER_WIDE,
+    "num.network.threads": CLUSTER_WIDE,
+    "num.replica.fetchers": CLUSTER_WIDE,
+    "num.recovery.threads.per.data.dir": CLUSTER_WIDE,
+    "max.connections": CLUSTER_WIDE,
+    "max.connections.per.ip": CLUSTER_WIDE,
+    "max.connections.per.ip.overrides": CLUSTER_WIDE,
+    "max.connection.creation.rate": CLUSTER_WIDE,
+    # Log defaults
+    "compression.type": CLUSTER_WIDE,
+    "log.cleanup.policy": CLUSTER_WIDE,
+    "log.flush.interval.messages": CLUSTER_WIDE,
+    "log.flush.interval.ms": CLUSTER_WIDE,
+    "log.index.interval.bytes": CLUSTER_WIDE,
+    "log.index.size.max.bytes": CLUSTER_WIDE,
+    "log.message.downconversion.enable": CLUSTER_WIDE,
+    "log.message.timestamp.difference.max.ms": CLUSTER_WIDE,
+    "log.message.timestamp.type": CLUSTER_WIDE,
+    "log.preallocate": CLUSTER_WIDE,
+    "log.retention.bytes": CLUSTER_WIDE,
+    "log.retention.ms": CLUSTER_WIDE,
+    "log.roll.jitter.ms": CLUSTER_WIDE,
+    "log.roll.ms": CLUSTER_WIDE,
+    "log.segment.bytes": CLUSTER_WIDE,
+    "log.segment.delete.delay.ms": CLUSTER_WIDE,
+    "message.max.bytes": CLUSTER_WIDE,
+    "min.insync.replicas": CLUSTER_WIDE,
+    "unclean.leader.election.enable": CLUSTER_WIDE,
+    "metric.reporters": CLUSTER_WIDE,
+    # Log cleaner
+    "log.cleaner.backoff.ms": CLUSTER_WIDE,
+    "log.cleaner.dedupe.buffer.size": CLUSTER_WIDE,
+    "log.cleaner.delete.retention.ms": CLUSTER_WIDE,
+    "log.cleaner.io.buffer.load.factor": CLUSTER_WIDE,
+    "log.cleaner.io.buffer.size": CLUSTER_WIDE,
+    "log.cleaner.io.max.bytes.per.second": CLUSTER_WIDE,
+    "log.cleaner.max.compaction.lag.ms": CLUSTER_WIDE,
+    "log.cleaner.min.cleanable.ratio": CLUSTER_WIDE,
+    "log.cleaner.min.compaction.lag.ms": CLUSTER_WIDE,
+    "log.cleaner.threads": CLUSTER_WIDE,
+    # Replication throttles
+    "leader.replication.throttled.rate": PER_BROKER,
+    "follower.replication.throttled.rate": PER_BROKER,
+    "replica.alter.log.dirs.io.max.bytes.per.second": PER_BROKER,
+}
+
+# Security configs, only dynamic per broker with the
+# listener.name.<listener>. prefix. Without it, they are read-only.
+LISTENER_DYNAMIC_CONFIGS = [
+    "ssl.cipher.suites",
+    "ssl.client.auth",
+    "ssl.enabled.protocols",
+    "ssl.endpoint.identification.algorithm",
+    "ssl.key.password",
+    "ssl.keymanager.algorithm",
+    "ssl.keystore.location",
+    "ssl.keystore.password",
+    "ssl.keystore.type",
+    "ssl.protocol",
+    "ssl.provider",
+    "ssl.secure.random.implementation",
+    "ssl.trustmanager.algorithm",
+    "ssl.truststore.location",
+    "ssl.truststore.password",
+    "ssl.truststore.type",
+    "sasl.enabled.mechanisms",
+    "sasl.jaas.config",
+    "sasl.kerberos.service.name"
+]
+
+_LISTENER_PREFIX = re.compile(r"^listener\.name\.[^.]+\.")
+# e.g. listener.name.<listener>.<mechanism>.sasl.jaas.config
+_MECHANISM_PREFIX = re.compile(r"^[^.]+\.(?=sasl\.jaas\.config$)")
+
+
+class KafkaDynamicConfigError(Exception):
+
+    def __init__(self,
+                 message="Failed to update broker configs dynamically"):
+        super().__init__(message)
+
+
+def kafka_configs_command(distro):
+    """Returns the kafka-configs command for a given distro."""
+    if distro == "apache_snap":
+        return "kafka.configs"
+    if distro == "apache":
+        return "/opt/kafka/bin/kafka-configs.sh"
+    return "kafka-configs"
+
+
+def versioned_store_path(path, version):
+    """Returns path with version added before the extension.
+
+    e.g. /var/ssl/private/kafka_ks.jks -> /var/ssl/private/kafka_ks.<v>.jks
+    """
+    base, ext = os.path.splitext(path)
+    return "{}.{}{}".format(base, version, ext)
+
+
+def read_broker_id(log_dirs):
+    """Returns the broker.id saved in meta.properties, or None.
+
+    log_dirs: comma-separated list of log folders, as in log.dirs
+    """
+    for d in (log_dirs or "").split(","):
+        meta = os.path.join(d.strip(), "meta.properties")
+        try:
+            with open(meta) as f:
+                for line in f:
+                    k, _, v = line.strip().partition("=")
+                    if k.strip() == "broker.id":
+                        return v.strip()
+        except OSError:
+            continue
+    return None
+
+
+def alter_broker_configs(configs, broker_id, bootstrap_server,
+                         command_config=None, cmd="kafka-configs",
+                         delete=None, entity_default=False):
+    """Updates configs of a running broker with a single kafka-configs call.
+
+    configs: dict of {config name: value}
+    broker_id: id of the broker to be updated
+    bootstrap_server: host:port of a listener of the broker
+    command_config: optional, properties file with the client configs
+    cmd: kafka-configs command, see kafka_configs_command
+    delete: optional, list of configs to be removed
+    entity_default: if True, update the cluster-wide defaults instead of
+                    the configs of broker_id
+
+    Raises KafkaDynamicConfigError if the update fails.
+    """
+    if not configs and not delete:
+        return
+    if broker_id is None and not entity_default:
+        raise KafkaDynamicConfigError("broker.id not found")
+    args = [cmd, "--bootstrap-server", bootstrap_server,
+            "--entity-type", "brokers"]
+    if entity_default:
+        args.append("--entity-default")
+    else:
+        args.extend(["--entity-name", str(broker_id)])
+    args.append("--alter")
+    if configs:
+        # Values containing commas must be enclosed with brackets
+        args.extend(["--add-config", ",".join(
+            "{}={}".format(k, "[{}]".format(v) if "," in str(v) else v)
+            for k, v in sorted(configs.items()))])
+    if delete:
+        args.extend(["--delete-config", ",".join(sorted(delete))])
+    if command_config:
+        args.extend(["--command-config", command_config])
+    try:
+        subprocess.check_output(args, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        output = getattr(e, "output", None) or b""
+        raise KafkaDynamicConfigError(
+            "kafka-configs failed: {} {}".format(
+                str(e), output.decode("utf-8", errors="replace")))
+
+
+def get_served_certificate(host, port, timeout=5):
+    """Returns the certificate served on host:port, in DER format.
+
+    The certificate is not verified, only retrieved.
+    """
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    with socket.create_connection((host, int(port)), timeout=timeout) as s:
+        with ctx.wrap_socket(s, server_hostname=host) as tls:
+            return tls.getpeercert(binary_form=True)
+
+
+def wait_for_certificate(host, port, cert_pem,
+                         timeout=CERT_VERIFY_TIMEOUT,
+                         interval=CERT_VERIFY_INTERVAL):
+    """Waits until host:port serves the certificate cert_pem.
+
+    Returns True if the certificate was served before the timeout.
+    """
+    expected = ssl.PEM_cert_to_DER_cert(cert_pem.strip())
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if get_served_certificate(host, port) == expected:
+                return True
+        except (OSError, ValueError) as e:
+            logger.debug("Failed to retrieve certificate from {}:{}: "
+                         "{}".format(host, port, str(e)))
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+
+
+def config_update_mode(key):
+    """Returns the dynamic update mode of a broker config.
+
+    Only the security configs can be set per listener
+    (listener.name.<listener>.<config>), and only per broker. Without
+    the prefix, they are read-only.
+    """
+    name = _LISTENER_PREFIX.sub("", key)
+    if name != key:
+        name = _MECHANISM_PREFIX.sub("", name)
+        if name in LISTENER_DYNAMIC_CONFIGS:
+            return PER_BROKER
+        return READ_ONLY
+    return DYNAMIC_CONFIGS.get(key, READ_ONLY)
+
+
+def diff_properties(old, new):
+    """Returns {key: (old value, new value)} of the keys that differ.
+
+    Values are compared as strings. Missing keys have None as value.
+    """
+    old = {k: str(v) for k, v in (old or {}).items() if v is not None}
+    new = {k: str(v) for k, v in (new or {}).items() if v is not None}
+    return {k: (old.get(k), new.get(k))
+            for k in sorted(set(old) | set(new))
+            if old.get(k) != new.get(k)}
+
+
+def _listener_entries(props):
+    """Returns {listener name: (endpoint, advertised, protocol)}."""
+    result = {}
+    for i, key in enumerate(LISTENER_CONFIGS):
+        for e in str((props or {}).get(key, "") or "").split(","):
+            if not e.strip():
+                continue
+            sep = ":" if key == "listener.security.protocol.map" else "://"
+            name, _, value = e.strip().partition(sep)
+            entry = result.setdefault(name.lower(), [None, None, None])
+            entry[i] = value
+    return {k: tuple(v) for k, v in result.items()}
+
+
+def listener_changes(old, new, inter_broker_listener):
+    """Returns (added, removed) listener names between two
+    server.properties, or None if the change needs a restart.
+
+    A restart is needed if a listener kept in both changed its endpoint,
+    advertised endpoint or security protocol, or if the inter-broker
+    listener is added or removed.
+    """
+    old_lst = _listener_entries(old)
+    new_lst = _listener_entries(new)
+    if any(old_lst[n] != new_lst[n] for n in set(old_lst) & set(new_lst)):
+        return None
+    added = sorted(set(new_lst) - set(old_lst))
+    removed = sorted(set(old_lst) - set(new_lst))
+    if (inter_broker_listener or "").lower() in added + removed:
+        return None
+    return added, removed
+
+
+def classify_changes(old, new, exclude=None, inter_broker_listener=None):
+    """Groups the differences between two server.properties per mode.
+
+    exclude: optional, keys to be ignored, e.g. handled elsewhere
+    inter_broker_listener: optional, if set, listeners added or removed
+                           are grouped as LISTENERS instead of READ_ONLY
+
+    Returns {READ_ONLY: {...}, PER_BROKER: {...}, CLUSTER_WIDE: {...},
+    LISTENERS: {...}}, each a dict of {key: new value}, where None means
+    the key was removed.
+    """
+    result = {READ_ONLY: {}, PER_BROKER: {}, CLUSTER_WIDE: {},
+              LISTENERS: {}}
+    lst = None
+    if inter_broker_listener:
+        lst = listener_changes(old, new, inter_broker_listener)
+    prefixes = tuple("listener.name.{}.".format(n)
+                     for n in (lst[0] + lst[1] if lst else []))
+    for k, (_, v) in diff_properties(old, new).items():
+        if k in (exclude or []):
+            continue
+        if lst and (k in LISTENER_CONFIGS or
+                    (prefixes and k.lower().startswith(prefixes))):
+            result[LISTENERS][k] = v
+        else:
+            result[config_update_mode(k)][k] = v
+    return result
@@ -0,0 +1,140 @@
+"""
+
+Implements a concurrent readiness probe of the broker endpoints.
+
+After a restart, the JVM takes from a few seconds to minutes to open its
+listeners. Probing each endpoint in turn and sleeping a fixed time between
+retries either wastes hook time or gives up too early. This probe checks
+all the endpoints at once, with asyncio, and retries each one with a
+jittered exponential backoff until it is ready or the deadline expires.
+
+Optionally, a TLS handshake is completed against the TLS listeners: an
+open port only means the socket is bound, while a handshake means the
+keystore was loaded as well.
+
+How to use:
+
+    results = probe_endpoints(
+        ["10.0.0.1:9092", "10.0.0.1:9093"], deadline=180,
+        tls_endpoints=["10.0.0.1:9093"])
+    if all(r["ready"] for r in results.values()):
+        ...
+    for ep, r in results.items():
+        logger.info("{} ready in {}s".format(ep, r["latency"]))
+
+"""
+
+import ssl
+import time
+import random
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "probe_endpoints",
+    "split_endpoint"
+]
+
+DEFAULT_DEADLINE = 180
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 15
+CONNECT_TIMEOUT = 5
+
+
+def split_endpoint(endpoint):
+    """Returns (host, port) of a host:port endpoint, IPv6 included."""
+    host, _, port = endpoint.rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+def _client_ssl_context():
+    """TLS context that completes the handshake without verification."""
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+async def _connect(host, port, ssl_ctx, timeout):
+    """Opens, and closes, a connection to host:port."""
+    _, writer = await asyncio.wait_for(
+        asyncio.open_connection(
+            host, port, ssl=ssl_ctx,
+            server_hostname=host if ssl_ctx else None),
+        timeout=timeout)
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (OSError, ssl.SSLError):
+        # The broker may reset the connection, it is ready anyway
+        pass
+
+
+async def _probe(endpoint, deadline, ssl_ctx, initial_backoff,
+                 max_backoff, connect_timeout):
+    host, port = split_endpoint(endpoint)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    attempt = 0
+    error = None
+    while True:
+        attempt += 1
+        remaining = deadline - loop.time()
+        try:
+            await _connect(host, port, ssl_ctx,
+                           max(0.1, min(connect_timeout, remaining)))
+            return {"ready": True, "attempts": attempt,
+                    "latency": round(loop.time() - start, 3), "error": None}
+        except (OSError, ssl.SSLError, asyncio.TimeoutError) as e:
+            error = str(e) or e.__class__.__name__
+        # Full jitter: spreads the retries of the endpoints apart
+        backoff = random.uniform(
+            0, min(max_backoff, initial_backoff * (2 ** (attempt - 1))))
+        if loop.time() + backoff >= deadline:
+            return {"ready": False, "attempts": attempt,
+                    "latency": round(loop.time() - start, 3),
+                    "error": error}
+        await asyncio.sleep(backoff)
+
+
+async def _probe_all(endpoints, timeout, tls_endpoints, ssl_ctx,
+                     initial_backoff, max_backoff, connect_timeout):
+    deadline = asyncio.get_running_loop().time() + timeout
+    results = await asyncio.gather(*[
+        _probe(ep, deadline, ssl_ctx if ep in tls_endpoints else None,
+               initial_backoff, max_backoff, connect_timeout)
+        for ep in endpoints])
+    return dict(zip(endpoints, results))
+
+
+def probe_endpoints(endpoints, deadline=DEFAULT_DEADLINE,
+                    tls_endpoints=None, ssl_context=None,
+                    initial_backoff=INITIAL_BACKOFF,
+                    max_backoff=MAX_BACKOFF,
+                    connect_timeout=CONNECT_TIMEOUT):
+    """Probes all the endpoints concurrently until ready or deadline.
+
+    endpoints: list of host:port
+    deadline: time, in seconds, to wait for all the endpoints
+    tls_endpoints: optional, endpoints that must complete a TLS handshake
+    ssl_context: optional, client context for the TLS handshakes, e.g.
+                 with a client certificate if the listener requires one
+
+    Returns {endpoint: {"ready", "attempts", "latency", "error"}}, where
+    latency is the time, in seconds, until the endpoint was ready.
+    """
+    endpoints = list(dict.fromkeys(endpoints or []))
+    if not endpoints:
+        return {}
+    tls_endpoints = set(tls_endpoints or [])
+    if tls_endpoints and ssl_context is None:
+        ssl_context = _client_ssl_context()
+    start = time.monotonic()
+    results = asyncio.run(_probe_all(
+        endpoints, deadline, tls_endpoints, ssl_context,
+        initial_backoff, max_backoff, connect_timeout))
+    logger.debug("Probed {} endpoints in {:.3f}s: {}".format(
+        len(endpoints), time.monotonic() - start, results))
+    return results
@@ -1,10 +1,12 @@
 import os
+import json
+import time
+import hashlib
 import pathlib
 import subprocess
 import pwd
 import grp
 import urllib
-from python_hosts import Hosts, HostsEntry
 
 import charms.kafka_broker.v0.charmhelper as charmhelper
 
@@ -19,9 +21,19 @@ __all__ = [
     "userAdd",
     "groupAdd",
     "fixMaybeLocalhost",
-    "get_hostname"
+    "get_hostname",
+    "invalidate_hostname_cache",
+    "has_aes_ni"
 ]
 
+# Resolved hostnames are cached per IP for HOSTNAME_CACHE_TTL seconds.
+# The cache is kept in memory and also saved to the unit's state directory,
+# so it is shared across hooks.
+HOSTNAME_CACHE_TTL = 3600
+HOSTNAME_CACHE_FILE = "hostname-cache.json"
+
+_hostname_cache = None
+
 
 class LinuxError(Exception):
     def __init__(self, message):
@@ -161,10 +173,22 @@ def set_folders_and_permissions(folders, user, group, mode=0o750):
 def fixMaybeLocalhost(hosts_path="/etc/hosts",
                       hostname=None,
                       IP=None):
+    from python_hosts import Hosts, HostsEntry
     hosts = Hosts(path=hosts_path)
-    removed_hosts = []
     # Consider cases where it is added both node.maas and node
-    for h in [hostname.split(".")[0], hostname]:
+    names = [hostname.split(".")[0], hostname]
+    matching = []
+    for h in names:
+        for e in hosts.find_all_matching(name=h):
+            if e not in matching:
+                matching.append(e)
+    if len(matching) == 1 and matching[0].address == IP and \
+       matching[0].names == [hostname] and \
+       len(hosts.find_all_matching(name="localhost")) > 0:
+        # Entry is already correct, avoid rewriting the file
+        return []
+    removed_hosts = []
+    for h in names:
         r = hosts.remove_all_matching(name=h)
         if r:
             removed_hosts += [str(el) for el in r]
@@ -179,10 +203,92 @@ def fixMaybeLocalhost(hosts_path="/etc/hosts",
     return removed_hosts
 
 
-def get_hostname(ipaddr):
+def _load_hostname_cache():
+    global _hostname_cache
+    if _hostname_cache is not None:
+        return _hostname_cache
+    _hostname_cache = {}
+    path = charmhelper.unit_state_path(HOSTNAME_CACHE_FILE)
+    if path and os.path.exists(path):
+        try:
+            with open(path) as f:
+                _hostname_cache = json.load(f)
+        except (OSError, ValueError):
+            # Corrupted cache, start over
+            _hostname_cache = {}
+    return _hostname_cache
+
+
+def _save_hostname_cache():
+    path = charmhelper.unit_state_path(HOSTNAME_CACHE_FILE)
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(_hostname_cache, f)
+    os.rename(path + ".tmp", path)
+
+
+def invalidate_hostname_cache(ipaddr=None):
+    """Removes ipaddr (or all the entries, if None) from the cache.
+
+    Should be called every time the binding addresses of the unit change.
+    """
+    cache = _load_hostname_cache()
+    if ipaddr:
+        cache.pop(ipaddr, None)
+    else:
+        cache.clear()
+    _save_hostname_cache()
+
+
+def _hosts_digest(hosts_path):
+    try:
+        with open(hosts_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def get_hostname(ipaddr, ttl=HOSTNAME_CACHE_TTL, hosts_path="/etc/hosts"):
+    """Resolves the hostname of ipaddr and fixes /etc/hosts accordingly.
+
+    Results are cached for ttl seconds. A cached hostname still fixes
+    /etc/hosts if its content changed since, e.g. cloud-init or an
+    operator changed the entry back.
+    """
     if not ipaddr:
         return
+    cache = _load_hostname_cache()
+    entry = cache.get(ipaddr, None)
+    if entry and time.time() - entry["timestamp"] < ttl:
+        if entry.get("hosts", None) != _hosts_digest(hosts_path):
+            fixMaybeLocalhost(hosts_path=hosts_path,
+                              hostname=entry["hostname"], IP=ipaddr)
+            entry["hosts"] = _hosts_digest(hosts_path)
+            _save_hostname_cache()
+        return entry["hostname"]
     h = charmhelper.get_hostname(ipaddr)
     if h:
-        fixMaybeLocalhost(hostname=h, IP=ipaddr)
+        fixMaybeLocalhost(hosts_path=hosts_path, hostname=h, IP=ipaddr)
+        cache[ipaddr] = {"hostname": h, "timestamp": time.time(),
+                         "hosts": _hosts_digest(hosts_path)}
+        _save_hostname_cache()
     return h
+
+
+def has_aes_ni(cpuinfo="/proc/cpuinfo"):
+    """Returns True if the CPU has AES instructions (AES-NI on x86).
+
+    Looks for the "aes" flag on the "flags" (x86) or "Features" (arm64)
+    lines of cpuinfo.
+    """
+    try:
+        with open(cpuinfo) as f:
+            for line in f:
+                k, _, v = line.partition(":")
+                if k.strip() in ["flags", "Features"]:
+                    return "aes" in v.split()
+    except OSError:
+        pass
+    return False
@@ -489,8 +489,13 @@ class KafkaListenerProvidesRelation(KafkaListenerRelation):
                        clientauth=False,
                        internal_extra_binding=None,
                        external_extra_binding=None,
-                       cluster_binding=None):
-        """Generates the config options based on listener template."""
+                       cluster_binding=None,
+                       ssl_opts=None):
+        """Generates the config options based on listener template.
+
+        ssl_opts: optional, dict of extra ssl.* options to be set on each
+                  of the TLS listeners, e.g. ssl.enabled.protocols.
+        """
         if not _lst:
             raise KafkaListenerRelationEmptyListenerDictError()
         # In case _lst comes as None
@@ -562,6 +567,8 @@ class KafkaListenerProvidesRelation(KafkaListenerRelation):
                         self.ts_path
                     listener_opts[prefix + k + ".ssl.truststore.password"] = \
                         self.ts_pwd
+                for opt, val in (ssl_opts or {}).items():
+                    listener_opts[prefix + k + "." + opt] = val
         return listener_opts
 
     def on_listener_relation_joined(self, event):
@@ -0,0 +1,168 @@
+"""
+
+Implements reading the broker metrics from the local JMX exporter.
+
+The JMX exporter renders the broker MBeans in the Prometheus text format,
+using the rules of templates/prometheus.yaml. With lowercaseOutputName set,
+for example:
+
+    kafka.server<type=ReplicaManager, name=UnderReplicatedPartitions>
+        -> kafka_server_replicamanager_underreplicatedpartitions
+    kafka.server<type=KafkaServer, name=BrokerState>
+        -> kafka_server_kafkaserver_brokerstate
+
+After a restart, the broker is healthy once it runs as broker and has no
+under-replicated partitions. Only then should the restart lock be handed
+to the next broker. Otherwise, the next restart happens while the replicas
+of this broker still catch up.
+
+check_broker_health runs a single check, e.g. once per hook while the
+restart event is deferred. wait_for_broker_health polls until healthy.
+
+How to use:
+
+    def _source():
+        return scrape_metrics(9404)
+
+    state, healthy_count = check_broker_health(_source, healthy_count)
+    if healthy_count >= HEALTH_STABLE_CHECKS:
+        ...
+
+    healthy, state = wait_for_broker_health(
+        _source, timeout=600,
+        progress=lambda s: logger.info(s["under_replicated"]))
+
+"""
+
+import time
+import logging
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "parse_metrics",
+    "scrape_metrics",
+    "broker_health",
+    "check_broker_health",
+    "wait_for_broker_health",
+    "UNDER_REPLICATED_PARTITIONS",
+    "BROKER_STATE",
+    "ACTIVE_CONTROLLER_COUNT",
+    "BROKER_STATE_RUNNING",
+    "HEALTH_STABLE_CHECKS"
+]
+
+UNDER_REPLICATED_PARTITIONS = \
+    "kafka_server_replicamanager_underreplicatedpartitions"
+BROKER_STATE = "kafka_server_kafkaserver_brokerstate"
+ACTIVE_CONTROLLER_COUNT = \
+    "kafka_controller_kafkacontroller_activecontrollercount"
+
+# BrokerState value once the broker finished its startup
+BROKER_STATE_RUNNING = 3
+
+HEALTH_CHECK_INTERVAL = 10
+# Number of consecutive healthy checks needed
+HEALTH_STABLE_CHECKS = 2
+
+
+def parse_metrics(text):
+    """Parses the Prometheus text format.
+
+    Returns {metric name: value}. Values of the same metric with different
+    labels are summed up.
+    """
+    result = {}
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        # Labels may contain spaces, the value comes after the last "}"
+        if "{" in line:
+            name = line[:line.index("{")]
+            rest = line[line.rindex("}") + 1:].split()
+        else:
+            name, _, rest = line.partition(" ")
+            rest = rest.split()
+        if not rest:
+            continue
+        try:
+            value = float(rest[0])
+        except ValueError:
+            continue
+        result[name] = result.get(name, 0.0) + value
+    return result
+
+
+def scrape_metrics(port, host="localhost", timeout=5):
+    """Returns the metrics of the JMX exporter at host:port.
+
+    Raises OSError if the exporter cannot be reached.
+    """
+    url = "http://{}:{}/metrics".format(host, port)
+    with urllib.request.urlopen(url, timeout=timeout) as r:
+        return parse_metrics(r.read().decode("utf-8", errors="replace"))
+
+
+def broker_health(metrics):
+    """Returns the health state of the broker from its metrics.
+
+    Returns {"healthy": bool, "under_replicated": int or None,
+    "broker_state": int or None}. Metrics that are missing are ignored,
+    but at least the under-replicated partitions must be present.
+    """
+    urp = metrics.get(UNDER_REPLICATED_PARTITIONS, None)
+    state = metrics.get(BROKER_STATE, None)
+    healthy = urp is not None and urp == 0 and \
+        (state is None or int(state) == BROKER_STATE_RUNNING)
+    return {
+        "healthy": healthy,
+        "under_replicated": int(urp) if urp is not None else None,
+        "broker_state": int(state) if state is not None else None
+    }
+
+
+def check_broker_health(source, healthy_count=0):
+    """Runs a single health check.
+
+    source: callable returning the metrics as {name: value}
+    healthy_count: number of consecutive healthy checks so far
+
+    Returns (state, healthy_count), the count including this check.
+    """
+    try:
+        state = broker_health(source())
+    except Exception as e:
+        logger.debug("Failed to read the broker metrics: {}".format(
+            str(e)))
+        state = {"healthy": False, "under_replicated": None,
+                 "broker_state": None}
+    return state, healthy_count + 1 if state["healthy"] else 0
+
+
+def wait_for_broker_health(source, timeout,
+                           interval=HEALTH_CHECK_INTERVAL,
+                           stable_checks=HEALTH_STABLE_CHECKS,
+                           progress=None):
+    """Waits until the broker is healthy for stable_checks checks in a row.
+
+    source: callable returning the metrics as {name: value}
+    timeout: maximum time to wait, in seconds
+    progress: optional, callable receiving the state and the time elapsed
+              after each check, e.g. to update the unit status
+
+    Returns (True, state) once healthy or (False, last state) on timeout.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    healthy_count = 0
+    while True:
+        state, healthy_count = check_broker_health(source, healthy_count)
+        if progress:
+            progress(state, int(time.monotonic() - start))
+        if healthy_count >= stable_checks:
+            return True, state
+        if time.monotonic() >= deadline:
+            return False, state
+        time.sleep(interval)
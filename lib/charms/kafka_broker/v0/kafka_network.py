@@ -0,0 +1,153 @@
+"""
+
+Implements a per-dispatch snapshot of the unit's network topology.
+
+Every binding address lookup runs network-get, a hook tool executed as a
+subprocess, and every get_address_in_network enumerates all the interfaces
+of the host. The snapshot collects, on first use, the bindings of all the
+relations and extra-bindings declared in metadata.yaml, running the
+network-get calls concurrently. The interface addresses are enumerated
+once as well.
+
+The snapshot lives for the duration of a dispatch: each hook creates a new
+charm object and, hence, a new snapshot.
+
+How to use:
+
+class MyCharm(CharmBase):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.network = NetworkSnapshot(self)
+
+    def some_method(self):
+        addr = self.network.ingress_address("cluster")
+        extra = self.network.address_in_network("192.168.0.0/24")
+
+Relation classes can use binding_address(charm, relation_name), which
+falls back to model.get_binding if the charm does not have a snapshot.
+
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from charms.kafka_broker.v0.charmhelper import (
+    get_address_in_network,
+    get_interface_networks
+)
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "NetworkSnapshot",
+    "binding_address"
+]
+
+# Maximum number of network-get calls running at the same time
+MAX_CONCURRENT_NETWORK_GET = 8
+
+
+class NetworkSnapshot(object):
+    """Caches binding and interface addresses for a dispatch."""
+
+    def __init__(self, charm, binding_names=None,
+                 max_workers=MAX_CONCURRENT_NETWORK_GET):
+        """Args:
+            charm: CharmBase object
+            binding_names: optional, list of bindings to be fetched. If not
+                           set, use all relations and extra-bindings of the
+                           charm's metadata.
+            max_workers: number of concurrent network-get calls
+        """
+        self._charm = charm
+        self._binding_names = binding_names
+        self._max_workers = max_workers
+        self._prefetched = False
+        self._interface_networks = None
+        self._address_in_network = {}
+
+    @property
+    def binding_names(self):
+        if self._binding_names is None:
+            meta = self._charm.meta
+            self._binding_names = \
+                list(meta.relations) + list(meta.extra_bindings)
+        return self._binding_names
+
+    def _fetch(self, binding):
+        try:
+            # ops caches the result of network-get in the binding object
+            binding.network
+        except Exception as e:
+            # Do not fail here. Accessing the binding again will raise
+            # the exception to the caller.
+            logger.debug("network-get for {} failed: {}".format(
+                binding.name, str(e)))
+
+    def prefetch(self):
+        """Runs network-get for all the bindings, concurrently."""
+        if self._prefetched:
+            return
+        self._prefetched = True
+        # get_binding is not thread-safe, create the Binding objects first
+        bindings = []
+        for name in self.binding_names:
+            try:
+                bindings.append(self._charm.model.get_binding(name))
+            except Exception as e:
+                logger.debug("Binding {} not available: {}".format(
+                    name, str(e)))
+        if len(bindings) <= 1 or self._max_workers <= 1:
+            for b in bindings:
+                self._fetch(b)
+            return
+        with ThreadPoolExecutor(
+                max_workers=min(self._max_workers, len(bindings))) as ex:
+            list(ex.map(self._fetch, bindings))
+
+    def network(self, name):
+        """Returns the ops Network object of a binding."""
+        self.prefetch()
+        return self._charm.model.get_binding(name).network
+
+    def bind_address(self, name):
+        return self.network(name).bind_address
+
+    def ingress_address(self, name):
+        return self.network(name).ingress_address
+
+    @property
+    def interface_networks(self):
+        """Returns the list of netaddr.IPNetwork of the host interfaces."""
+        if self._interface_networks is None:
+            self._interface_networks = get_interface_networks()
+        return self._interface_networks
+
+    def address_in_network(self, network):
+        """Cached version of charmhelper.get_address_in_network."""
+        if not network:
+            return None
+        if network not in self._address_in_network:
+            self._address_in_network[network] = get_address_in_network(
+                network, interface_networks=self.interface_networks)
+        return self._address_in_network[network]
+
+    def invalidate(self):
+        """Drops the cached interface addresses."""
+        self._interface_networks = None
+        self._address_in_network = {}
+
+
+def binding_address(charm, name, ingress=False):
+    """Returns the bind or ingress address of a binding.
+
+    Uses the charm's NetworkSnapshot if available, under charm.network.
+    Otherwise, runs network-get through the model.
+    """
+    snapshot = getattr(charm, "network", None)
+    if isinstance(snapshot, NetworkSnapshot):
+        return snapshot.ingress_address(name) if ingress \
+            else snapshot.bind_address(name)
+    network = charm.model.get_binding(name).network
+    return network.ingress_address if ingress else network.bind_address
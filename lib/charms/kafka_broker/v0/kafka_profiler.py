@@ -0,0 +1,303 @@
+"""
+
+Implements per-stage profiling of charm hooks.
+
+Each stage records its wall-clock time and the number of subprocesses
+spawned while it was running (e.g. keytool, openssl, systemctl calls).
+Stages can be nested: a stage accounts for everything that runs inside it.
+
+Subprocesses are only counted from the first stage of a dispatch until the
+profiler is flushed, subprocess.Popen is restored afterwards.
+
+Results of each dispatch are appended to a rolling history saved as a JSON
+file in the unit's state directory. The history can be summarized into
+p50/p95 per stage and per hook type with HookProfiler.report().
+
+How to use:
+
+from charms.kafka_broker.v0.charmhelper import unit_state_path
+
+class MyCharm(CharmBase):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.profiler = HookProfiler(
+            unit_state_path("hook-profile.json"))
+        self.framework.observe(self.framework.on.commit,
+                               self._on_framework_commit)
+
+    def _on_framework_commit(self, event):
+        self.profiler.flush()
+
+    @profiled("server-properties")
+    def _generate_server_properties(self):
+        ...
+
+    def _on_config_changed(self, event):
+        with self.profiler.stage("manage-volumes"):
+            self.manage_volumes()
+
+"""
+
+import os
+import json
+import math
+import time
+import logging
+import functools
+import threading
+import subprocess
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "HookProfiler",
+    "profiled",
+    "current_hook_name",
+    "count_subprocesses",
+    "percentile"
+]
+
+# Number of dispatches kept in the history
+DEFAULT_MAX_ENTRIES = 200
+
+_SUBPROCESS_COUNTER = [0]
+# Hook tools may run from threads, e.g. the network and relation data
+# snapshots: the counter and the Popen replacement are updated under it
+_COUNTER_LOCK = threading.Lock()
+
+
+class _CountingPopen(subprocess.Popen):
+    """Counts every subprocess spawned by the charm.
+
+    subprocess.run, check_call and check_output all instantiate Popen
+    through the module's namespace, hence replacing subprocess.Popen is
+    enough to account for all of them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        with _COUNTER_LOCK:
+            _SUBPROCESS_COUNTER[0] += 1
+        super().__init__(*args, **kwargs)
+
+
+_ORIGINAL_POPEN = subprocess.Popen
+_COUNTER_USERS = [0]
+
+
+@contextlib.contextmanager
+def count_subprocesses():
+    """Context manager that counts the subprocesses spawned inside it.
+
+    subprocess.Popen is replaced only while at least one of these contexts
+    is open, the original class is restored once the last one exits.
+    """
+    with _COUNTER_LOCK:
+        if _COUNTER_USERS[0] == 0 and subprocess.Popen is _ORIGINAL_POPEN:
+            subprocess.Popen = _CountingPopen
+        _COUNTER_USERS[0] += 1
+    try:
+        yield
+    finally:
+        with _COUNTER_LOCK:
+            _COUNTER_USERS[0] -= 1
+            if _COUNTER_USERS[0] == 0 and \
+               subprocess.Popen is _CountingPopen:
+                subprocess.Popen = _ORIGINAL_POPEN
+
+
+def current_hook_name():
+    """Returns the name of the hook or action being dispatched."""
+    dispatch = os.environ.get("JUJU_DISPATCH_PATH", "")
+    if dispatch:
+        return os.path.basename(dispatch)
+    return os.environ.get("JUJU_HOOK_NAME", None) or \
+        os.environ.get("JUJU_ACTION_NAME", None) or "unknown"
+
+
+def percentile(values, pct):
+    """Returns the nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class HookProfiler(object):
+    """Collects per-stage timings and persists them as a rolling history."""
+
+    def __init__(self, history_path=None, max_entries=DEFAULT_MAX_ENTRIES,
+                 hook=None):
+        """Args:
+            history_path: JSON file to save the history. If None, the
+                          results are kept in memory only.
+            max_entries: number of dispatches kept in the history
+            hook: name of the hook, if None, discover it from the env
+        """
+        self.history_path = history_path
+        self.max_entries = max_entries
+        self.hook = hook or current_hook_name()
+        self.stages = {}
+        self._start = time.monotonic()
+        self._start_subprocs = _SUBPROCESS_COUNTER[0]
+        self._flushed = False
+        self._counter = None
+
+    def _start_counter(self):
+        """Counts the subprocesses from now until the end of the dispatch.
+
+        Profilers only used to read the history never replace Popen.
+        """
+        if self._counter or self._flushed:
+            return
+        self._counter = contextlib.ExitStack()
+        self._counter.enter_context(count_subprocesses())
+        self._start_subprocs = _SUBPROCESS_COUNTER[0]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that accounts the time spent in a stage.
+
+        If the same stage runs several times within a hook, the times
+        and subprocess counts are added up.
+        """
+        self._start_counter()
+        start = time.monotonic()
+        subprocs = _SUBPROCESS_COUNTER[0]
+        try:
+            yield
+        finally:
+            s = self.stages.setdefault(
+                name, {"wall": 0.0, "subprocesses": 0, "calls": 0})
+            s["wall"] += time.monotonic() - start
+            s["subprocesses"] += _SUBPROCESS_COUNTER[0] - subprocs
+            s["calls"] += 1
+
+    def record(self, name, wall):
+        """Accounts wall seconds, measured elsewhere, to a stage.
+
+        Used for timings that do not map to a block of code, e.g. the time
+        until each endpoint answered after a restart.
+        """
+        s = self.stages.setdefault(
+            name, {"wall": 0.0, "subprocesses": 0, "calls": 0})
+        s["wall"] += wall
+        s["calls"] += 1
+
+    def load(self):
+        """Returns the history saved on disk."""
+        if not self.history_path or not os.path.exists(self.history_path):
+            return []
+        try:
+            with open(self.history_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to load hook profile history from "
+                           "{}: {}".format(self.history_path, str(e)))
+            return []
+
+    def entry(self):
+        """Returns the profile of the current dispatch."""
+        return {
+            "hook": self.hook,
+            "timestamp": time.time(),
+            "wall": time.monotonic() - self._start,
+            "subprocesses": _SUBPROCESS_COUNTER[0] - self._start_subprocs,
+            "stages": self.stages
+        }
+
+    def flush(self):
+        """Appends the current dispatch to the history file.
+
+        Only runs once per dispatch. Dispatches that did not run any of
+        the profiled stages are not saved. Stops counting the subprocesses
+        and restores subprocess.Popen.
+        """
+        if self._flushed:
+            return
+        if self._counter:
+            self._counter.close()
+            self._counter = None
+        if not self.stages or not self.history_path:
+            return
+        self._flushed = True
+        history = self.load()
+        history.append(self.entry())
+        history = history[-self.max_entries:]
+        tmp = self.history_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(history, f)
+            os.rename(tmp, self.history_path)
+        except OSError as e:
+            logger.warning("Failed to save hook profile history to "
+                           "{}: {}".format(self.history_path, str(e)))
+
+    def reset(self):
+        """Removes the history file."""
+        if self.history_path and os.path.exists(self.history_path):
+            os.remove(self.history_path)
+
+    def report(self, hook=None):
+        """Summarizes the history into p50/p95 timings.
+
+        Args:
+            hook: optional, only consider dispatches of this hook type
+
+        Returns a dict with:
+            "stages": {stage: stats} across all hook types
+            "hooks": {hook: {"total": stats, stage: stats}}
+        where stats is a dict with count, wall-p50, wall-p95 and
+        subprocesses-p95.
+        """
+        by_stage = {}
+        by_hook = {}
+        for e in self.load():
+            if hook and e["hook"] != hook:
+                continue
+            h = by_hook.setdefault(e["hook"], {})
+            h.setdefault("total", []).append(
+                (e["wall"], e["subprocesses"]))
+            for name, s in e["stages"].items():
+                sample = (s["wall"], s["subprocesses"])
+                by_stage.setdefault(name, []).append(sample)
+                h.setdefault(name, []).append(sample)
+
+        def _stats(samples):
+            walls = [w for w, _ in samples]
+            subprocs = [p for _, p in samples]
+            return {
+                "count": len(samples),
+                "wall-p50": round(percentile(walls, 50), 3),
+                "wall-p95": round(percentile(walls, 95), 3),
+                "subprocesses-p95": percentile(subprocs, 95)
+            }
+
+        return {
+            "stages": {k: _stats(v) for k, v in by_stage.items()},
+            "hooks": {
+                h: {k: _stats(v) for k, v in stages.items()}
+                for h, stages in by_hook.items()
+            }
+        }
+
+
+def profiled(stage):
+    """Decorator that profiles a method as a stage.
+
+    The object must have a "profiler" attribute set with a HookProfiler.
+    If it is not set, the method runs without profiling.
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(self, *args, **kwargs):
+            profiler = getattr(self, "profiler", None)
+            if not profiler:
+                return func(self, *args, **kwargs)
+            with profiler.stage(stage):
+                return func(self, *args, **kwargs)
+        return _wrapper
+    return _decorator
@@ -95,6 +95,11 @@ import uuid
 from ops.framework import EventBase, EventSource, StoredState, Object
 from ops.charm import CharmEvents
 
+from charms.kafka_broker.v0.kafka_network import binding_address
+from charms.kafka_broker.v0.kafka_relation_snapshot import (
+    get_relation_snapshot
+)
+
 
 def _implicit_peer_relation_name():
     md = None
@@ -150,22 +155,28 @@ class RelationManagerBase(Object):
             return None
         return self.relations[0]
 
+    @property
+    def relation_data(self):
+        """Snapshot of the relation databags, see kafka_relation_snapshot."""
+        return get_relation_snapshot(self._charm)
+
     @property
     def peer_addresses(self):
         addresses = []
+        data = self.relation_data
         for u in self.relation.units:
-            addresses.append(str(self.relation.data[u]["ingress-address"]))
+            addresses.append(
+                str(data.databag(self.relation, u)["ingress-address"]))
         return addresses
 
     @property
     def advertise_addr(self):
-        m = self.model
-        return str(m.get_binding(self._relation_name).network.ingress_address)
+        return str(binding_address(
+            self._charm, self._relation_name, ingress=True))
 
     @property
     def binding_addr(self):
-        m = self.model
-        return str(m.get_binding(self._relation_name).network.bind_address)
+        return str(binding_address(self._charm, self._relation_name))
 
     @property
     def relations(self):
@@ -205,13 +216,12 @@ class RelationManagerBase(Object):
         else:
             v = str(value)
         result = False
+        data = self.relation_data
         # Now, we have the data converted to string and we will try
         # update every relation available.
         for r in relation:
-            if v == r.data[rel_obj].get(field, ""):
-                continue
-            r.data[rel_obj][field] = v
-            result = True
+            if data.set(r, rel_obj, field, v):
+                result = True
         return result
 
 
@@ -263,13 +273,12 @@ class BasePrometheusMonitor(RelationManagerBase):
             "{}:{}".format(self.endpoint or self.advertise_addr, port)
         ]
         peer_rel = self.framework.model.relations[self.peer_rel_name][0]
-        for u in peer_rel.units:
-            entryname = self._relation_name + "_endpoint"
-            if entryname not in peer_rel.data[u]:
-                raise BasePrometheusMonitorMissingEndpointInfoError()
-            targets.append(
-                "{}:{}".format(
-                    peer_rel.data[u][entryname], port))
+        entryname = self._relation_name + "_endpoint"
+        endpoints = self.relation_data.values(peer_rel, entryname)
+        if len(endpoints) != len(peer_rel.units):
+            raise BasePrometheusMonitorMissingEndpointInfoError()
+        for e in endpoints:
+            targets.append("{}:{}".format(e, port))
 
         name = job_name or \
             "{}".format(self._charm.app.name.replace("-", "_"))
@@ -371,9 +380,10 @@ class BasePrometheusMonitor(RelationManagerBase):
         if not self.peer_rel_name:
             return
         peer_rel = self.framework.model.relations[self.peer_rel_name][0]
-        peer_rel.data[self.unit][self._relation_name + "_endpoint"] = \
-            self.endpoint or \
-            self.model.get_binding(self.peer_rel_name).network.ingress_address
+        self.relation_data.set(
+            peer_rel, self.unit, self._relation_name + "_endpoint",
+            self.endpoint or str(binding_address(
+                self._charm, self.peer_rel_name, ingress=True)))
 
     def on_prometheus_relation_changed(self, event):
         """If peers relation exist, ensure all the peers published their
@@ -389,17 +399,17 @@ class BasePrometheusMonitor(RelationManagerBase):
         # Check if all units have already published their endpoints.
         # If one did not yet, then defer this event and return.
         entryname = self._relation_name + "_endpoint"
-        if entryname not in peer_rel.data[self.unit]:
+        data = self.relation_data
+        if entryname not in data.databag(peer_rel, self.unit):
             # A -changed event is not expected to happen before a -joined.
             # Therefore this logic will likely never be used.
             event.defer()
             return
 
-        for u in peer_rel.units:
-            if entryname not in peer_rel.data[u]:
-                # Prometheus does not yet has all the info it needs.
-                # Postpone this event:
-                event.defer()
-                return
+        if len(data.values(peer_rel, entryname)) != len(peer_rel.units):
+            # Prometheus does not yet has all the info it needs.
+            # Postpone this event:
+            event.defer()
+            return
 
         self.on.prometheus_job_available.emit()
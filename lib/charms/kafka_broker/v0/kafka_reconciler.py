@@ -0,0 +1,133 @@
+"""
+
+Implements a dependency-tracked reconcile engine for rendered artifacts.
+
+Each artifact (e.g. server.properties, client.properties, override.conf)
+declares the inputs it depends on: config options, relation databags,
+certificate fingerprints, etc. The reconciler hashes those inputs and
+compares the digest with the one saved at the last successful build.
+If the digest is the same and the target files are still present, the
+build is skipped and the result saved on the last run is returned instead.
+
+The state is kept as a JSON string on a StoredState object, following the
+same pattern as other charm-wide states (e.g. config_state).
+
+How to use:
+
+class MyCharm(CharmBase):
+
+    def __init__(self, *args):
+        ...
+        self.ks.set_default(artifacts="{}")
+        self.reconciler = ArtifactReconciler(self.ks)
+
+    def _on_config_changed(self, event):
+        server_opts, changed = self.reconciler.reconcile(
+            "server.properties",
+            inputs={
+                "config": dict(self.config),
+                "cluster": self._relation_inputs("cluster")
+            },
+            build=lambda: self._generate_server_properties(event),
+            targets=[self.config["filepath-server-properties"]])
+
+If build returns None, the result is not saved and the artifact will be
+rebuilt on the next run. That allows methods that return early (e.g. waiting
+on a relation) to be retried.
+
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "ArtifactReconciler",
+    "fingerprint"
+]
+
+
+def fingerprint(inputs):
+    """Returns the sha256 digest of a JSON-serializable structure.
+
+    Keys are sorted so dicts built in different orders generate the same
+    digest. Values that are not serializable (e.g. sets) are converted
+    with str().
+    """
+    if isinstance(inputs, (set, frozenset)):
+        inputs = sorted(inputs)
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class ArtifactReconciler(object):
+    """Recomputes artifacts only when their declared inputs change."""
+
+    def __init__(self, state, state_key="artifacts"):
+        """Args:
+            state: StoredState object, must have state_key set as a
+                   JSON-formatted string.
+            state_key: name of the field in state used to save the digests
+        """
+        self._state = state
+        self._state_key = state_key
+
+    def _load(self):
+        return json.loads(getattr(self._state, self._state_key) or "{}")
+
+    def _save(self, artifacts):
+        setattr(self._state, self._state_key, json.dumps(artifacts))
+
+    def is_current(self, name, inputs, targets=None):
+        """Returns True if the artifact was built with the same inputs and
+        all its target files still exist."""
+        entry = self._load().get(name)
+        if not entry:
+            return False
+        if entry.get("digest") != fingerprint(inputs):
+            return False
+        for t in targets or []:
+            if not os.path.exists(t):
+                logger.debug("Artifact {} target {} missing".format(name, t))
+                return False
+        return True
+
+    def reconcile(self, name, inputs, build, targets=None):
+        """Builds the artifact if its inputs changed.
+
+        Args:
+            name: unique name of the artifact
+            inputs: JSON-serializable structure with all the inputs
+            build: callable that generates the artifact and returns a
+                   JSON-serializable result
+            targets: optional list of files generated by build
+
+        Returns a tuple (result, changed), where changed is True if
+        build was called.
+        """
+        if self.is_current(name, inputs, targets):
+            logger.debug("Artifact {} is up-to-date, skipping".format(name))
+            return self._load()[name].get("result"), False
+        logger.debug("Artifact {} inputs changed, rebuilding".format(name))
+        result = build()
+        if result is not None:
+            artifacts = self._load()
+            artifacts[name] = {
+                "digest": fingerprint(inputs),
+                "result": result
+            }
+            self._save(artifacts)
+        return result, True
+
+    def invalidate(self, name=None):
+        """Forces the artifact (or all, if name is None) to be rebuilt."""
+        if not name:
+            self._save({})
+            return
+        artifacts = self._load()
+        artifacts.pop(name, None)
+        self._save(artifacts)
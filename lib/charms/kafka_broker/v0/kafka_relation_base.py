@@ -1,8 +1,17 @@
+from collections.abc import Mapping
+
 from ops.framework import Object
 from ops.framework import StoredState
 
-from charms.kafka_broker.v0.kafka_security import CreateTruststore
+from charms.kafka_broker.v0.kafka_security import (
+    CreateTruststore,
+    index_cert_chains
+)
 from charms.kafka_broker.v0.kafka_linux import get_hostname
+from charms.kafka_broker.v0.kafka_network import binding_address
+from charms.kafka_broker.v0.kafka_relation_snapshot import (
+    get_relation_snapshot
+)
 
 __all__ = [
     "KafkaRelationBaseNotUsedError",
@@ -37,14 +46,23 @@ class KafkaRelationBase(Object):
         self._relation_name = relation_name
         # Keeping _relation for compatibility reasons
         self._relation = self.relation
-        # :: separated list of trusted_certs for TLS
-        self.state.set_default(trusted_certs="")
+        # Cert chains trusted for TLS, as a {fingerprint: chain} map
+        self.state.set_default(trusted_certs={})
+        if not isinstance(self.state.trusted_certs, Mapping):
+            # Older versions saved the chains as a :: separated string
+            self.state.trusted_certs = index_cert_chains(
+                self.state.trusted_certs.split("::"))
         self.state.set_default(ts_path="")
         self.state.set_default(ts_pwd="")
         self.state.set_default(user=user)
         self.state.set_default(group=group)
         self.state.set_default(mode=mode)
 
+    @property
+    def relation_data(self):
+        """Snapshot of the relation databags, see kafka_relation_snapshot."""
+        return get_relation_snapshot(self._charm)
+
     @property
     def ts_path(self):
         return self.state.ts_path
@@ -139,15 +157,14 @@ class KafkaRelationBase(Object):
             # given it will use non-encrypted communication instead
             return
         crt_list = list(ext_list)
+        data = self.relation_data
         for r in self.relations:
-            for u in self.all_units(r):
-                if "tls_cert" in r.data[u]:
-                    crt_list.append(r.data[u]["tls_cert"])
-        self.state.trusted_certs = \
-            "::".join(crt_list)
+            crt_list.extend(
+                data.values(r, "tls_cert", units=self.all_units(r)))
+        self.state.trusted_certs = index_cert_chains(crt_list)
         CreateTruststore(self.state.ts_path,
                          self.state.ts_pwd,
-                         self.state.trusted_certs.split("::"),
+                         list(self.state.trusted_certs.values()),
                          ts_regenerate=True,
                          user=self.state.user,
                          group=self.state.group,
@@ -164,12 +181,13 @@ class KafkaRelationBase(Object):
             rel = relation
         else:
             rel = [relation]
+        data = self.relation_data
         for r in rel:
             for u in self.all_units(r):
-                if "tls_cert" in r.data[u]:
+                if "tls_cert" in data.databag(r, u):
                     # It is enabled, now we check
                     # if we have it set this unit as well
-                    if "tls_cert" not in r.data[self.unit]:
+                    if "tls_cert" not in data.databag(r, self.unit):
                         # we do not, so raise an error to inform it
                         raise KafkaRelationBaseTLSNotSetError()
                     return True
@@ -196,14 +214,13 @@ class KafkaRelationBase(Object):
         """
         if not self.relations:
             raise KafkaRelationBaseNotUsedError()
+        data = self.relation_data
         for r in self.relations:
             # 1) Publishes the cert on tls_cert
-            if cert_chain == r.data[self.unit].get("tls_cert", ""):
-                continue
-            r.data[self.unit]["tls_cert"] = cert_chain
+            data.set(r, self.unit, "tls_cert", cert_chain)
         self.state.ts_path = truststore_path
         self.state.ts_pwd = truststore_pwd
-        self.state.trusted_certs = cert_chain
+        self.state.trusted_certs = index_cert_chains([cert_chain])
         if user:
             self.state.user = user
         if group:
@@ -216,16 +233,17 @@ class KafkaRelationBase(Object):
     @property
     def peer_addresses(self):
         addresses = []
+        data = self.relation_data
         for u in self.relation.units:
-            addresses.append(str(self.relation.data[u]["ingress-address"]))
+            addresses.append(
+                str(data.databag(self.relation, u)["ingress-address"]))
         return addresses
 
     @property
     def advertise_addr(self):
-        m = self.model
-        return str(m.get_binding(self._relation_name).network.ingress_address)
+        return str(binding_address(
+            self._charm, self._relation_name, ingress=True))
 
     @property
     def binding_addr(self):
-        m = self.model
-        return str(m.get_binding(self._relation_name).network.bind_address)
+        return str(binding_address(self._charm, self._relation_name))
@@ -0,0 +1,239 @@
+"""
+
+Implements a per-dispatch snapshot of the relation databags.
+
+Every read of a databag that was not accessed yet runs relation-get, a hook
+tool executed as a subprocess. Methods such as get_all_certs or
+scrape_request_all_peers walk the databags of every unit of a relation,
+which, on large clusters, dominates the hook time. Likewise, every write
+runs relation-set.
+
+The snapshot loads, on first read, all the databags of a list of relations
+concurrently and keeps them as read-only views. Lookups of a given key
+across all the units of a relation are indexed.
+
+Writes are buffered and flushed once, at the end of the dispatch, with a
+single relation-set per databag. Values equal to the ones already present
+are discarded. Reads see the buffered writes.
+
+The snapshot lives for the duration of a dispatch: each hook creates a new
+charm object and, hence, a new snapshot.
+
+How to use:
+
+class MyCharm(CharmBase):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.relation_data = RelationSnapshot(self, ["cluster"])
+        self.framework.observe(self.framework.on.commit,
+                               self._on_framework_commit)
+
+    def _on_framework_commit(self, event):
+        self.relation_data.flush()
+
+    def some_method(self):
+        r = self.model.get_relation("cluster")
+        certs = self.relation_data.values(r, "cert")
+        self.relation_data.set(r, self.unit, "cert", my_cert)
+
+Relation classes can use get_relation_snapshot(charm), which falls back to
+an unbuffered snapshot if the charm does not have one.
+
+"""
+
+import logging
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "RelationSnapshot",
+    "get_relation_snapshot"
+]
+
+# Maximum number of relation-get calls running at the same time
+MAX_CONCURRENT_RELATION_GET = 8
+
+
+class RelationSnapshot(object):
+    """Caches relation databags and buffers writes for a dispatch."""
+
+    def __init__(self, charm, relation_names=None, buffered=True,
+                 max_workers=MAX_CONCURRENT_RELATION_GET):
+        """Args:
+            charm: CharmBase object
+            relation_names: optional, list of relations to be loaded on
+                            first read. If not set, use all the relations
+                            of the charm's metadata.
+            buffered: if False, writes run relation-set right away
+            max_workers: number of concurrent relation-get calls
+        """
+        self._charm = charm
+        self._relation_names = relation_names
+        self._buffered = buffered
+        self._max_workers = max_workers
+        self._prefetched = False
+        # {(relation id, entity name): dict}
+        self._bags = {}
+        # {(relation id, key): [values]}
+        self._index = {}
+        # {(relation id, entity name): (relation, entity, dict)}
+        self._pending = {}
+
+    @property
+    def relation_names(self):
+        if self._relation_names is None:
+            self._relation_names = list(self._charm.meta.relations)
+        return self._relation_names
+
+    def _entities(self, relation):
+        """Returns all the units and apps that have a databag."""
+        entities = list(relation.units)
+        entities.append(self._charm.unit)
+        if relation.app:
+            entities.append(relation.app)
+        if relation.app != self._charm.app:
+            entities.append(self._charm.app)
+        return entities
+
+    def _fetch(self, relation, entity):
+        try:
+            return dict(relation.data[entity])
+        except Exception as e:
+            # Do not fail here. The databag is read again from the model
+            # and the exception raised to the caller, if any.
+            logger.debug("relation-get for {} on {} failed: {}".format(
+                entity.name, relation.name, str(e)))
+            return None
+
+    def _load(self, args):
+        relation, entity = args
+        bag = self._fetch(relation, entity)
+        if bag is not None:
+            self._bags.setdefault((relation.id, entity.name), bag)
+
+    def prefetch(self):
+        """Loads all the databags of the relations, concurrently."""
+        if self._prefetched or not self._buffered:
+            return
+        self._prefetched = True
+        todo = []
+        for name in self.relation_names:
+            for r in self._charm.model.relations.get(name, []):
+                for e in self._entities(r):
+                    if (r.id, e.name) not in self._bags:
+                        todo.append((r, e))
+        if len(todo) <= 1 or self._max_workers <= 1:
+            for t in todo:
+                self._load(t)
+            return
+        with ThreadPoolExecutor(
+                max_workers=min(self._max_workers, len(todo))) as ex:
+            list(ex.map(self._load, todo))
+
+    def _bag(self, relation, entity):
+        key = (relation.id, entity.name)
+        if key not in self._bags:
+            if relation.name in self.relation_names:
+                self.prefetch()
+            if key not in self._bags:
+                bag = self._fetch(relation, entity)
+                if bag is None:
+                    # Raise the same exception the model would
+                    return relation.data[entity]
+                self._bags[key] = bag
+        return self._bags[key]
+
+    def databag(self, relation, entity):
+        """Returns a read-only view of the databag of a unit or app."""
+        bag = self._bag(relation, entity)
+        if isinstance(bag, dict):
+            return MappingProxyType(bag)
+        return bag
+
+    def get(self, relation, entity, key, default=None):
+        """Returns the value of key in the databag of a unit or app."""
+        return self._bag(relation, entity).get(key, default)
+
+    def values(self, relations, key, units=None):
+        """Returns the values of key across the units of relations.
+
+        Units that do not have key set are skipped.
+
+        Args:
+            relations: a relation or a list of relations
+            key: the key to look for
+            units: optional, list of units to search. If not set, use the
+                   remote units of each relation.
+        """
+        if not relations:
+            return []
+        if not isinstance(relations, (list, tuple)):
+            relations = [relations]
+        result = []
+        for r in relations:
+            if units is not None:
+                for u in units:
+                    v = self.get(r, u, key)
+                    if v is not None:
+                        result.append(v)
+                continue
+            index_key = (r.id, key)
+            if index_key not in self._index:
+                found = [self.get(r, u, key) for u in r.units]
+                self._index[index_key] = \
+                    [v for v in found if v is not None]
+            result.extend(self._index[index_key])
+        return result
+
+    def set(self, relation, entity, key, value):
+        """Sets key in the databag of a unit or app.
+
+        Returns True if the value changed. If the snapshot is buffered, the
+        write only happens on flush().
+        """
+        bag = self._bag(relation, entity)
+        if bag.get(key, "") == value:
+            return False
+        if not isinstance(bag, dict):
+            # Not readable through the snapshot, write to the model
+            bag[key] = value
+            return True
+        if not self._buffered:
+            relation.data[entity][key] = value
+        if value == "":
+            bag.pop(key, None)
+        else:
+            bag[key] = value
+        self._index.pop((relation.id, key), None)
+        if not self._buffered:
+            return True
+        self._pending.setdefault(
+            (relation.id, entity.name), (relation, entity, {}))[2][key] = value
+        return True
+
+    def flush(self):
+        """Writes all the buffered changes, one relation-set per databag."""
+        pending, self._pending = self._pending, {}
+        for relation, entity, data in pending.values():
+            logger.debug("Flushing {} keys to {} on {}".format(
+                len(data), entity.name, relation.name))
+            relation.data[entity].update(data)
+
+    @property
+    def has_pending_writes(self):
+        return len(self._pending) > 0
+
+
+def get_relation_snapshot(charm):
+    """Returns the charm's RelationSnapshot, under charm.relation_data.
+
+    If the charm does not have one, returns an unbuffered snapshot, which
+    reads from and writes to the model right away.
+    """
+    snapshot = getattr(charm, "relation_data", None)
+    if isinstance(snapshot, RelationSnapshot):
+        return snapshot
+    return RelationSnapshot(charm, relation_names=[], buffered=False)
@@ -0,0 +1,452 @@
+"""
+
+Implements a rack-aware rolling restart scheduler over the peer relation.
+
+OpsCoordinator grants the restart lock to one unit at a time: a rollout
+takes as many steps as there are brokers. If every partition has replicas
+in at least two racks, all the brokers of a rack can be restarted at the
+same time without taking any partition offline. The rollout then takes as
+many steps as there are racks.
+
+Each unit publishes, on its peer databag:
+
+    restart_request: token of the restart it waits for
+    restart_done: token of the last restart it finished
+    restart_recovering: token of the restart it waits to recover from,
+                        i.e. restarted but its replicas still catch up
+    rack: broker.rack of the unit, if any
+    broker_id: broker.id of the unit
+    controller: "true" if the unit runs the active controller
+
+The leader publishes the units allowed to restart on the app databag:
+
+    restart_grants: {"rack": <rack>, "units": [<unit names>]}
+    restart_rollout: {"active": <bool>, "controller": <unit name>,
+                      "start_epoch": <controller epoch>,
+                      "failovers": <controller failovers>}
+
+The leader keeps granting units of the same rack, up to max_concurrency at
+a time, until all of its pending units are done. Then it moves to the next
+rack. If parallel restarts are not safe, only one unit is granted at a
+time, as OpsCoordinator does. Units without a rack are restarted one at a
+time.
+
+The unit of the active controller is restarted last: its rack is the last
+one and it is the last unit granted within its rack. Otherwise, each
+restart of a broker after the controller's may cause another controller
+failover, which stalls the metadata updates and leader elections.
+The leader counts the failovers of each rollout in restart_rollout, from
+the controller epoch if known, or else from the changes of controller.
+
+How to use:
+
+    self.restart_scheduler = RackRestartScheduler(self, "cluster")
+
+    def on_restart_event(self, event):
+        self.restart_scheduler.request(rack=..., broker_id=...)
+        if self.unit.is_leader():
+            self.restart_scheduler.schedule(
+                max_concurrency=0, safety_check=my_check,
+                controller=self.restart_scheduler.controller_unit(id))
+        if not self.restart_scheduler.is_granted():
+            event.defer()
+            return
+        # restart the service
+        self.restart_scheduler.done()
+
+The leader must also run schedule() on peer relation events, so it sees
+the units that finished.
+
+"""
+
+import re
+import json
+import time
+import logging
+import subprocess
+
+from charms.kafka_broker.v0.kafka_relation_snapshot import (
+    get_relation_snapshot
+)
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "SCHEDULER_KEYS",
+    "RackRestartScheduler",
+    "KafkaTopicsError",
+    "plan_restarts",
+    "update_rollout",
+    "partitions_span_racks",
+    "parse_topics_describe",
+    "describe_partitions",
+    "kafka_topics_command"
+]
+
+# Databag keys
+RESTART_REQUEST = "restart_request"
+RESTART_DONE = "restart_done"
+RESTART_RECOVERING = "restart_recovering"
+RESTART_GRANTS = "restart_grants"
+RESTART_ROLLOUT = "restart_rollout"
+RACK = "rack"
+BROKER_ID = "broker_id"
+CONTROLLER = "controller"
+# All of the above: restart bookkeeping, unrelated to the broker configs
+SCHEDULER_KEYS = [RESTART_REQUEST, RESTART_DONE, RESTART_RECOVERING,
+                  RESTART_GRANTS, RESTART_ROLLOUT, RACK, BROKER_ID,
+                  CONTROLLER]
+
+# Prefix of the rack given to units without broker.rack, so each one of
+# them is restarted alone
+NO_RACK_PREFIX = "unit:"
+
+# Max time, in seconds, the active controller lets the other units restart
+# first when the lock has no order, as with OpsCoordinator
+CONTROLLER_YIELD_TIMEOUT = 3600
+
+_REPLICAS_RE = re.compile(r"Replicas:\s*([0-9,]+)")
+
+
+class KafkaTopicsError(Exception):
+
+    def __init__(self,
+                 message="Failed to describe the topics"):
+        super().__init__(message)
+
+
+def kafka_topics_command(distro):
+    """Returns the kafka-topics command for a given distro."""
+    if distro == "apache_snap":
+        return "kafka.topics"
+    if distro == "apache":
+        return "/opt/kafka/bin/kafka-topics.sh"
+    return "kafka-topics"
+
+
+def parse_topics_describe(output):
+    """Returns the list of replicas of each partition.
+
+    output: output of kafka-topics --describe, e.g.:
+        Topic: t1  Partition: 0  Leader: 1  Replicas: 1,2,3  Isr: 1,2,3
+    """
+    result = []
+    for line in output.split("\n"):
+        m = _REPLICAS_RE.search(line)
+        if m and "Partition:" in line:
+            result.append([r for r in m.group(1).split(",") if r])
+    return result
+
+
+def describe_partitions(bootstrap_server, command_config=None,
+                        cmd="kafka-topics", extra_args=None):
+    """Returns the list of replicas of each partition of the cluster.
+
+    extra_args: optional, list of extra arguments to filter the partitions,
+                e.g. ["--under-replicated-partitions"]
+
+    Raises KafkaTopicsError if kafka-topics fails.
+    """
+    args = [cmd, "--bootstrap-server", bootstrap_server, "--describe"]
+    args.extend(extra_args or [])
+    if command_config:
+        args.extend(["--command-config", command_config])
+    try:
+        output = subprocess.check_output(args, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        output = getattr(e, "output", None) or b""
+        raise KafkaTopicsError(
+            "kafka-topics failed: {} {}".format(
+                str(e), output.decode("utf-8", errors="replace")))
+    return parse_topics_describe(output.decode("utf-8", errors="replace"))
+
+
+def partitions_span_racks(partitions, broker_racks, min_racks=2):
+    """Returns True if the replicas of every partition span min_racks racks.
+
+    partitions: list of replicas (broker ids) per partition
+    broker_racks: {broker id: rack}. Brokers with an unknown rack are
+                  considered to be alone in their own rack.
+    """
+    for replicas in partitions:
+        racks = set(broker_racks.get(str(b), NO_RACK_PREFIX + str(b))
+                    for b in replicas)
+        if len(racks) < min_racks:
+            return False
+    return True
+
+
+def _unit_key(name):
+    app, _, num = name.rpartition("/")
+    return (app, int(num) if num.isdigit() else num)
+
+
+def plan_restarts(requests, grants, max_concurrency=0, parallel=True,
+                  rack_order=None, last_unit=None):
+    """Returns the next restart grants.
+
+    requests: {unit name: rack} of the units waiting for a restart
+    grants: last grants, {"rack": rack, "units": [unit names]}
+    max_concurrency: max units of a rack restarting at once, 0 for all
+    parallel: if False, grant a single unit at a time
+    rack_order: optional, sort key used to choose the next rack
+    last_unit: optional, unit to be granted after the others of its rack,
+               e.g. the active controller
+    """
+    grants = grants or {}
+    # Granted units that have not finished yet
+    active = [u for u in grants.get("units", []) if u in requests]
+    rack = grants.get("rack", None)
+    if rack not in requests.values():
+        racks = sorted(set(requests.values()), key=rack_order)
+        if not racks:
+            return {"rack": None, "units": []}
+        rack = racks[0]
+    if not parallel or rack.startswith(NO_RACK_PREFIX):
+        limit = 1
+    else:
+        limit = max_concurrency
+    candidates = sorted(
+        [u for u, r in requests.items() if r == rack and u not in active],
+        key=lambda u: (u == last_unit, _unit_key(u)))
+    slots = len(candidates) if limit <= 0 else max(0, limit - len(active))
+    return {"rack": rack, "units": active + candidates[:slots]}
+
+
+def update_rollout(rollout, pending, controller=None, epoch=None):
+    """Returns the rollout state after a new observation of the cluster.
+
+    rollout: last state, see restart_rollout
+    pending: True if any unit waits for a restart
+    controller: unit of the active controller, if known
+    epoch: controller epoch, if known. Each election increments it.
+    """
+    rollout = dict(rollout or {})
+    if not rollout.get("active", False):
+        if not pending:
+            return rollout
+        rollout = {"active": True, "controller": controller,
+                   "start_epoch": epoch, "failovers": 0}
+    elif epoch is not None and rollout.get("start_epoch") is not None:
+        rollout["failovers"] = max(0, epoch - rollout["start_epoch"])
+    elif controller and rollout.get("controller") and \
+            controller != rollout["controller"]:
+        rollout["failovers"] = rollout.get("failovers", 0) + 1
+    if controller:
+        rollout["controller"] = controller
+    if rollout.get("start_epoch") is None:
+        rollout["start_epoch"] = epoch
+    if not pending:
+        rollout["active"] = False
+    return rollout
+
+
+class RackRestartScheduler(object):
+    """Schedules the restarts of the brokers rack by rack."""
+
+    def __init__(self, charm, relation_name):
+        self._charm = charm
+        self._relation_name = relation_name
+
+    @property
+    def relation(self):
+        return self._charm.model.get_relation(self._relation_name)
+
+    @property
+    def relation_data(self):
+        return get_relation_snapshot(self._charm)
+
+    @property
+    def unit(self):
+        return self._charm.unit
+
+    def _all_units(self):
+        return [self.unit] + list(self.relation.units)
+
+    def _get(self, entity, key, default=None):
+        return self.relation_data.get(self.relation, entity, key, default)
+
+    def _set(self, entity, key, value):
+        self.relation_data.set(self.relation, entity, key, value)
+
+    def _is_pending(self, unit):
+        req = self._get(unit, RESTART_REQUEST, "")
+        return len(req) > 0 and req != self._get(unit, RESTART_DONE, "")
+
+    @property
+    def pending(self):
+        """True if this unit waits for a restart."""
+        if not self.relation:
+            return False
+        return self._is_pending(self.unit)
+
+    def request(self, rack=None, broker_id=None):
+        """Publishes a restart request, if none is pending."""
+        if not self.relation:
+            return
+        self._set(self.unit, RACK, rack or "")
+        self._set(self.unit, BROKER_ID, str(broker_id or ""))
+        if not self.pending:
+            self._set(self.unit, RESTART_REQUEST, str(time.time()))
+
+    def recovering(self):
+        """Marks this unit as restarted, but not yet recovered.
+
+        The restart stays pending until done() is called.
+        """
+        if not self.relation:
+            return
+        self._set(self.unit, RESTART_RECOVERING,
+                  self._get(self.unit, RESTART_REQUEST, ""))
+
+    def done(self):
+        """Marks the restart of this unit as finished."""
+        if not self.relation:
+            return
+        self._set(self.unit, RESTART_DONE,
+                  self._get(self.unit, RESTART_REQUEST, ""))
+
+    @property
+    def grants(self):
+        if not self.relation:
+            return {}
+        return json.loads(
+            self._get(self._charm.app, RESTART_GRANTS, "") or "{}")
+
+    def is_granted(self):
+        """True if this unit can restart now.
+
+        Without the peer relation, there is no other unit to wait for.
+        """
+        if not self.relation:
+            return True
+        return self.unit.name in self.grants.get("units", [])
+
+    def requests(self):
+        """Returns {unit name: rack} of the units waiting for a restart."""
+        result = {}
+        for u in self._all_units():
+            if self._is_pending(u):
+                result[u.name] = self._get(u, RACK, "") or \
+                    NO_RACK_PREFIX + u.name
+        return result
+
+    def broker_racks(self):
+        """Returns {broker id: rack} of all the units."""
+        result = {}
+        for u in self._all_units():
+            broker_id = self._get(u, BROKER_ID, "")
+            if broker_id:
+                result[broker_id] = self._get(u, RACK, "") or \
+                    NO_RACK_PREFIX + u.name
+        return result
+
+    def set_controller(self, is_controller):
+        """Publishes if this unit runs the active controller."""
+        if not self.relation:
+            return
+        self._set(self.unit, CONTROLLER, "true" if is_controller else "")
+
+    def controller_unit(self, broker_id=None):
+        """Returns the name of the unit running the active controller.
+
+        broker_id: optional, id of the active controller, e.g. read from
+                   ZooKeeper. If not set, the flags published with
+                   set_controller are used instead.
+        """
+        if not self.relation:
+            return None
+        for u in self._all_units():
+            if broker_id is not None:
+                if self._get(u, BROKER_ID, "") == str(broker_id):
+                    return u.name
+            elif self._get(u, CONTROLLER, "") == "true":
+                return u.name
+        return None
+
+    def others_pending(self):
+        """Returns the names of the other units waiting for a restart."""
+        return sorted(u for u in self.requests() if u != self.unit.name)
+
+    def others_recovering(self):
+        """Returns the names of the other units restarted, but not yet
+        recovered."""
+        if not self.relation:
+            return []
+        return sorted(
+            u.name for u in self.relation.units if self._is_pending(u) and
+            self._get(u, RESTART_RECOVERING, "") ==
+            self._get(u, RESTART_REQUEST, ""))
+
+    @property
+    def rollout(self):
+        if not self.relation:
+            return {}
+        return json.loads(
+            self._get(self._charm.app, RESTART_ROLLOUT, "") or "{}")
+
+    def track_rollout(self, controller=None, epoch=None):
+        """Updates the controller failovers of the current rollout.
+
+        Only runs on the leader. Returns the rollout state.
+        """
+        if not self.relation or not self.unit.is_leader():
+            return self.rollout
+        last = self.rollout
+        rollout = update_rollout(last, len(self.requests()) > 0,
+                                 controller=controller, epoch=epoch)
+        if rollout != last:
+            if last.get("active", False) and not rollout["active"]:
+                logger.info("Rolling restart finished with {} controller "
+                            "failovers".format(rollout["failovers"]))
+            self._set(self._charm.app, RESTART_ROLLOUT,
+                      json.dumps(rollout, sort_keys=True))
+        return rollout
+
+    def num_racks(self):
+        return len(set(self._get(u, RACK, "") or NO_RACK_PREFIX + u.name
+                       for u in self._all_units()))
+
+    def schedule(self, max_concurrency=0, safety_check=None,
+                 rack_order=None, controller=None):
+        """Updates the restart grants. Only runs on the leader.
+
+        safety_check: optional, callable receiving {broker id: rack} that
+                      returns True if a whole rack can restart at once.
+                      Only called when a new rack is about to start.
+        controller: optional, unit of the active controller, restarted last
+        Returns the new grants.
+        """
+        if not self.relation or not self.unit.is_leader():
+            return self.grants
+        requests = self.requests()
+        last = self.grants
+        if controller in requests:
+            controller_rack = requests[controller]
+            order = rack_order
+
+            def rack_order(r):
+                return (r == controller_rack,
+                        order(r) if order else r)
+        parallel = self.num_racks() >= 2
+        starting = last.get("rack", None) not in requests.values()
+        if parallel and starting and safety_check:
+            try:
+                parallel = safety_check(self.broker_racks())
+            except Exception as e:
+                logger.warning("Restart safety check failed, restarting "
+                               "one unit at a time: {}".format(str(e)))
+                parallel = False
+        elif not starting:
+            # Keep the mode chosen when the rack started
+            parallel = last.get("parallel", parallel)
+        grants = plan_restarts(requests, last,
+                               max_concurrency=max_concurrency,
+                               parallel=parallel, rack_order=rack_order,
+                               last_unit=controller)
+        grants["parallel"] = parallel
+        if grants != last:
+            logger.info("Restart grants: {}".format(grants))
+            self._set(self._charm.app, RESTART_GRANTS,
+                      json.dumps(grants, sort_keys=True))
+        return grants
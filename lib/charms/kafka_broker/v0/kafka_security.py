@@ -11,69 +11,205 @@
 #  under the License.
 
 import os
+import json
+import base64
 import shutil
 import string
+import hashlib
+import logging
+import tempfile
 import subprocess
-from OpenSSL import crypto
+
+import charms.kafka_broker.v0.charmhelper as charmhelper
+
+logger = logging.getLogger(__name__)
 
 CHARS_PASSWORD = string.ascii_letters + string.digits
 PASSWORD_LEN = 48
 
+# Keystores and truststores are only rebuilt if their inputs change.
+# The digest of the inputs and of the resulting file are kept per path.
+STORE_CACHE_FILE = "store-cache.json"
+_store_cache = None
+
+# Algorithms supported for generated keys. ECDSA keys are much cheaper to
+# generate and to handshake with than RSA keys of equivalent strength.
+KEY_ALGORITHMS = [
+    "ecdsa-p256",
+    "ecdsa-p384",
+    "ed25519",
+    "rsa-2048",
+    "rsa-4096"
+]
+DEFAULT_KEY_ALGORITHM = "rsa-4096"
+
+# Private keys generated ahead of time, see pregenerate_keys
+PREGENERATED_KEYS_FOLDER = "pregenerated-keys"
+PREGENERATED_KEYS_COUNT = 2
+
+# Protocols enabled by the TLS performance profile. TLS 1.3 needs one
+# round trip less than TLS 1.2 to complete the handshake.
+TLS_PERFORMANCE_PROTOCOLS = ["TLSv1.3", "TLSv1.2"]
+
+# TLS 1.3 suites do not depend on the certificate key type
+TLS13_CIPHER_SUITES = [
+    "TLS_AES_128_GCM_SHA256",
+    "TLS_AES_256_GCM_SHA384",
+    "TLS_CHACHA20_POLY1305_SHA256"
+]
+# TLS 1.2 suites, per certificate key type, strongest first
+TLS12_CIPHER_SUITES = {
+    "ecdsa": [
+        "TLS_ECDHE_ECDSA_WITH_AES_128_GCM_SHA256",
+        "TLS_ECDHE_ECDSA_WITH_AES_256_GCM_SHA384",
+        "TLS_ECDHE_ECDSA_WITH_CHACHA20_POLY1305_SHA256"
+    ],
+    "rsa": [
+        "TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256",
+        "TLS_ECDHE_RSA_WITH_AES_256_GCM_SHA384",
+        "TLS_ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256"
+    ]
+}
+
 
 nano = [
     'get_ca_and_cert',
     '_break_crt_chain',
+    'iter_pem_certificates',
+    'iter_certificates',
+    'cert_fingerprint',
+    'merge_certificates',
+    'index_cert_chains',
     'saveCrtChainToFile',
     '_check_file_exists',
     'genRandomPassword',
     'RegisterIfKeystoreExists',
     'RegisterIfTruststoreExists',
     'setFilePermissions',
+    'generateKey',
+    'key_algorithm_family',
+    'cipher_suites_for_cert',
+    'pregenerate_keys',
+    'pop_pregenerated_key',
     'generateSelfSigned',
     'SetTrustAndKeystoreFilePermissions',
     'SetCertAndKeyFilePermissions',
     'PKCS12CreateKeystore',
     'CreateTruststoreWithCertificates',
     'CreateKeystoreAndTruststore',
-    'CreateTruststore'
+    'CreateTruststore',
+    'invalidate_store_cache'
 ]
 
 
 def get_ca_and_cert(full_chain):
-    """Returns the ca, crt in string format."""
+    """Returns the ca, crt in string format.
+
+    Both are empty if full_chain has no certificate.
+    """
     chain = _break_crt_chain(full_chain)
+    if not chain:
+        return "", ""
     if len(chain) > 1:
         return "\n".join(chain[1:]), chain[0]
     # It is a self-signed cert, return the same cert for both
     return chain[0], chain[0]
 
 
-def _break_crt_chain(buffer):
-    """Breaks the certificate chain string into a list.
+PEM_BEGIN = "-----BEGIN CERTIFICATE-----"
+PEM_END = "-----END CERTIFICATE-----"
 
-    Splits the cert chain with "-----END CERTIFICATE-----".
 
-    There are two cases to consider:
-    1) Certificates ending on "-----END CERTIFICATE-----"
-    2) Certificates ending on "-----END CERTIFICATE-----\n"
+def _iter_lines(data):
+    """Yields the lines of data, which can be a str, bytes or an iterable
+    of lines (e.g. a file object)."""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    if isinstance(data, str):
+        data = data.splitlines()
+    for line in data:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        yield line.strip()
 
-    In case (1), there will be certificates in the list with "\n-----BEGIN CERTIFICATE-----\n"
-    at the start. In case (2), certificates will be rendered correctly. There will be some empty
-    or "\n" strings in the intermediate list as well.
 
-    The inner list comprehension will parse the chain string into chunks and filter the cases of not
-    being certificates (i.e. starting with "-----BEGIN CERTIFICATE-----\n") by either trying
-    to remove the "\n" at the start or just setting that string to None.
+def iter_pem_certificates(data):
+    """Yields each certificate found in a PEM bundle, one at a time.
 
-    The outer list comprehension ensures only meaningful (not None) are considered.
+    Handles CRLF line endings, surrounding whitespace and any text found
+    between certificates (e.g. the subject/issuer comments of CA bundles).
+    Certificates are yielded in the normalized format:
+    "-----BEGIN CERTIFICATE-----\n<base64 lines>\n-----END CERTIFICATE-----"
     """
-    return [x for x in [i+"-----END CERTIFICATE-----"
-                        if i.startswith("-----BEGIN CERTIFICATE-----\n") else
-                        (i[1:]+"-----END CERTIFICATE-----" if i.startswith("\n-----BEGIN CERTIFICATE-----\n") else None)
-                        for i in buffer.split("-----END CERTIFICATE-----")] if x is not None]
-#    return [i+"-----END CERTIFICATE-----"
-#            for i in buffer.split("-----END CERTIFICATE-----")
-#            if i.startswith("-----BEGIN CERTIFICATE-----\n")]
+    body = None
+    for line in _iter_lines(data):
+        if line == PEM_BEGIN:
+            body = []
+        elif line == PEM_END:
+            if body:
+                yield "\n".join([PEM_BEGIN] + body + [PEM_END])
+            body = None
+        elif body is not None and line:
+            body.append(line)
+
+
+def cert_fingerprint(pem):
+    """Returns the SHA-256 fingerprint, in hex, of a PEM certificate.
+
+    The fingerprint is calculated over the DER content, as openssl and
+    keytool do.
+    """
+    body = "".join(pem.strip().splitlines()[1:-1])
+    return hashlib.sha256(base64.b64decode(body)).hexdigest()
+
+
+def iter_certificates(data):
+    """Yields (fingerprint, pem) for each certificate in data.
+
+    data can be a PEM bundle, a DER-encoded certificate (bytes) or an
+    iterable of lines.
+    """
+    if isinstance(data, bytes) and PEM_BEGIN.encode("utf-8") not in data:
+        b64 = base64.b64encode(data).decode("utf-8")
+        pem = "\n".join(
+            [PEM_BEGIN] + [b64[i:i + 64] for i in range(0, len(b64), 64)] +
+            [PEM_END])
+        yield hashlib.sha256(data).hexdigest(), pem
+        return
+    for pem in iter_pem_certificates(data):
+        yield cert_fingerprint(pem), pem
+
+
+def merge_certificates(certs, data):
+    """Adds the certificates of data to certs, a {fingerprint: pem} map.
+
+    Returns the list of fingerprints that were not present in certs.
+    """
+    added = []
+    for fp, pem in iter_certificates(data):
+        if fp not in certs:
+            certs[fp] = pem
+            added.append(fp)
+    return added
+
+
+def index_cert_chains(chains):
+    """Returns a {fingerprint: chain} map of a list of cert chains.
+
+    Each chain is indexed by the fingerprint of its first cert. Empty
+    chains and duplicates are discarded.
+    """
+    result = {}
+    for chain in chains:
+        for fp, _ in iter_certificates(chain):
+            result.setdefault(fp, chain)
+            break
+    return result
+
+
+def _break_crt_chain(buffer):
+    """Breaks the certificate chain string into a list."""
+    return list(iter_pem_certificates(buffer))
 
 
 def saveCrtChainToFile(buffer,
@@ -135,51 +271,210 @@ def setFilePermissions(path, user, group, mode=None):
         os.chmod(path, mode)
 
 
+def _parse_key_algorithm(algorithm):
+    """Returns (family, parameter) of a key algorithm name.
+
+    e.g. "rsa-2048" -> ("rsa", 2048), "ecdsa-p256" -> ("ecdsa", "p256")
+    """
+    if algorithm not in KEY_ALGORITHMS:
+        raise ValueError("Unsupported key algorithm {}, choose one of: "
+                         "{}".format(algorithm, ", ".join(KEY_ALGORITHMS)))
+    family, _, param = algorithm.partition("-")
+    return family, int(param) if family == "rsa" else param
+
+
+def generateKey(algorithm=DEFAULT_KEY_ALGORITHM):
+    """Generates a private key and returns it in PEM (PKCS8) format.
+
+    algorithm: one of KEY_ALGORITHMS
+    """
+    # cryptography is only needed to generate keys and certs
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+    family, param = _parse_key_algorithm(algorithm)
+    if family == "rsa":
+        key = rsa.generate_private_key(public_exponent=65537,
+                                       key_size=param)
+    elif family == "ecdsa":
+        curve = ec.SECP256R1() if param == "p256" else ec.SECP384R1()
+        key = ec.generate_private_key(curve)
+    else:
+        key = ed25519.Ed25519PrivateKey.generate()
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()).decode("utf-8")
+
+
+def key_algorithm_family(pem):
+    """Returns "rsa", "ecdsa" or "ed25519" for a cert or key in PEM format.
+
+    If pem is a chain, the first cert is used. Returns None if the type
+    cannot be found.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+    try:
+        certs = _break_crt_chain(pem)
+        if certs:
+            key = x509.load_pem_x509_certificate(
+                certs[0].encode("utf-8")).public_key()
+        else:
+            key = serialization.load_pem_private_key(
+                pem.encode("utf-8"), password=None)
+    except (ValueError, TypeError):
+        return None
+    if isinstance(key, (rsa.RSAPublicKey, rsa.RSAPrivateKey)):
+        return "rsa"
+    if isinstance(key, (ec.EllipticCurvePublicKey,
+                        ec.EllipticCurvePrivateKey)):
+        return "ecdsa"
+    if isinstance(key, (ed25519.Ed25519PublicKey,
+                        ed25519.Ed25519PrivateKey)):
+        return "ed25519"
+    return None
+
+
+def cipher_suites_for_cert(pem, prefer_chacha20=False):
+    """Returns the TLS cipher suites that can be served with cert pem.
+
+    TLS 1.2 suites depend on the key type of the certificate: restricting
+    the list to the matching ECDHE suites avoids negotiating suites the
+    key cannot be used with. Ed25519 certs use the ECDSA suites on TLS 1.2
+    (RFC 8422). Returns an empty list if the key type is unknown, in which
+    case the JVM defaults should be kept.
+
+    AES-GCM suites come first, as they are the fastest with AES-NI. Set
+    prefer_chacha20 on CPUs without AES instructions, where ChaCha20 is
+    faster.
+    """
+    family = key_algorithm_family(pem)
+    if family is None:
+        return []
+    tls12 = TLS12_CIPHER_SUITES["rsa" if family == "rsa" else "ecdsa"]
+    suites = TLS13_CIPHER_SUITES + tls12
+    if prefer_chacha20:
+        # sorted is stable, so the order is kept within each group
+        suites = sorted(suites, key=lambda c: "CHACHA20" not in c)
+    return suites
+
+
+def _pregenerated_key_folder(folder, algorithm):
+    return os.path.join(folder, PREGENERATED_KEYS_FOLDER, algorithm)
+
+
+def pregenerate_keys(folder, algorithm=DEFAULT_KEY_ALGORITHM,
+                     count=PREGENERATED_KEYS_COUNT):
+    """Fills the pool of private keys under folder up to count keys.
+
+    Key generation, in special RSA, can take seconds of CPU. The pool is
+    meant to be filled outside of the hooks that need the keys, e.g. on
+    install and update-status, and consumed with pop_pregenerated_key.
+
+    Returns the number of keys generated.
+    """
+    path = _pregenerated_key_folder(folder, algorithm)
+    os.makedirs(path, 0o700, exist_ok=True)
+    available = [f for f in os.listdir(path) if f.endswith(".key")]
+    generated = 0
+    for _ in range(count - len(available)):
+        _atomic_write(
+            os.path.join(path, genRandomPassword(12) + ".key"),
+            generateKey(algorithm).encode("utf-8"), mode=0o600)
+        generated += 1
+    return generated
+
+
+def pop_pregenerated_key(folder, algorithm=DEFAULT_KEY_ALGORITHM):
+    """Removes a key from the pool and returns it in PEM format.
+
+    Returns None if the pool is empty.
+    """
+    path = _pregenerated_key_folder(folder, algorithm)
+    try:
+        available = sorted(f for f in os.listdir(path) if f.endswith(".key"))
+    except OSError:
+        return None
+    for f in available:
+        keyfile = os.path.join(path, f)
+        try:
+            with open(keyfile) as k:
+                key = k.read()
+            os.remove(keyfile)
+        except OSError:
+            continue
+        if key:
+            return key
+    return None
+
+
 def generateSelfSigned(folderpath=None,
                        certname=None,
                        keysize=4096,
                        cn="*.maas",
                        user=None,
                        group=None,
-                       mode=None):
-    key = crypto.PKey()
-    key.generate_key(crypto.TYPE_RSA, keysize)
-    cert = crypto.X509()
-    serNum = 0
-    valSecs = 10*365*24*60*60
-    x509name = crypto.X509Name(crypto.X509().get_subject())
-    x509name.countryName = "UK"
-    x509name.stateOrProvinceName = "London"
-    x509name.organizationName = "TestWandUbuntu"
-    x509name.organizationalUnitName = "WandLib"
-    x509name.commonName = cn or "*.example.com"
-    cert.set_subject(x509name)
-    cert.set_serial_number(serNum)
-    cert.gmtime_adj_notBefore(0)
-    cert.gmtime_adj_notAfter(valSecs)
-    cert.set_pubkey(key)
-    issuerName = crypto.X509Name(x509name)
-    cert.set_issuer(issuerName)
-    cert.sign(key, 'sha512')
+                       mode=None,
+                       key_algorithm=None,
+                       key=None):
+    """Generates a self-signed cert and saves it as <certname>.crt/.key.
+
+    key_algorithm: one of KEY_ALGORITHMS. Defaults to RSA with keysize bits.
+    key: optional, private key in PEM format to be used instead of a new
+         one, e.g. from pop_pregenerated_key.
+
+    Returns the cert and key in PEM format.
+    """
+    # cryptography is only needed to generate self-signed certs
+    import datetime
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    algorithm = key_algorithm or "rsa-{}".format(keysize)
+    family, param = _parse_key_algorithm(algorithm)
+    key = key or generateKey(algorithm)
+    pkey = serialization.load_pem_private_key(
+        key.encode("utf-8"), password=None)
+    if family == "ed25519":
+        # Ed25519 signatures do not take a separate hash
+        digest = None
+    elif family == "ecdsa" and param == "p256":
+        digest = hashes.SHA256()
+    elif family == "ecdsa":
+        digest = hashes.SHA384()
+    else:
+        digest = hashes.SHA512()
+    name = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "UK"),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "London"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "TestWandUbuntu"),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "WandLib"),
+        x509.NameAttribute(NameOID.COMMON_NAME, cn or "*.example.com"),
+    ])
+    # RFC 5280 requires a positive serial number, up to 20 bytes long
+    serNum = int.from_bytes(os.urandom(16), "big") | 1
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name). \
+        issuer_name(name). \
+        public_key(pkey.public_key()). \
+        serial_number(serNum). \
+        not_valid_before(now). \
+        not_valid_after(now + datetime.timedelta(days=10*365)). \
+        sign(pkey, digest)
+    crt = cert.public_bytes(serialization.Encoding.PEM).decode("utf-8")
     cname = certname or genRandomPassword(6)
     folder = folderpath or "/tmp"
     with open(os.path.join(folder, cname + ".crt"), "w") as f:
-        f.write(crypto.dump_certificate(
-            crypto.FILETYPE_PEM, cert).decode("utf-8"))
-        f.close()
+        f.write(crt)
     with open(os.path.join(folder, cname + ".key"), "w") as f:
-        f.write(crypto.dump_privatekey(
-            crypto.FILETYPE_PEM, key).decode("utf-8"))
-        f.close()
+        f.write(key)
     if user and group:
         setFilePermissions(os.path.join(folder, cname + ".crt"),
                            user, group, mode)
         setFilePermissions(os.path.join(folder, cname + ".key"),
                            user, group, mode)
-    return (crypto.dump_certificate(
-               crypto.FILETYPE_PEM, cert).decode("utf-8"),
-            crypto.dump_privatekey(
-                crypto.FILETYPE_PEM, key).decode("utf-8"))
+    return (crt, key)
 
 
 def SetTrustAndKeystoreFilePermissions(user, group,
@@ -203,6 +498,134 @@ def SetCertAndKeyFilePermissions(user, group,
     os.chmod(key_path, 0o640)
 
 
+def _sha256(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def _load_store_cache():
+    global _store_cache
+    if _store_cache is not None:
+        return _store_cache
+    _store_cache = {}
+    path = charmhelper.unit_state_path(STORE_CACHE_FILE)
+    if path and os.path.exists(path):
+        try:
+            with open(path) as f:
+                _store_cache = json.load(f)
+        except (OSError, ValueError):
+            # Corrupted cache, start over
+            _store_cache = {}
+    return _store_cache
+
+
+def _save_store_cache():
+    path = charmhelper.unit_state_path(STORE_CACHE_FILE)
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(_store_cache, f)
+    os.rename(path + ".tmp", path)
+
+
+def _store_key(store_type, pwd, fingerprints):
+    """Returns the content address of a store.
+
+    The address is the digest of the store type, the password and the
+    sorted fingerprints of all the certs and keys that compose the store.
+    """
+    return _sha256(json.dumps({
+        "type": store_type,
+        "pwd": _sha256(pwd),
+        "inputs": sorted(fingerprints)
+    }, sort_keys=True))
+
+
+def _store_is_current(path, key):
+    """Returns True if path was generated from the same inputs.
+
+    The file must still exist and be the same as the one generated, so
+    stores removed or changed by someone else are rebuilt.
+    """
+    entry = _load_store_cache().get(path)
+    if not entry or entry.get("key") != key:
+        return False
+    try:
+        with open(path, "rb") as f:
+            return _sha256(f.read()) == entry.get("sha256")
+    except OSError:
+        return False
+
+
+def _store_save(path, key, content):
+    _load_store_cache()[path] = {"key": key, "sha256": _sha256(content)}
+    _save_store_cache()
+
+
+def invalidate_store_cache(path=None):
+    """Forces the store at path (or all, if path is None) to be rebuilt."""
+    cache = _load_store_cache()
+    if path:
+        cache.pop(path, None)
+    else:
+        cache.clear()
+    _save_store_cache()
+
+
+def _atomic_write(path, content, user=None, group=None, mode=None):
+    """Writes content to a temporary file then renames it over path.
+
+    Permissions are set on the temporary file, so path never shows up with
+    the wrong ownership or mode.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=".{}.".format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            os.fchmod(f.fileno(), 0o600)
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if user and group:
+            setFilePermissions(tmp_path, user, group, mode)
+        elif mode:
+            os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _load_pem_certs(chain):
+    """Loads all the certificates of a PEM chain as x509 objects."""
+    # cryptography is only needed when building the stores
+    from cryptography import x509
+    return [x509.load_pem_x509_certificate(c.encode("utf-8"))
+            for c in _break_crt_chain(chain)]
+
+
+def _pkcs12_encryption(pwd):
+    """Returns the encryption used on PKCS12 stores.
+
+    Uses SHA1 MAC and 3DES for keys and certs, as those algorithms are
+    understood by every JDK version, including Java 8 prior to 8u301.
+    """
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.serialization import pkcs12
+    try:
+        return serialization.PrivateFormat.PKCS12.encryption_builder(). \
+            kdf_rounds(50000). \
+            key_cert_algorithm(pkcs12.PBES.PBESv1SHA1And3KeyTripleDESCBC). \
+            hmac_hash(hashes.SHA1()).build(pwd.encode("utf-8"))
+    except AttributeError:
+        # cryptography < 38 only supports the default algorithms
+        return serialization.BestAvailableEncryption(pwd.encode("utf-8"))
+
+
 def PKCS12CreateKeystore(keystore_path,
                          keystore_pwd,
                          ssl_chain,
@@ -210,50 +633,99 @@ def PKCS12CreateKeystore(keystore_path,
                          user=None,
                          group=None,
                          mode=None,
-                         openssl_chain_path="/tmp/ks-charm-cert.chain",
-                         openssl_key_path="/tmp/ks-charm.key",
-                         openssl_p12_path="/tmp/ks-charm.p12",
-                         ks_regenerate=False):
-
-    # We've saved the key and cert to /tmp, we cannot leave it there
-    # clean it up:
-    def __cleanup():
-        for i in [openssl_chain_path, openssl_key_path, openssl_p12_path]:
-            try:
-                os.remove(i)
-            except Exception:
-                pass
-    if ks_regenerate:
-        try:
-            os.remove(keystore_path)
-        except Exception:
-            pass
+                         openssl_chain_path=None,
+                         openssl_key_path=None,
+                         openssl_p12_path=None,
+                         ks_regenerate=False,
+                         alias="localhost"):
+    """Creates a PKCS12 keystore with the cert chain and its private key.
+
+    The keystore is generated in memory and written atomically: neither the
+    key nor the intermediate files are saved to disk. The key entry is
+    protected with the keystore password, as keytool would do.
+
+    keystore_path: str, path to the keystore in the unit
+    keystore_pwd: str, password for the keystore and the key entry
+    ssl_chain: str, PEM cert chain, the first cert is the unit's
+    ssl_key: str, PEM private key of the first cert in ssl_chain
+    user, group, mode: set permissions for keystore file
+    ks_regenerate: kept for compatibility, the keystore is rebuilt
+                   whenever its inputs change
+    alias: name of the key entry
+    openssl_*_path: kept for compatibility, not used anymore
+
+    Returns True if the keystore was rebuilt, False if the existing file
+    was generated with the same inputs and reused.
+    """
+    key_addr = _store_key(
+        "keystore", keystore_pwd,
+        ["alias:" + alias, "chain:" + _sha256(ssl_chain),
+         "key:" + _sha256(ssl_key)])
+    if _store_is_current(keystore_path, key_addr):
+        logger.debug("Keystore {} is up-to-date".format(keystore_path))
+        return False
+
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization import pkcs12
+
+    certs = _load_pem_certs(ssl_chain)
+    if not certs:
+        raise Exception("No certificate found in the cert chain")
+    key = serialization.load_pem_private_key(
+        ssl_key.encode("utf-8"), password=None)
+    content = pkcs12.serialize_key_and_certificates(
+        alias.encode("utf-8"), key, certs[0], certs[1:] or None,
+        _pkcs12_encryption(keystore_pwd))
+    _atomic_write(keystore_path, content, user, group, mode)
+    _store_save(keystore_path, key_addr, content)
+    return True
+
+
+def _truststore_cas(ts_certs, extra_cas=None):
+    """Returns {fingerprint: x509 cert} of the unique CAs to be trusted.
+
+    For each cert chain in ts_certs, only the CAs are considered. If the
+    chain is composed of a single (self-signed) cert, then that cert is
+    trusted instead. All the certs in extra_cas are trusted.
+    Duplicates are removed based on the cert fingerprint, keeping the order
+    in which the certs were found.
+    """
+    from cryptography import x509
+    pems = {}
+    for c in ts_certs or []:
+        certs = list(iter_certificates(c))
+        for fp, pem in (certs[1:] if len(certs) > 1 else certs):
+            pems.setdefault(fp, pem)
+    for c in extra_cas or []:
+        merge_certificates(pems, c)
+    # Only the unique certs are parsed
+    return {fp: x509.load_pem_x509_certificate(pem.encode("utf-8"))
+            for fp, pem in pems.items()}
+
+
+def _keytool_create_truststore(ts_path, ts_pwd, cas):
+    """Creates the truststore with one keytool call per CA.
+
+    Used if the cryptography version available cannot generate Java
+    truststores (i.e. < 45).
+    """
+    from cryptography.hazmat.primitives import serialization
+    tmpdir = tempfile.mkdtemp()
+    tmp_ts = os.path.join(tmpdir, "truststore.p12")
     try:
-        with open(openssl_chain_path, "w") as f:
-            f.write(ssl_chain)
-            f.close()
-        with open(openssl_key_path, "w") as f:
-            f.write(ssl_key)
-            f.close()
-        pk12_cmd = ['openssl', 'pkcs12', '-export', '-in',
-                    openssl_chain_path,
-                    "-inkey", openssl_key_path,
-                    "-out", openssl_p12_path,
-                    "-name", "localhost", "-passout",
-                    "pass:{}".format(keystore_pwd)]
-        subprocess.check_call(pk12_cmd)
-        ks_cmd = ["keytool", "-importkeystore", "-srckeystore",
-                  openssl_p12_path, "-srcstoretype",
-                  "pkcs12", "-srcstorepass", keystore_pwd,
-                  "-destkeystore", keystore_path, "-deststoretype", "pkcs12",
-                  "-deststorepass", keystore_pwd, "-destkeypass", keystore_pwd]
-        subprocess.check_call(ks_cmd)
-        setFilePermissions(keystore_path, user, group, mode)
-    except Exception as e:
-        __cleanup()
-        raise e
-    # We clean up intermediate keys and certs for p12 anyway
-    __cleanup()
+        for alias, crt in cas.items():
+            crtpath = os.path.join(tmpdir, alias + ".crt")
+            with open(crtpath, "wb") as f:
+                f.write(crt.public_bytes(serialization.Encoding.PEM))
+            subprocess.check_call(
+                ["keytool", "-noprompt", "-keystore", tmp_ts,
+                 "-storetype", "pkcs12", "-alias", "ca." + alias[:16],
+                 "-trustcacerts", "-import", "-file", crtpath,
+                 "-deststorepass", ts_pwd])
+        with open(tmp_ts, "rb") as f:
+            return f.read()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
 
 def CreateTruststore(ts_path,
@@ -270,47 +742,53 @@ def CreateTruststore(ts_path,
     the Truststore will not have one crt chain per node, but only the
     common list of trusted CAs.
 
+    All the CAs are parsed and deduplicated, then the PKCS12 truststore is
+    generated in-process in a single pass and written atomically. Each CA
+    is stored with an alias derived from its fingerprint.
+
     ts_path: str, path to the truststore in the unit
     ts_pwd: str, password for the truststore
     ts_certs: list, contains all the certs (str) to be added
-    ts_regenerate: bool, if True, it will rewrite the truststore file
+    ts_regenerate: bool, if False, keeps the CAs already present in
+                   the truststore file
     user, group, mode: set permissions for truststore file
     extra_cas: list of extra cas to be added
+
+    Returns True if the truststore was rebuilt, False if the existing file
+    was generated with the same CAs and reused.
     """
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.serialization import pkcs12
+
+    new_cas = _truststore_cas(ts_certs, extra_cas)
+    key_addr = _store_key(
+        "truststore" if ts_regenerate else "truststore-append",
+        ts_pwd, new_cas.keys())
+    if _store_is_current(ts_path, key_addr):
+        logger.debug("Truststore {} is up-to-date".format(ts_path))
+        return False
 
-    crtpath = "/tmp/juju_ca_cert"
-    if ts_regenerate:
-        try:
-            os.remove(ts_path)
-        except Exception:
-            pass
-
-    def _add_cert_to_ts(ts_path, host_rand, counter, crtpath, ts_pwd):
-        # ZK doc: alias must change per cert added
-        ts_cmd = ["keytool", "-noprompt", "-keystore", ts_path,
-                  "-storetype", "pkcs12", "-alias",
-                  "host.{}.{}".format(host_rand, counter),
-                  "-trustcacerts", "-import", "-file", crtpath,
-                  "-deststorepass", ts_pwd]
-        subprocess.check_call(ts_cmd)
-
-    # small random string to act as prefix for the certs' alias
-    host_rand = genRandomPassword(6)
-    counter = 0
-    for c in ts_certs:
-        with open(crtpath, "w") as f:
-            ca, _ = get_ca_and_cert(c)
-            f.write(ca)
-            f.close()
-        _add_cert_to_ts(ts_path, host_rand, counter, crtpath, ts_pwd)
-        counter += 1
-    # Now, add the CAs that are only CAs passed via extra_cas
-    for c in (extra_cas or []):
-        with open(crtpath, "w") as f:
-            f.write(c)
-            f.close()
-        _add_cert_to_ts(ts_path, host_rand, counter, crtpath, ts_pwd)
-        counter += 1
-    # Update permissions
-    setFilePermissions(ts_path, user, group, mode)
-    os.remove(crtpath)
+    cas = {}
+    if not ts_regenerate and _check_file_exists(ts_path):
+        # Keep the CAs already trusted
+        with open(ts_path, "rb") as f:
+            existing = pkcs12.load_pkcs12(f.read(), ts_pwd.encode("utf-8"))
+        for c in existing.additional_certs:
+            cas.setdefault(
+                c.certificate.fingerprint(hashes.SHA256()).hex(),
+                c.certificate)
+    for fp, crt in new_cas.items():
+        cas.setdefault(fp, crt)
+    if not cas:
+        raise Exception("No CA certificates found for {}".format(ts_path))
+
+    if hasattr(pkcs12, "serialize_java_truststore"):
+        content = pkcs12.serialize_java_truststore(
+            [pkcs12.PKCS12Certificate(crt, ("ca." + fp[:16]).encode("utf-8"))
+             for fp, crt in cas.items()],
+            _pkcs12_encryption(ts_pwd))
+    else:
+        content = _keytool_create_truststore(ts_path, ts_pwd, cas)
+    _atomic_write(ts_path, content, user, group, mode)
+    _store_save(ts_path, key_addr, content)
+    return True
@@ -0,0 +1,207 @@
+"""
+
+Implements a TLS benchmark of the broker listeners.
+
+Measures, per listener, the rate and latency of full TLS handshakes and the
+throughput of the cipher negotiated, as seen by a client offering:
+
+    - "default": TLS 1.2 and the OpenSSL default cipher list, i.e. what an
+      older client negotiates with the broker.
+    - "profile": the protocols and cipher suites of the TLS performance
+      profile, TLS 1.3 first.
+
+The broker still has the last word on what is negotiated: run it with and
+without the tls-performance-profile option to compare both sides.
+
+The cipher throughput is measured locally, encrypting a buffer with the
+AEAD algorithm of the negotiated cipher. That is the per-byte cost the
+broker pays once the handshake is done.
+
+How to use:
+
+    results = benchmark_listener("broker-0.maas", 9093, count=50)
+    for name, r in results.items():
+        print(name, r["handshakes_per_sec"], r["cipher"])
+
+"""
+
+import os
+import ssl
+import time
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "client_context",
+    "handshake_benchmark",
+    "cipher_throughput",
+    "benchmark_listener",
+    "openssl_cipher_names"
+]
+
+DEFAULT_HANDSHAKES = 50
+THROUGHPUT_BUFFER_SIZE = 16 * 1024
+THROUGHPUT_TOTAL_SIZE = 64 * 1024 * 1024
+
+# IANA (Java) to OpenSSL (Python ssl) names of the TLS 1.2 suites
+OPENSSL_CIPHER_NAMES = {
+    "TLS_ECDHE_ECDSA_WITH_AES_128_GCM_SHA256":
+        "ECDHE-ECDSA-AES128-GCM-SHA256",
+    "TLS_ECDHE_ECDSA_WITH_AES_256_GCM_SHA384":
+        "ECDHE-ECDSA-AES256-GCM-SHA384",
+    "TLS_ECDHE_ECDSA_WITH_CHACHA20_POLY1305_SHA256":
+        "ECDHE-ECDSA-CHACHA20-POLY1305",
+    "TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256":
+        "ECDHE-RSA-AES128-GCM-SHA256",
+    "TLS_ECDHE_RSA_WITH_AES_256_GCM_SHA384":
+        "ECDHE-RSA-AES256-GCM-SHA384",
+    "TLS_ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256":
+        "ECDHE-RSA-CHACHA20-POLY1305",
+}
+
+_TLS_VERSIONS = {
+    "TLSv1.2": ssl.TLSVersion.TLSv1_2,
+    "TLSv1.3": ssl.TLSVersion.TLSv1_3,
+}
+
+
+def openssl_cipher_names(suites):
+    """Converts a list of IANA cipher suite names to an OpenSSL cipher list.
+
+    TLS 1.3 suites are skipped, as Python's ssl does not allow choosing
+    them. Returns None if no suite could be converted.
+    """
+    names = [OPENSSL_CIPHER_NAMES[s] for s in suites or []
+             if s in OPENSSL_CIPHER_NAMES]
+    return ":".join(names) if names else None
+
+
+def client_context(protocols=None, suites=None, certfile=None, keyfile=None):
+    """Returns a client SSLContext for the benchmark.
+
+    The broker certificate is not verified, as only the TLS cost matters.
+
+    protocols: optional, list of protocols, e.g. ["TLSv1.3", "TLSv1.2"]
+    suites: optional, list of cipher suites with IANA names
+    certfile, keyfile: optional, client cert for listeners with mTLS
+    """
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    # Session tickets would turn the handshakes into resumptions
+    ctx.options |= ssl.OP_NO_TICKET
+    if protocols:
+        versions = [_TLS_VERSIONS[p] for p in protocols
+                    if p in _TLS_VERSIONS]
+        if versions:
+            ctx.minimum_version = min(versions)
+            ctx.maximum_version = max(versions)
+    ciphers = openssl_cipher_names(suites)
+    if ciphers:
+        ctx.set_ciphers(ciphers)
+    if certfile:
+        ctx.load_cert_chain(certfile, keyfile)
+    return ctx
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))]
+
+
+def handshake_benchmark(host, port, context,
+                        count=DEFAULT_HANDSHAKES, timeout=5):
+    """Runs count full handshakes against host:port, one after the other.
+
+    Returns a dict with the handshake rate, the p50/p95 latency in ms, the
+    number of failures and the protocol and cipher negotiated.
+    """
+    latencies = []
+    failures = 0
+    protocol, cipher = None, None
+    start = time.monotonic()
+    for _ in range(count):
+        t = time.monotonic()
+        try:
+            with socket.create_connection(
+                    (host, int(port)), timeout=timeout) as s:
+                with context.wrap_socket(s, server_hostname=host) as tls:
+                    latencies.append(time.monotonic() - t)
+                    protocol = tls.version()
+                    cipher = tls.cipher()[0]
+        except (OSError, ssl.SSLError) as e:
+            failures += 1
+            logger.debug("Handshake with {}:{} failed: {}".format(
+                host, port, str(e)))
+    elapsed = time.monotonic() - start
+    return {
+        "handshakes": len(latencies),
+        "failures": failures,
+        "handshakes_per_sec": round(len(latencies) / elapsed, 2)
+        if elapsed > 0 else 0.0,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+        "protocol": protocol,
+        "cipher": cipher,
+    }
+
+
+def cipher_throughput(cipher, total=THROUGHPUT_TOTAL_SIZE,
+                      buffer_size=THROUGHPUT_BUFFER_SIZE):
+    """Returns the encryption throughput, in MB/s, of the AEAD of cipher.
+
+    cipher: OpenSSL or IANA name of the cipher, as returned by
+            SSLSocket.cipher()
+    Returns None if the cipher is not AES-GCM or ChaCha20-Poly1305.
+    """
+    # cryptography is only needed by the benchmark
+    from cryptography.hazmat.primitives.ciphers.aead import (
+        AESGCM,
+        ChaCha20Poly1305
+    )
+    name = (cipher or "").upper().replace("_", "-")
+    if "CHACHA20" in name:
+        aead = ChaCha20Poly1305(ChaCha20Poly1305.generate_key())
+    elif "AES-128-GCM" in name or "AES128-GCM" in name:
+        aead = AESGCM(AESGCM.generate_key(bit_length=128))
+    elif "AES-256-GCM" in name or "AES256-GCM" in name:
+        aead = AESGCM(AESGCM.generate_key(bit_length=256))
+    else:
+        return None
+    data = os.urandom(buffer_size)
+    nonce = os.urandom(12)
+    rounds = max(1, total // buffer_size)
+    start = time.monotonic()
+    for _ in range(rounds):
+        aead.encrypt(nonce, data, None)
+    elapsed = time.monotonic() - start
+    if elapsed <= 0:
+        return None
+    return round(rounds * buffer_size / elapsed / (1024 * 1024), 2)
+
+
+def benchmark_listener(host, port, count=DEFAULT_HANDSHAKES,
+                       profile_protocols=None, profile_suites=None,
+                       certfile=None, keyfile=None):
+    """Compares the default client settings against the TLS profile.
+
+    Returns {"default": results, "profile": results}, where results is
+    the output of handshake_benchmark plus the "throughput_mbps" of the
+    negotiated cipher.
+    """
+    contexts = {
+        "default": client_context(["TLSv1.2"],
+                                  certfile=certfile, keyfile=keyfile),
+        "profile": client_context(profile_protocols, profile_suites,
+                                  certfile=certfile, keyfile=keyfile),
+    }
+    results = {}
+    for name, ctx in contexts.items():
+        r = handshake_benchmark(host, port, ctx, count=count)
+        r["throughput_mbps"] = cipher_throughput(r["cipher"])
+        results[name] = r
+    return results
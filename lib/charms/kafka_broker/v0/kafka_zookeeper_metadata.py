@@ -0,0 +1,159 @@
+"""
+
+Implements reading the cluster metadata the brokers register on ZooKeeper.
+
+Each broker registers itself on /brokers/ids/<broker id>, e.g.:
+
+    {"listener_security_protocol_map": {"BROKER": "SSL", ...},
+     "endpoints": ["BROKER://broker-0.maas:9092", ...],
+     "rack": "rack-1", "jmx_port": -1, "host": null, "version": 5, ...}
+
+The registration is updated once the broker applies a dynamic listener
+change. Reading it confirms the broker advertises the new listeners, with
+no need for the credentials of those listeners.
+
+The active controller registers itself on /controller and each controller
+election increments /controller_epoch.
+
+How to use:
+
+    cmd = zookeeper_shell_command(distro)
+    endpoints = broker_endpoints(
+        "zk-0.maas:2182", 1001, cmd=cmd,
+        zk_client_config="/etc/kafka/zookeeper-tls-client.properties")
+    if wait_for_advertised_listeners(
+            lambda: broker_endpoints("zk-0.maas:2182", 1001, cmd=cmd),
+            added=["external"], removed=[]):
+        ...
+    broker_id, epoch = active_controller("zk-0.maas:2182", cmd=cmd)
+
+"""
+
+import json
+import time
+import logging
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "KafkaZookeeperMetadataError",
+    "zookeeper_shell_command",
+    "zk_get",
+    "broker_endpoints",
+    "endpoint_listener_names",
+    "wait_for_advertised_listeners",
+    "active_controller"
+]
+
+# Time to wait for the broker to register its new listeners
+LISTENER_VERIFY_TIMEOUT = 60
+LISTENER_VERIFY_INTERVAL = 5
+
+
+class KafkaZookeeperMetadataError(Exception):
+
+    def __init__(self,
+                 message="Failed to read the metadata from ZooKeeper"):
+        super().__init__(message)
+
+
+def zookeeper_shell_command(distro):
+    """Returns the zookeeper-shell command for a given distro."""
+    if distro == "apache_snap":
+        return "kafka.zookeeper-shell"
+    if distro == "apache":
+        return "/opt/kafka/bin/zookeeper-shell.sh"
+    return "zookeeper-shell"
+
+
+def zk_get(connect, path, zk_client_config=None, cmd="zookeeper-shell"):
+    """Returns the JSON content of a znode, or None if it does not exist.
+
+    Znodes holding a number, e.g. /controller_epoch, return an int.
+
+    connect: zookeeper.connect of the broker
+    zk_client_config: optional, ZooKeeper client properties, e.g. for TLS
+
+    Raises KafkaZookeeperMetadataError if zookeeper-shell fails.
+    """
+    args = [cmd, connect]
+    if zk_client_config:
+        args.extend(["-zk-tls-config-file", zk_client_config])
+    args.extend(["get", path])
+    try:
+        output = subprocess.check_output(
+            args, stderr=subprocess.STDOUT).decode("utf-8", errors="replace")
+    except (OSError, subprocess.CalledProcessError) as e:
+        output = getattr(e, "output", None) or b""
+        raise KafkaZookeeperMetadataError(
+            "zookeeper-shell failed: {} {}".format(
+                str(e), output.decode("utf-8", errors="replace")))
+    # zookeeper-shell logs the connection before the content of the znode
+    for line in output.split("\n"):
+        line = line.strip()
+        if line.startswith("{") or line.isdigit():
+            try:
+                return json.loads(line)
+            except ValueError:
+                continue
+        if line.startswith("Node does not exist"):
+            return None
+    return None
+
+
+def broker_endpoints(connect, broker_id, zk_client_config=None,
+                     cmd="zookeeper-shell"):
+    """Returns the endpoints registered by broker_id, or [] if none."""
+    data = zk_get(connect, "/brokers/ids/{}".format(broker_id),
+                  zk_client_config=zk_client_config, cmd=cmd)
+    return (data or {}).get("endpoints", [])
+
+
+def endpoint_listener_names(endpoints):
+    """Returns the lowercase listener names of a list of endpoints."""
+    return set(e.partition("://")[0].lower() for e in endpoints or []
+               if "://" in e)
+
+
+def wait_for_advertised_listeners(source, added, removed,
+                                  timeout=LISTENER_VERIFY_TIMEOUT,
+                                  interval=LISTENER_VERIFY_INTERVAL):
+    """Waits until the broker advertises the added listeners and stopped
+    advertising the removed ones.
+
+    source: callable returning the endpoints registered by the broker
+    added, removed: lists of listener names
+
+    Returns True once the listeners match, False on timeout.
+    """
+    added = set(n.lower() for n in added or [])
+    removed = set(n.lower() for n in removed or [])
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            names = endpoint_listener_names(source())
+            if added <= names and not (removed & names):
+                return True
+            logger.debug("Broker advertises {}, waiting for {} and not "
+                         "{}".format(sorted(names), sorted(added),
+                                     sorted(removed)))
+        except KafkaZookeeperMetadataError as e:
+            logger.debug(str(e))
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+
+
+def active_controller(connect, zk_client_config=None, cmd="zookeeper-shell"):
+    """Returns (broker id, controller epoch) of the active controller.
+
+    Each value is None if not found, e.g. during a controller election.
+    """
+    data = zk_get(connect, "/controller",
+                  zk_client_config=zk_client_config, cmd=cmd)
+    epoch = zk_get(connect, "/controller_epoch",
+                   zk_client_config=zk_client_config, cmd=cmd)
+    broker_id = (data or {}).get("brokerid", None)
+    return (str(broker_id) if broker_id is not None else None,
+            epoch if isinstance(epoch, int) else None)
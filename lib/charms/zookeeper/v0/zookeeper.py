@@ -72,7 +72,9 @@ class ZookeeperRelation(KafkaRelationBase):
             if len(r.data[u]["endpoint"]) == 0:
                 continue
             zk_list.append(r.data[u]["endpoint"])
-        self.state.zk_list = ",".join(zk_list)
+        # Units come in no particular order: sort them, so the connection
+        # string only changes if the ensemble does
+        self.state.zk_list = ",".join(sorted(zk_list))
         self._get_all_tls_cert()
 
 
@@ -6,7 +6,12 @@ import logging
 import os
 import yaml
 import json
+import glob
+import shutil
+import contextlib
 import hashlib
+import tempfile
+import time
 
 from ops.main import main
 from ops.model import (
@@ -35,20 +40,27 @@ from charms.kafka_broker.v0.kafka_relation_base import (
     KafkaRelationBaseTLSNotSetError
 )
 
-import interface_tls_certificates.ca_client as ca_client
 
 from charms.kafka_broker.v0.charmhelper import (
     open_port,
     render,
-    get_address_in_network
+    write_file,
+    file_changed,
+    get_changed_files,
+    reset_changed_files,
+    unit_state_path
 )
 
 from charms.kafka_broker.v0.kafka_security import (
-    setFilePermissions,
     genRandomPassword,
     generateSelfSigned,
+    pregenerate_keys,
+    pop_pregenerated_key,
+    cipher_suites_for_cert,
+    TLS_PERFORMANCE_PROTOCOLS,
     PKCS12CreateKeystore,
-    CreateTruststore
+    CreateTruststore,
+    get_ca_and_cert
 )
 from charms.kafka_broker.v0.kafka_listener import (
     KafkaListenerProvidesRelation,
@@ -63,7 +75,62 @@ from ops_coordinator.ops_coordinator import (
 )
 
 from charms.kafka_broker.v0.kafka_storage_manager import StorageManager, StorageManagerError
-from charms.kafka_broker.v0.kafka_linux import get_hostname
+from charms.kafka_broker.v0.kafka_linux import (
+    get_hostname,
+    invalidate_hostname_cache,
+    has_aes_ni
+)
+from charms.kafka_broker.v0.kafka_reconciler import (
+    ArtifactReconciler,
+    fingerprint
+)
+from charms.kafka_broker.v0.kafka_network import NetworkSnapshot
+from charms.kafka_broker.v0.kafka_dynamic_config import (
+    CLUSTER_WIDE,
+    LISTENERS,
+    PER_BROKER,
+    READ_ONLY,
+    KafkaDynamicConfigError,
+    alter_broker_configs,
+    classify_changes,
+    kafka_configs_command,
+    listener_changes,
+    read_broker_id,
+    versioned_store_path,
+    wait_for_certificate
+)
+from charms.kafka_broker.v0.kafka_relation_snapshot import RelationSnapshot
+from charms.kafka_broker.v0.kafka_zookeeper_metadata import (
+    KafkaZookeeperMetadataError,
+    active_controller,
+    broker_endpoints,
+    wait_for_advertised_listeners,
+    zookeeper_shell_command
+)
+from charms.kafka_broker.v0.kafka_tls_benchmark import (
+    benchmark_listener,
+    client_context
+)
+from charms.kafka_broker.v0.kafka_restart_scheduler import (
+    CONTROLLER_YIELD_TIMEOUT,
+    KafkaTopicsError,
+    RackRestartScheduler,
+    SCHEDULER_KEYS,
+    describe_partitions,
+    kafka_topics_command,
+    partitions_span_racks
+)
+from charms.kafka_broker.v0.kafka_metrics import (
+    ACTIVE_CONTROLLER_COUNT,
+    UNDER_REPLICATED_PARTITIONS,
+    HEALTH_STABLE_CHECKS,
+    scrape_metrics,
+    check_broker_health
+)
+from charms.kafka_broker.v0.kafka_profiler import (
+    HookProfiler,
+    profiled
+)
 logger = logging.getLogger(__name__)
 
 # Given: https://docs.confluent.io/current/ \
@@ -84,6 +151,65 @@ CONFLUENT_PACKAGES = [
   "confluent-security",
 ]
 
+# Inputs of each of the artifacts rendered on config-changed.
+# If none of the inputs below change, the artifact is not rendered again.
+# Check _on_config_changed for the full list of inputs per artifact.
+KERBEROS_CONFIG_INPUTS = [
+    "kerberos-protocol",
+    "kerberos-realm",
+    "kerberos-domain",
+    "kerberos-kdc-hostname",
+    "kerberos-admin-hostname",
+    "filepath-jaas-conf",
+    "user",
+    "group"
+]
+
+CLIENT_PROPERTIES_CONFIG_INPUTS = [
+    "client-properties",
+    "filepath-kafka-client-properties",
+    "truststore-path",
+    "sasl-kbros-service",
+    "user",
+    "group"
+] + KERBEROS_CONFIG_INPUTS
+
+SERVICE_OVERRIDE_CONFIG_INPUTS = [
+    "service-unit-overrides",
+    "service-overrides",
+    "service-environment-overrides",
+    "jmx-exporter-port",
+    "sasl-protocol",
+    "tls-performance-profile",
+    "tls-session-cache-size",
+    "distro",
+    "user",
+    "group"
+] + KERBEROS_CONFIG_INPUTS
+
+LOG4J_CONFIG_INPUTS = [
+    "log4j-root-logger",
+    "filepath-log4j-properties",
+    "distro",
+    "user",
+    "group"
+]
+
+# server.properties depends on virtually every option, therefore it
+# uses the entire config as input plus the relations below.
+SERVER_PROPERTIES_RELATION_INPUTS = [
+    "cluster",
+    "zookeeper",
+    "listeners",
+    "mds",
+    "certificates"
+]
+
+# Relations whose databags are loaded at once on first read
+SNAPSHOT_RELATIONS = SERVER_PROPERTIES_RELATION_INPUTS + [
+    "prometheus-manual"
+]
+
 
 class KafkaBrokerCharmMDSNotSupportedError(Exception):
     """Exception raised when MDS relation is but distro is not confluent."""
@@ -108,11 +234,24 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
     def __init__(self, *args):
         """Initialize kafka charm."""
         super().__init__(*args)
-        self.certificates = ca_client.CAClient(
-            self,
-            'certificates')
+        # Bindings and interface addresses, collected once per dispatch
+        self.network = NetworkSnapshot(self)
+        self._extra_binding_memo = {}
+        # Relation databags, loaded once per dispatch. Writes are flushed
+        # on framework commit.
+        self.relation_data = RelationSnapshot(self, SNAPSHOT_RELATIONS)
+        # Profiles the stages of each hook, saved on framework commit
+        self.profiler = HookProfiler(unit_state_path("hook-profile.json"))
+        self.framework.observe(self.framework.on.commit,
+                               self._on_framework_commit)
+        # Handlers only mark the charm as dirty, config-changed logic runs
+        # once, right before the framework commits its state.
+        self._dirty_event = None
+        self.framework.observe(self.framework.on.pre_commit,
+                               self._on_pre_commit)
         self.framework.observe(self.on.install, self._on_install)
-        self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.config_changed, self._mark_dirty)
+        self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
         self.framework.observe(self.on.cluster_relation_joined,
                                self._on_cluster_relation_joined)
         self.framework.observe(self.on.cluster_relation_changed,
@@ -121,10 +260,18 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                                self._on_zookeeper_relation_joined)
         self.framework.observe(self.on.zookeeper_relation_changed,
                                self._on_zookeeper_relation_changed)
-        self.framework.observe(self.certificates.on.ca_available,
-                               self.on_certificates_relation_joined)
-        self.framework.observe(self.certificates.on.tls_server_config_ready,
-                               self.on_certificates_relation_changed)
+        # ca_client loads cryptography: only needed with the relation
+        if self.model.relations["certificates"]:
+            import interface_tls_certificates.ca_client as ca_client
+            self.certificates = ca_client.CAClient(
+                self,
+                'certificates')
+            self.framework.observe(
+                self.certificates.on.ca_available,
+                self.on_certificates_relation_joined)
+            self.framework.observe(
+                self.certificates.on.tls_server_config_ready,
+                self.on_certificates_relation_changed)
         self.framework.observe(self.on.update_status,
                                self.on_update_status)
         self.framework.observe(self.on.mds_relation_joined,
@@ -148,6 +295,12 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                                self.list_certificates_action)
         self.framework.observe(self.on.set_rack_id_action,
                                self.set_rack_id_action)
+        self.framework.observe(self.on.hook_profile_action,
+                               self.hook_profile_action)
+        self.framework.observe(self.on.rotate_keystore_passwords_action,
+                               self.rotate_keystore_passwords_action)
+        self.framework.observe(self.on.tls_benchmark_action,
+                               self.tls_benchmark_action)
 
         self.cluster = KafkaBrokerCluster(self, 'cluster',
                                           self.config.get("cluster-count", 3))
@@ -156,8 +309,13 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         self.ks.set_default(zk_key="")
         self.ks.set_default(ssl_cert="")
         self.ks.set_default(ssl_key="")
+        # Key algorithm used for the certs generated with generate-root-ca
+        self.ks.set_default(generated_key_algorithm="")
         self.ks.set_default(ts_zookeeper_pwd=genRandomPassword())
         self.ks.set_default(ks_zookeeper_pwd=genRandomPassword())
+        # Encrypts the passwords set dynamically, never rotated: the
+        # passwords already stored could not be decrypted anymore
+        self.ks.set_default(password_encoder_secret=genRandomPassword())
         self.ks.set_default(changed_params="{}")
         self.listener = KafkaListenerProvidesRelation(self, 'listeners')
         self.mds = KafkaMDSProvidesRelation(self, 'mds')
@@ -165,9 +323,39 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         self.ks.set_default(need_restart=False)
         self.ks.set_default(ports=[])
         self.ks.set_default(endpoints=[])
+        # Inter-broker listener endpoint, used by the admin commands
+        self.ks.set_default(bootstrap_server="")
+        # Endpoints that must complete a TLS handshake after a restart
+        self.ks.set_default(tls_endpoints=[])
         self.ks.set_default(internal_listener="")
         self.ks.set_default(external_listener="")
         self.ks.set_default(rack_id="")
+        # Digests of the inputs used to render each artifact
+        self.ks.set_default(artifacts="{}")
+        self.ks.set_default(listener_info="")
+        # Binding addresses used to resolve the hostnames
+        self.ks.set_default(binding_addrs="")
+        # Versioned keystore in use and the fingerprints of the TLS
+        # material served by the broker and applied on the last restart
+        self.ks.set_default(ssl_keystore_active="")
+        # Versioned keystore loaded by the running broker
+        self.ks.set_default(ssl_keystore_running="")
+        self.ks.set_default(tls_state="")
+        self.ks.set_default(tls_restart_state="")
+        # server.properties, without the listeners' keystores, as last
+        # rendered and as applied on the last restart
+        self.ks.set_default(server_props="")
+        self.ks.set_default(server_props_restart="")
+        # Fingerprint of the ZooKeeper client settings, see _zk_client_state
+        self.ks.set_default(zk_client_state="")
+        # Since when the active controller waits for the other units to
+        # restart first
+        self.ks.set_default(controller_yield_since=0.0)
+        # Since when the broker restarted and waits for its replicas to
+        # catch up, and the number of consecutive healthy checks
+        self.ks.set_default(restart_health_since=0.0)
+        self.ks.set_default(restart_health_checks=0)
+        self.reconciler = ArtifactReconciler(self.ks)
         # LMA integrations
         self.prometheus = \
             KafkaJavaCharmBasePrometheusMonitorNode(
@@ -186,9 +374,15 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         # always manage the locks.
         self.coordinator = OpsCoordinator()
         self.coordinator.resume()
+        # Used instead of the coordinator if rolling-restart-strategy=rack
+        self.restart_scheduler = RackRestartScheduler(self, "cluster")
         # List of listeners to be passed via relation if restart is
         # successful
         self.listener_info = None
+        # The broker health is checked at most once per dispatch
+        self._health_checked = False
+        # Active controller, read from ZooKeeper at most once per dispatch
+        self._controller = None
 
     def __del__(self):
         """Ensure coordinator will release any locks."""
@@ -219,15 +413,20 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             # Likewise, there is an external listener address already defined
             return self.ks.external_listener
 
-        addr = get_address_in_network(self.config["{}-network".format(bind_name)])
-        bind_addr = self.model.get_binding(bind_name).network.ingress_address \
-            if ingress else self.model.get_binding(bind_name).network.bind_address
+        network = self.config["{}-network".format(bind_name)]
+        memo_key = (bind_name, ingress, network)
+        if memo_key in self._extra_binding_memo:
+            return self._extra_binding_memo[memo_key]
+        addr = self.network.address_in_network(network)
+        bind_addr = self.network.ingress_address(bind_name) \
+            if ingress else self.network.bind_address(bind_name)
         lst_addr = self.listener.binding_addr \
             if ingress else self.listener.advertise_addr
         # Check if addr or the binding is equal to "listener" binding
         # If that is the case, then try to use the binding
         if addr == lst_addr and bind_addr == lst_addr:
             # There is no point in following up, the addresses are all the same
+            self._extra_binding_memo[memo_key] = None
             return None
         if addr == lst_addr:
             addr = bind_addr
@@ -236,8 +435,10 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             self.ks.internal_listener = addr
         else:
             self.ks.external_listener = addr
+        self._extra_binding_memo[memo_key] = addr
         return addr
 
+    @profiled("manage-listener-certs")
     def _manage_listener_certs(self):
         """Manages the certificates between cluster and listener relations.
 
@@ -255,7 +456,7 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                 group = self.config.get("group", "")
                 extra_certs = self.cluster.get_all_certs()
                 # Grab the extra CAs that have been passed via certificates action
-                extra_cas = self.ks.ssl_certs
+                extra_cas = list(self.ks.ssl_certs.values())
 
                 # There are 3x possible situations to manage certs:
                 # 1) listener relation exists: push certs there
@@ -320,7 +521,169 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             self._generate_server_properties(event)
             service_restart(self.service)
         else:
-            self._on_config_changed(event)
+            self._mark_dirty(event)
+
+    def rotate_keystore_passwords_action(self, event):
+        """Generates new keystore passwords and rebuilds the keystores.
+
+        As server.properties changes, the broker is restarted.
+        """
+        self.ks.ks_password = genRandomPassword()
+        self.ks.ks_zookeeper_pwd = genRandomPassword()
+        rotated = ["keystore", "zookeeper-keystore"]
+        if event.params.get("truststores", False):
+            self.ks.ts_password = genRandomPassword()
+            self.ks.ts_zookeeper_pwd = genRandomPassword()
+            rotated.extend(["truststore", "zookeeper-truststore"])
+        self._build_keystores()
+        self._mark_dirty(event)
+        event.set_results({"rotated": ",".join(rotated)})
+
+    def _tls_profile_suites(self):
+        """Cipher suites of the TLS performance profile.
+
+        AES-GCM first if the CPU has AES instructions, ChaCha20 otherwise.
+        """
+        return cipher_suites_for_cert(
+            self.get_ssl_cert(), prefer_chacha20=not has_aes_ni())
+
+    def _tls_profile_opts(self):
+        """Per-listener options of the TLS performance profile."""
+        if not self.config.get("tls-performance-profile", False):
+            return {}
+        opts = {"ssl.enabled.protocols": ",".join(TLS_PERFORMANCE_PROTOCOLS)}
+        suites = self._tls_profile_suites()
+        if suites:
+            opts["ssl.cipher.suites"] = ",".join(suites)
+        return opts
+
+    @contextlib.contextmanager
+    def _tls_client_files(self):
+        """Yields (certfile, keyfile) with the unit's cert and key, to be
+        used as client cert on listeners with clientAuth set.
+
+        Yields (None, None) if clientAuth is not set. Files are removed on
+        exit.
+        """
+        if not self.config.get("clientAuth", False) or \
+           not self.get_ssl_cert() or not self.get_ssl_key():
+            yield None, None
+            return
+        tmpdir = tempfile.mkdtemp()
+        try:
+            certfile = os.path.join(tmpdir, "client.crt")
+            keyfile = os.path.join(tmpdir, "client.key")
+            with open(certfile, "w") as f:
+                f.write(self.get_ssl_cert())
+            with open(keyfile, "w") as f:
+                f.write(self.get_ssl_key())
+            yield certfile, keyfile
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _check_endpoints_after_restart(self):
+        """Probes all the listeners, with a TLS handshake on the TLS ones.
+
+        The time each endpoint took to answer is saved in the hook profile,
+        see the hook-profile action.
+        """
+        with self._tls_client_files() as (certfile, keyfile):
+            ready = self.check_ports_are_open(
+                endpoints=self.ks.endpoints,
+                retrials=3,
+                tls_endpoints=self.ks.tls_endpoints,
+                ssl_context=client_context(
+                    certfile=certfile, keyfile=keyfile))
+        for ep, r in self.endpoint_probe_results.items():
+            self.profiler.record("endpoint-ready:{}".format(ep),
+                                 r["latency"])
+        return ready
+
+    def tls_benchmark_action(self, event):
+        """Measures handshake rate and cipher throughput per listener.
+
+        Compares a client with default TLS 1.2 settings against one using
+        the TLS performance profile.
+        """
+        if not self.ks.listener_info:
+            event.fail("Listeners not configured yet")
+            return
+        listeners = self.listener._convert_listener_template(
+            self.ks.listener_info,
+            internal_extra_binding=self._reconcile_extra_biding(
+                "internal-listener"),
+            external_extra_binding=self._reconcile_extra_biding(
+                "external-listener", ingress=False),
+            cluster_binding=self.cluster.binding_addr)
+        only = event.params.get("listener", "")
+        results = {}
+        with self._tls_client_files() as (certfile, keyfile):
+            for name, lst in listeners.items():
+                if lst["secprot"] not in ["SSL", "SASL_SSL"] or \
+                   (only and only != name):
+                    continue
+                host = lst["endpoint"].split("://")[1].rsplit(":", 1)[0]
+                r = benchmark_listener(
+                    host or self.listener.hostname, lst["port"],
+                    count=event.params.get("count", 50),
+                    profile_protocols=TLS_PERFORMANCE_PROTOCOLS,
+                    profile_suites=self._tls_profile_suites(),
+                    certfile=certfile, keyfile=keyfile)
+                # Action results only accept strings as values
+                results[name] = {
+                    profile: " ".join(
+                        "{}={}".format(k, v) for k, v in stats.items())
+                    for profile, stats in r.items()}
+        if not results:
+            event.fail("No TLS listeners found")
+            return
+        event.set_results(results)
+
+    def hook_profile_action(self, event):
+        """Returns the p50/p95 timings per stage and per hook type."""
+        if event.params.get("reset", False):
+            self.profiler.reset()
+            event.set_results({"profile": "History removed"})
+            return
+        report = self.profiler.report(hook=event.params.get("hook", None))
+        if not report["hooks"]:
+            event.set_results({"profile": "No hooks profiled yet"})
+            return
+
+        # Action results only accept strings as values
+        def _fmt(stats):
+            return " ".join("{}={}".format(k, v) for k, v in stats.items())
+        event.set_results({
+            "stages": {
+                name: _fmt(stats)
+                for name, stats in report["stages"].items()},
+            "hooks": {
+                hook: {name: _fmt(stats) for name, stats in stages.items()}
+                for hook, stages in report["hooks"].items()}
+        })
+
+    def _mark_dirty(self, event):
+        """Requests the config-changed logic to run at the end of the hook.
+
+        Several handlers may run on the same dispatch (e.g. deferred events
+        being reemitted before the actual hook). The reconcile runs only
+        once, with the last event that requested it.
+        """
+        self._dirty_event = event
+
+    def _on_pre_commit(self, event):
+        """Runs the config-changed logic if any handler requested it."""
+        if self._dirty_event is None:
+            return
+        dirty_event, self._dirty_event = self._dirty_event, None
+        # Only the files written by this run decide on reloads and restarts
+        reset_changed_files()
+        self._on_config_changed(dirty_event)
+
+    def _on_framework_commit(self, event):
+        """Flushes relation data and saves the profile of this hook."""
+        self.relation_data.flush()
+        self.profiler.flush()
 
     def on_upload_keytab_action(self, event):
         """Implement the keytab action upload."""
@@ -331,11 +694,254 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             # Capture any exceptions and return them via action
             event.fail("Failed with: {}".format(str(e)))
             return
-        self._on_config_changed(event)
+        self._mark_dirty(event)
         event.set_results({"keytab": "Uploaded!"})
 
+    def _broker_rack(self):
+        """Returns broker.rack: set-rack-id value or the unit's AZ, if
+        customize-failure-domain is set."""
+        if len(self.ks.rack_id) > 0:
+            return self.ks.rack_id
+        if self.config.get("customize-failure-domain", False):
+            return os.environ.get("JUJU_AVAILABILITY_ZONE", None) or ""
+        return ""
+
+    def _rack_restarts_enabled(self):
+        return self.config.get("rolling-restart-strategy",
+                               "coordinator") == "rack"
+
+    def _rack_restart_is_safe(self, broker_racks):
+        """True if every partition has replicas in at least two racks.
+
+        Otherwise, restarting a whole rack could take partitions offline.
+        """
+        if not self.config.get("restart-rack-safety-check", True):
+            return True
+        if not self.ks.bootstrap_server:
+            return False
+        try:
+            partitions = describe_partitions(
+                self.ks.bootstrap_server,
+                command_config=self.config.get(
+                    "filepath-kafka-client-properties", None),
+                cmd=kafka_topics_command(self.distro))
+        except KafkaTopicsError as e:
+            logger.warning("Cannot check the partitions: {}".format(str(e)))
+            return False
+        return partitions_span_racks(partitions, broker_racks)
+
+    def _zk_shell_args(self, server_opts):
+        """Returns the zookeeper-shell arguments for server_opts."""
+        zk_client_config = None
+        if server_opts.get("zookeeper.ssl.client.enable", "") == "true":
+            zk_client_config = self.config.get(
+                "filepath-zookeeper-client-properties", None)
+        return {"zk_client_config": zk_client_config,
+                "cmd": zookeeper_shell_command(self.distro)}
+
+    def _active_controller(self):
+        """Returns (broker id, epoch) of the active controller, read from
+        ZooKeeper. Each value is None if unknown.
+
+        Each read starts a zookeeper-shell JVM: the result is kept for the
+        rest of the dispatch.
+        """
+        if self._controller is not None:
+            return self._controller
+        self._controller = (None, None)
+        server_opts = json.loads(self.ks.server_props or "{}")
+        if not server_opts.get("zookeeper.connect", ""):
+            return self._controller
+        try:
+            self._controller = active_controller(
+                server_opts["zookeeper.connect"],
+                **self._zk_shell_args(server_opts))
+        except KafkaZookeeperMetadataError as e:
+            logger.debug("Cannot read the active controller: {}".format(
+                str(e)))
+        return self._controller
+
+    def _is_local_controller(self):
+        """True if this broker runs the active controller.
+
+        Reads ActiveControllerCount from the JMX exporter, if enabled, or
+        compares the controller registered on ZooKeeper with this broker.
+        """
+        if self.is_jmxexporter_enabled():
+            try:
+                metrics = scrape_metrics(
+                    self.config.get("jmx-exporter-port", 9404))
+                return metrics.get(ACTIVE_CONTROLLER_COUNT, 0) >= 1
+            except OSError as e:
+                logger.debug("Cannot read the broker metrics: {}".format(
+                    str(e)))
+        controller, _ = self._active_controller()
+        return controller is not None and controller == read_broker_id(
+            ",".join(self.sm.lst_volumes()))
+
+    def _controller_yields(self, is_controller):
+        """True if this unit runs the active controller and lets the other
+        units waiting for a restart go first.
+
+        Used with the coordinator, which grants the lock in no particular
+        order. Waits up to CONTROLLER_YIELD_TIMEOUT seconds.
+        """
+        others = self.restart_scheduler.others_pending()
+        if not is_controller or not others or \
+           not self.config.get("restart-controller-last", True):
+            self.ks.controller_yield_since = 0.0
+            return False
+        if not self.ks.controller_yield_since:
+            self.ks.controller_yield_since = time.time()
+        if time.time() - self.ks.controller_yield_since > \
+           CONTROLLER_YIELD_TIMEOUT:
+            logger.warning("Units {} still waiting for a restart, restart "
+                           "the active controller anyway".format(others))
+            return False
+        self.model.unit.status = MaintenanceStatus(
+            "Active controller, restarting after: {}".format(
+                ", ".join(others)))
+        return True
+
+    def _schedule_restarts(self):
+        """Updates the restart grants and the controller failovers of the
+        rollout, if leader.
+
+        Only the rack scheduler has grants. The active controller is
+        granted last, if restart-controller-last is set.
+        """
+        if not self.unit.is_leader():
+            return
+        if not self.restart_scheduler.requests():
+            # Only closes the rollout, if any: the failovers were tracked
+            # while the restarts were pending
+            if self.restart_scheduler.rollout.get("active", False):
+                self.restart_scheduler.track_rollout()
+            return
+        controller_id, epoch = self._active_controller()
+        controller = self.restart_scheduler.controller_unit(controller_id)
+        self.restart_scheduler.track_rollout(controller, epoch)
+        if not self._rack_restarts_enabled():
+            return
+        if not self.config.get("restart-controller-last", True):
+            controller = None
+        self.restart_scheduler.schedule(
+            max_concurrency=self.config.get("restart-max-concurrency", 0),
+            safety_check=self._rack_restart_is_safe,
+            controller=controller)
+
+    def _others_recovering(self):
+        """True if other units restarted and their replicas still catch up.
+
+        The coordinator lock is released at the end of each hook, the
+        next unit only requests it once the others recovered.
+        """
+        others = self.restart_scheduler.others_recovering()
+        if others:
+            self.model.unit.status = MaintenanceStatus(
+                "Waiting for {} to recover".format(", ".join(others)))
+        return len(others) > 0
+
+    def _restart_granted(self, event):
+        """Requests the restart and checks if it can happen now.
+
+        Uses the rack scheduler or the OpsCoordinator lock, depending on
+        rolling-restart-strategy. With the coordinator, the services are
+        also restarted once the lock is acquired. In both cases, the
+        request is published on the peer relation, so the active
+        controller can restart after the other units.
+        """
+        is_controller = self._is_local_controller()
+        self.restart_scheduler.set_controller(is_controller)
+        self.restart_scheduler.request(
+            rack=self._broker_rack(),
+            broker_id=read_broker_id(",".join(self.sm.lst_volumes())))
+        if not self._rack_restarts_enabled():
+            self._schedule_restarts()
+            # The lock is released at the end of each hook and may be
+            # granted to any unit: check the others on every attempt
+            if self._others_recovering() or \
+               self._controller_yields(is_controller):
+                return False
+            return event.restart(self.coordinator)
+        self._schedule_restarts()
+        if not self.restart_scheduler.is_granted():
+            return False
+        for svc in self.services:
+            service_restart(svc)
+        return True
+
+    def _broker_metrics(self):
+        """Returns the metrics used to check the broker health.
+
+        Scraped from the local JMX exporter, if enabled. Otherwise, only
+        the under-replicated partitions are counted with kafka-topics.
+        """
+        if self.is_jmxexporter_enabled():
+            return scrape_metrics(self.config.get("jmx-exporter-port", 9404))
+        partitions = describe_partitions(
+            self.ks.bootstrap_server,
+            command_config=self.config.get(
+                "filepath-kafka-client-properties", None),
+            cmd=kafka_topics_command(self.distro),
+            extra_args=["--under-replicated-partitions"])
+        # Only the partitions led by or replicated on this broker
+        broker_id = read_broker_id(",".join(self.sm.lst_volumes()))
+        if broker_id:
+            partitions = [p for p in partitions if str(broker_id) in p]
+        return {UNDER_REPLICATED_PARTITIONS: len(partitions)}
+
+    def _broker_recovered(self):
+        """Checks if the replicas caught up after the restart.
+
+        Runs a single check per dispatch, the restart event is deferred
+        in the meantime: the hook never waits for the replicas. Once the
+        broker is healthy, or after restart-health-timeout seconds, the
+        restart is marked as done, so the next units can restart.
+
+        Returns True once the restart is done.
+        """
+        if self._health_checked:
+            return False
+        self._health_checked = True
+        timeout = self.config.get("restart-health-timeout", 600)
+        elapsed = int(time.time() - self.ks.restart_health_since)
+        state = {}
+        if timeout > 0:
+            state, self.ks.restart_health_checks = check_broker_health(
+                self._broker_metrics, self.ks.restart_health_checks)
+        healthy = timeout <= 0 or \
+            self.ks.restart_health_checks >= HEALTH_STABLE_CHECKS
+        if not healthy and elapsed < timeout:
+            if state["under_replicated"] is None:
+                msg = "Restarted, waiting for broker metrics"
+            else:
+                msg = "Restarted, waiting for {} under-replicated " \
+                      "partitions".format(state["under_replicated"])
+            self.model.unit.status = MaintenanceStatus(
+                "{} ({}s/{}s)".format(msg, elapsed, timeout))
+            return False
+        if healthy:
+            self.model.unit.status = ActiveStatus("service running")
+        else:
+            logger.warning("Broker not healthy after {}s: {}".format(
+                timeout, state))
+            self.model.unit.status = BlockedStatus(
+                "Restarted, but {} under-replicated partitions "
+                "after timeout".format(
+                    state.get("under_replicated", "unknown")))
+        self.ks.restart_health_since = 0.0
+        self.restart_scheduler.done()
+        return True
+
+    @profiled("restart-event")
     def on_restart_event(self, event):
         """Run the restart logic."""
+        if self.ks.restart_health_since:
+            # Restarted on a previous hook, the replicas still catch up
+            if not self._broker_recovered():
+                event.defer()
+            return
         if not self.ks.need_restart:
             # There is a chance of several restart events being stacked.
             # This check ensures a single restart happens if several
@@ -356,20 +962,24 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                 self.listener.set_bootstrap_data(self.listener_info)
             return
         try:
-            if event.restart(self.coordinator):
-                if self.check_ports_are_open(
-                        endpoints=self.ks.endpoints,
-                        retrials=3):
-                    # Restart was successful, update need_restart and inform
-                    # the clients via listener relation
-                    self.model.unit.status = \
-                        ActiveStatus("service running")
-                    # Toggle need_restart as we just did it.
-                    self.ks.need_restart = False
-                else:
+            if self._restart_granted(event):
+                self._keystore_loaded()
+                if not self._check_endpoints_after_restart():
                     logger.warning("Failure at restart, operator should check")
                     self.model.unit.status = \
                         BlockedStatus("Restart Failed, check service")
+                    # As with the coordinator lock, let the next units restart
+                    self.restart_scheduler.done()
+                    return
+                # Toggle need_restart as we just did it.
+                self.ks.need_restart = False
+                # Hold the restart until the replicas caught up, checked on
+                # this and the next hooks
+                self.ks.restart_health_since = time.time()
+                self.ks.restart_health_checks = 0
+                self.restart_scheduler.recovering()
+                if not self._broker_recovered():
+                    event.defer()
             else:
                 # defer the RestartEvent as it is still waiting for the
                 # lock to be released.
@@ -382,9 +992,12 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                 BlockedStatus("Restart Failed, check service")
             # Ignore the next restarts
             self.ks.need_restart = False
+            self.ks.restart_health_since = 0.0
+            self.restart_scheduler.done()
 
     def on_certificates_relation_joined(self, event):
         """Request the certificates needed for this unit."""
+        self.invalidate_cert_cache()
         # Relation just joined, request certs for each of the relations
         # That will happen once. The certificates will be generated, then
         # it will trigger a -changed Event on certificates, which will
@@ -408,16 +1021,17 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             extra_sans.append(self._reconcile_extra_biding("external-listener", ingress=False))
         self._cert_relation_set(None, self.listener,
                                 extra_sans=extra_sans)
-        self._on_config_changed(event)
+        self._mark_dirty(event)
 
     def on_certificates_relation_changed(self, event):
         """Check if the certificates are ready and update configs."""
-        self._on_config_changed(event)
+        self.invalidate_cert_cache()
+        self._mark_dirty(event)
 
     def on_listeners_relation_joined(self, event):
         """Execute listener logic."""
         self.listener.on_listener_relation_joined(event)
-        self._on_config_changed(event)
+        self._mark_dirty(event)
 
     def on_listeners_relation_changed(self, event):
         """Execute listener logic."""
@@ -434,7 +1048,7 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                 "Missing certificate info: listeners")
             event.defer()
             return
-        self._on_config_changed(event)
+        self._mark_dirty(event)
 
     def on_mds_relation_joined(self, event):
         """Add the MDS relation for confluent kafka."""
@@ -451,8 +1065,25 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         # Check if the locks must be handled or not
         # coordinator = OpsCoordinator()
         # coordinator.handle_locks(self.unit)
+        self._pregenerate_keys()
+        self._schedule_restarts()
         super().on_update_status(event)
 
+    @profiled("pregenerate-keys")
+    def _pregenerate_keys(self):
+        """Fills the pool of keys used by generate-root-ca.
+
+        Runs on install and update-status, so config-changed does not have
+        to wait for the key generation once the certs need to be created.
+        """
+        if not self.config.get("generate-root-ca", False):
+            return
+        algorithm = self.config.get("tls-key-algorithm", "ecdsa-p256")
+        try:
+            pregenerate_keys(self.unit_folder, algorithm)
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to pregenerate keys: {}".format(str(e)))
+
     def _on_cluster_relation_joined(self, event):
         """Call cluster class for -joined event."""
         self.cluster.user = self.config.get("user", "")
@@ -466,7 +1097,7 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         except KafkaRelationBaseTLSNotSetError as e:
             event.defer()
             self.model.unit.status = BlockedStatus(str(e))
-        self._on_config_changed(event)
+        self._mark_dirty(event)
 
     def _on_cluster_relation_changed(self, event):
         """Call cluster class for -changed event."""
@@ -481,7 +1112,9 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         except KafkaRelationBaseTLSNotSetError as e:
             event.defer()
             self.model.unit.status = BlockedStatus(str(e))
-        self._on_config_changed(event)
+        self._mark_dirty(event)
+        # Peers may have finished their restarts
+        self._schedule_restarts()
         # Inform prometheus there are new units to monitor
         if not self.prometheus.relations:
             return
@@ -501,7 +1134,7 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         except KafkaRelationBaseTLSNotSetError as e:
             event.defer()
             self.model.unit.status = BlockedStatus(str(e))
-        self._on_config_changed(event)
+        self._mark_dirty(event)
 
     def _on_zookeeper_relation_changed(self, event):
         """Call zk class for -changed event."""
@@ -516,7 +1149,6 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         except KafkaRelationBaseTLSNotSetError as e:
             event.defer()
             self.model.unit.status = BlockedStatus(str(e))
-        # A Zookeeper change should always trigger a restart.
         if not service_running(self.service):
             # For some reason, after configurations are ready, kafka restarts
             # before zookeeper is ready. That means the last restart events
@@ -526,14 +1158,28 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             # kafka <> zookeeper specific.
             service_resume(self.service)
             service_restart(self.service)
-        else:
-            # Otherwise, charm is running then issue a restart event.
-            self.ks.need_restart = True
-            # Issue a restart event with current context.
-            self.on.restart_event.emit(
-                self.ks.config_state, services=self.services)
-        self._on_config_changed(event)
-
+        # Otherwise, only a change of the ZooKeeper client settings rendered,
+        # e.g. zookeeper.connect or the TLS configs, needs a restart: the
+        # config-changed logic compares their fingerprint with the one in
+        # use and requests a coordinated restart if they differ. That also
+        # covers the first join, as no fingerprint was in use before.
+        self._mark_dirty(event)
+
+    def _zk_client_state(self, server_opts):
+        """Returns the fingerprint of the ZooKeeper client settings.
+
+        Covers the connection string, TLS and SASL configs of
+        server.properties and the certificate used against ZooKeeper.
+        """
+        return fingerprint({
+            "server_opts": {k: v for k, v in (server_opts or {}).items()
+                            if k.startswith("zookeeper.")},
+            "zk_crt": fingerprint(self.get_zk_cert()),
+            "zk_key": fingerprint(self.get_zk_key()),
+            "sasl_kerberos": self.zk.is_sasl_kerberos_enabled(),
+        })
+
+    @profiled("generate-keystores")
     def _generate_keystores(self):
         """Generate the keystores for SSL and zookeeper relations."""
         # TODO: move to kafka base class
@@ -541,25 +1187,35 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         # If we will auto-generate the root ca
         # and at least one of the certs or keys is not yet set,
         # then we can proceed and regenerate it.
+        key_algorithm = self.config.get("tls-key-algorithm", "ecdsa-p256")
         if self.config["generate-root-ca"] and \
-            (len(self.ks.ssl_cert) > 0 and
-             len(self.ks.ssl_key) > 0 and
-             len(self.ks.zk_cert) > 0 and
-             len(self.ks.zk_key) > 0):
+                (len(self.ks.ssl_cert) > 0 and
+                 len(self.ks.ssl_key) > 0 and
+                 len(self.ks.zk_cert) > 0 and
+                 len(self.ks.zk_key) > 0) and \
+                self.ks.generated_key_algorithm in ["", key_algorithm]:
             return
         if self.config["generate-root-ca"]:
+            # Use the keys generated ahead of time, if any are available
             self.ks.ssl_cert, self.ks.ssl_key = \
                 generateSelfSigned(self.unit_folder,
                                    certname="zk-kafka-broker-root-ca",
                                    user=self.config["user"],
                                    group=self.config["group"],
-                                   mode=0o640)
+                                   mode=0o640,
+                                   key_algorithm=key_algorithm,
+                                   key=pop_pregenerated_key(
+                                       self.unit_folder, key_algorithm))
             self.ks.zk_cert, self.ks.zk_key = \
                 generateSelfSigned(self.unit_folder,
                                    certname="ssl-kafka-broker-root-ca",
                                    user=self.config["user"],
                                    group=self.config["group"],
-                                   mode=0o640)
+                                   mode=0o640,
+                                   key_algorithm=key_algorithm,
+                                   key=pop_pregenerated_key(
+                                       self.unit_folder, key_algorithm))
+            self.ks.generated_key_algorithm = key_algorithm
         else:
             # Check if the certificates remain the same
             if self.ks.zk_cert == self.get_zk_cert() and \
@@ -573,9 +1229,190 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             self.ks.zk_key = self.get_zk_key()
             self.ks.ssl_cert = self.get_ssl_cert()
             self.ks.ssl_key = self.get_ssl_key()
+        self._build_keystores()
+
+    def get_ssl_keystore_location(self):
+        """Keystore in use by the listeners.
+
+        If tls-dynamic-rotation is set, the keystore is versioned by the
+        cert and key it contains, see _build_keystores.
+        """
+        return self.ks.ssl_keystore_active or self.get_ssl_keystore()
+
+    def _tls_material(self, server_opts):
+        """Returns the keystore options of server_opts and the fingerprint
+        of the cert, key and keystore served by the listeners."""
+        keystore = self.get_ssl_keystore_location()
+        keys = [k for k, v in (server_opts or {}).items()
+                if k.endswith("ssl.keystore.location") and v == keystore]
+        return keys, fingerprint({
+            "ssl_crt": self.get_ssl_cert(),
+            "ssl_key": self.get_ssl_key(),
+            "keystore": keystore
+        })
+
+    def _rotate_tls_dynamically(self, server_opts, tls_keys, ctx):
+        """Updates the listeners' keystore on the running broker.
+
+        Only possible if tls-dynamic-rotation is set, the broker is
+        already running with TLS, no other change requires a restart (ctx is
+        the same as the last one) and the keystore is only used by listeners.
+        Once kafka-configs finishes, waits until each listener serves the
+        new certificate.
+
+        Returns True if the rotation was applied, False if a restart is
+        needed instead.
+        """
+        if not self.config.get("tls-dynamic-rotation", False) or \
+           not tls_keys or not self.ks.tls_state or \
+           ctx != self.ks.config_state or \
+           not service_running(self.service):
+            return False
+        if any(not k.startswith("listener.name.") for k in tls_keys):
+            logger.info("Keystore also used outside listeners, restart")
+            return False
+        # {listener name: (host, port)}
+        endpoints = {}
+        for e in server_opts.get("advertised.listeners", "").split(","):
+            name, _, addr = e.partition("://")
+            host, _, port = addr.rpartition(":")
+            endpoints[name.lower()] = (host, port)
+        inter_broker = server_opts.get(
+            "inter.broker.listener.name", "BROKER").lower()
+        if inter_broker not in endpoints:
+            return False
+        _, crt = get_ca_and_cert(self.get_ssl_cert())
+        if not crt:
+            logger.warning("No certificate to verify the rotation, restart")
+            return False
+        try:
+            alter_broker_configs(
+                {k: server_opts[k] for k in tls_keys},
+                broker_id=read_broker_id(server_opts.get("log.dirs")),
+                bootstrap_server="{}:{}".format(*endpoints[inter_broker]),
+                command_config=self.config.get(
+                    "filepath-kafka-client-properties", None),
+                cmd=kafka_configs_command(self.distro))
+        except KafkaDynamicConfigError as e:
+            logger.warning("Dynamic TLS rotation failed: {}".format(str(e)))
+            return False
+        for k in tls_keys:
+            name = k[len("listener.name."):].split(".")[0]
+            if name not in endpoints:
+                continue
+            if not wait_for_certificate(*endpoints[name], crt):
+                logger.warning("Listener {} does not serve the new "
+                               "certificate".format(name))
+                return False
+        self.ks.ssl_keystore_running = self.get_ssl_keystore_location()
+        logger.info("TLS certificates rotated without restart")
+        return True
+
+    def _apply_dynamic_configs(self, changes, server_opts, listeners=None):
+        """Updates the per-broker and cluster-wide configs on the running
+        broker.
+
+        changes: output of classify_changes for server.properties. The
+        cluster-wide configs are set as cluster defaults: every unit renders
+        the same values, so each unit applying them is idempotent.
+        listeners: (added, removed) listener names, if changes has LISTENERS.
+        The listeners are updated together with the per-broker configs.
+        Then, waits until the broker advertises them on its ZooKeeper
+        registration before publishing the new bootstrap data.
+
+        Returns True if all the changes were applied, False if a restart is
+        needed instead.
+        """
+        if not self.config.get("dynamic-config-updates", True) or \
+           not self.ks.bootstrap_server or \
+           not service_running(self.service):
+            return False
+        args = {
+            "bootstrap_server": self.ks.bootstrap_server,
+            "command_config": self.config.get(
+                "filepath-kafka-client-properties", None),
+            "cmd": kafka_configs_command(self.distro)
+        }
+        if changes[LISTENERS] and not listeners:
+            return False
+        broker_id = read_broker_id(server_opts.get("log.dirs"))
+        per_broker = {**changes[PER_BROKER], **changes[LISTENERS]}
+        if changes[LISTENERS]:
+            # The new listeners need all their configs on the same update,
+            # including the keystore left out of changes
+            prefixes = tuple("listener.name.{}.".format(n)
+                             for n in listeners[0])
+            per_broker.update({
+                k: v for k, v in server_opts.items()
+                if prefixes and k.lower().startswith(prefixes)})
+        try:
+            for updates, default in [(per_broker, False),
+                                     (changes[CLUSTER_WIDE], True)]:
+                alter_broker_configs(
+                    {k: v for k, v in updates.items() if v is not None},
+                    broker_id=broker_id,
+                    delete=[k for k, v in updates.items() if v is None],
+                    entity_default=default, **args)
+        except KafkaDynamicConfigError as e:
+            # Dynamic configs take precedence over server.properties:
+            # configs applied dynamically before keep their old value
+            logger.warning("Dynamic config update failed, restart: "
+                           "{}".format(str(e)))
+            return False
+        if changes[LISTENERS]:
+            added, removed = listeners
+            if not self._wait_for_advertised_listeners(
+                    server_opts, broker_id, added, removed):
+                logger.warning("Listeners {} not advertised, "
+                               "restart".format(added))
+                return False
+            if self.listener_info:
+                self.listener.set_bootstrap_data(self.listener_info)
+            logger.info("Listeners added: {}, removed: {}".format(
+                added, removed))
+        logger.info("Configs updated without restart: {}".format(
+            sorted(list(per_broker) + list(changes[CLUSTER_WIDE]))))
+        return True
+
+    def _wait_for_advertised_listeners(self, server_opts, broker_id,
+                                       added, removed):
+        """Waits until the broker registration on ZooKeeper lists the
+        added listeners and none of the removed ones."""
+        args = self._zk_shell_args(server_opts)
+        return wait_for_advertised_listeners(
+            lambda: broker_endpoints(
+                server_opts.get("zookeeper.connect", ""), broker_id, **args),
+            added, removed)
+
+    def _remove_stale_keystores(self, new_path):
+        """Removes versioned keystores other than new_path and the ones in
+        use: the keystore rendered on server.properties and the one loaded
+        by the running broker. The latter is kept until the broker loads
+        another one, e.g. if the rotation waits for a restart."""
+        base, ext = os.path.splitext(self.get_ssl_keystore())
+        keep = [new_path, self.ks.ssl_keystore_active,
+                self.ks.ssl_keystore_running]
+        for f in glob.glob("{}.*{}".format(base, ext)):
+            if f not in keep:
+                logger.debug("Removing stale keystore {}".format(f))
+                os.remove(f)
+
+    def _keystore_loaded(self):
+        """Tracks the keystore loaded by the broker on a restart and removes
+        the older versions."""
+        self.ks.ssl_keystore_running = self.get_ssl_keystore_location()
+        if self.config.get("tls-dynamic-rotation", False) and \
+           self.ks.ssl_keystore_active:
+            self._remove_stale_keystores(self.ks.ssl_keystore_active)
+
+    def _build_keystores(self):
+        """Builds the keystores from the certs and keys saved in self.ks.
+
+        Passwords are kept across regenerations, so a new cert does not
+        change server.properties. They are only rotated with the
+        rotate-keystore-passwords action.
+        """
         if (len(self.ks.zk_cert) > 0 and len(self.ks.zk_key) > 0):
-            self.ks.ks_zookeeper_pwd = genRandomPassword()
-            filename = genRandomPassword(6)
             PKCS12CreateKeystore(
                 self.get_zk_keystore(),
                 self.ks.ks_zookeeper_pwd,
@@ -584,26 +1421,25 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                 user=self.config["user"],
                 group=self.config["group"],
                 mode=0o640,
-                openssl_chain_path="/tmp/" + filename + ".chain",
-                openssl_key_path="/tmp/" + filename + ".key",
-                openssl_p12_path="/tmp/" + filename + ".p12",
                 ks_regenerate=self.config.get(
                                   "regenerate-keystore-truststore", False))
         if len(self.ks.ssl_cert) > 0 and \
            len(self.ks.ssl_key) > 0:
-            self.ks.ks_password = genRandomPassword()
-            filename = genRandomPassword(6)
+            path = self.get_ssl_keystore()
+            if self.config.get("tls-dynamic-rotation", False) and path:
+                # Kafka only reloads the keystore if its location changes
+                path = versioned_store_path(path, fingerprint(
+                    [self.get_ssl_cert(), self.get_ssl_key()])[:12])
+                self._remove_stale_keystores(path)
+            self.ks.ssl_keystore_active = path
             PKCS12CreateKeystore(
-                self.get_ssl_keystore(),
+                path,
                 self.ks.ks_password,
                 self.get_ssl_cert(),
                 self.get_ssl_key(),
                 user=self.config["user"],
                 group=self.config["group"],
                 mode=0o640,
-                openssl_chain_path="/tmp/" + filename + ".chain",
-                openssl_key_path="/tmp/" + filename + ".key",
-                openssl_p12_path="/tmp/" + filename + ".p12",
                 ks_regenerate=self.config.get(
                                   "regenerate-keystore-truststore", False))
 
@@ -633,7 +1469,8 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                 "/snap/kafka/current/jar/"
         # Install packages will install snap in this case
         super().install_packages('openjdk-11-headless', packages)
-        self._on_config_changed(event)
+        self._pregenerate_keys()
+        self._mark_dirty(event)
 
     def _check_if_ready_to_start(self, ctx):
         """Check if restart event is necessary.
@@ -706,6 +1543,104 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         # management through this getters
         raise Exception("Not Implemented Yet")
 
+    @profiled("sync-listeners")
+    def _sync_listeners(self, listeners):
+        """Applies the listener settings kept outside of server.properties.
+
+        Runs on every render of server.properties, even if it is up-to-date:
+        the peers' listener template, the truststores, the ports and the
+        NRPE checks also depend on data that does not change it, e.g. a new
+        client certificate published on the listeners relation.
+        """
+        if self.unit.is_leader():
+            # update peers
+            self.cluster.set_listeners(listeners)
+        self._manage_listener_certs()
+        if not listeners:
+            return
+        # Now, open the ports
+        prts = []
+        e_lst = self.listener._convert_listener_template(
+            listeners,
+            internal_extra_binding=self._reconcile_extra_biding(
+                "internal-listener"),
+            external_extra_binding=self._reconcile_extra_biding(
+                "external-listener", ingress=False),
+            cluster_binding=self.cluster.binding_addr)
+        for k, v in e_lst.items():
+            open_port(v["port"])
+            prts.append(v["port"])
+        self.ks.ports = prts
+        # Update NRPE endpoints
+        endpoints = \
+            [v["endpoint"].split("://")[1] for k, v in e_lst.items()]
+        self.nrpe.recommit_checks(
+            svcs=[],
+            endpoints=endpoints
+        )
+        # This is used in the restart logic
+        self.ks.endpoints = endpoints
+        self.ks.tls_endpoints = [
+            v["endpoint"].split("://")[1] for k, v in e_lst.items()
+            if v["secprot"] in ["SSL", "SASL_SSL"]]
+        if "broker" in e_lst:
+            self.ks.bootstrap_server = \
+                e_lst["broker"]["endpoint"].split("://")[1]
+
+    def _render_server_properties(self, event):
+        """Renders server.properties if any of its inputs changed.
+
+        Returns the options rendered, or None if not possible yet.
+        """
+        server_opts, changed = self.reconciler.reconcile(
+            "server.properties",
+            inputs=self._server_properties_inputs(),
+            build=lambda: self._generate_server_properties(event),
+            targets=[self.config["filepath-server-properties"]])
+        if not changed:
+            # Recover the listeners found on the last render, they are
+            # used to update the bootstrap data on the restart event.
+            self.listener_info = self.ks.listener_info or None
+            self._sync_listeners(self.listener_info)
+        return server_opts
+
+    def _render_service_override(self, override_target=None):
+        """Renders the service override.conf if any of its inputs changed.
+
+        Returns the options rendered.
+        """
+        override_target = override_target or "/etc/systemd/system/" + \
+            "{}.service.d/override.conf".format(self.service)
+        if self.distro == "apache_snap":
+            jmx_file_name = "/var/snap/kafka/common/prometheus.yaml"
+            override_args = {
+                "target": override_target,
+                "jmx_jar_folder": "/snap/kafka/current/jar/",
+                "jmx_file_name": jmx_file_name
+            }
+        else:
+            jmx_file_name = "/opt/prometheus/prometheus.yaml"
+            override_args = {"target": override_target}
+        svc_opts, _ = self.reconciler.reconcile(
+            "override.conf",
+            inputs={
+                "config": self._config_inputs(
+                    SERVICE_OVERRIDE_CONFIG_INPUTS),
+                "is_ssl_enabled": self.is_ssl_enabled(),
+                "is_sasl_enabled": self.is_sasl_enabled(),
+                "is_jolokia_enabled": self.is_jolokia_enabled(),
+                "is_jmxexporter_enabled": self.is_jmxexporter_enabled(),
+            },
+            build=lambda: self.render_service_override_file(
+                **override_args),
+            targets=[override_target] + (
+                [jmx_file_name] if self.is_jmxexporter_enabled() else []))
+        # Reload service only if the override file content has changed
+        if file_changed(override_target):
+            daemon_reload()
+        return svc_opts
+
+    @profiled("server-properties")
     def _generate_server_properties(self, event):
         self.model.unit.status = \
             MaintenanceStatus("Starting server.properties")
@@ -720,12 +1655,8 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         logger.info("Selected {} for "
                     "log.dirs".format(server_props["log.dirs"]))
 
-        if len(self.ks.rack_id) > 0:
-            server_props["broker.rack"] = self.ks.rack_id
-        elif (os.environ.get("JUJU_AVAILABILITY_ZONE", None) and
-                self.config.get("customize-failure-domain", False)):
-            server_props["broker.rack"] = \
-                os.environ.get("JUJU_AVAILABILITY_ZONE")
+        if self._broker_rack():
+            server_props["broker.rack"] = self._broker_rack()
             logger.info("Failure domains enabled, broker.rack={}".format(
                 server_props["broker.rack"]))
         # Resolve replication factors
@@ -769,7 +1700,11 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             super_user_list = ["User:" + str(get_hostname(self.cluster.binding_addr))]
             super_user_list.extend(["User:" + str(get_hostname(p)) for p in self.cluster.peer_addresses])
             if len(self.framework.model.relations["certificates"]) > 0 and len(list(self.framework.model.relations['certificates'][0].units)) > 0:
-                super_user_list.append("User:" + str(get_hostname(self.framework.model.relations["certificates"][0].data[list(self.framework.model.relations['certificates'][0].units)[0]]["ingress-address"])))
+                crt_rel = self.framework.model.relations["certificates"][0]
+                crt_data = self.relation_data.databag(
+                    crt_rel, list(crt_rel.units)[0])
+                super_user_list.append("User:" + str(
+                    get_hostname(crt_data["ingress-address"])))
             server_props["super.users"] = ";".join(super_user_list)
 
 
@@ -792,8 +1727,6 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         #     b711fc9e3b43d2069a9ac8b13177e7f2a07c7bfb/VARIABLES.md
         # server_props["kafka_broker_rest_proxy_enabled"] = False
 
-        self._manage_listener_certs()
-
         # Metadata service relation
         if self.mds.relations and self.distro != "confluent":
             raise KafkaBrokerCharmMDSNotSupportedError(self.distro)
@@ -809,15 +1742,16 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
 
             # In case LDAP is configured, MDS endpoints need to be shared.
             # Publish the endpoints to the cluster units:
-            cluster_data = self.cluster.relation.data
-            cluster_data[self.unit]["mds_url"] = \
-                server_props["confluent.metadata.server.advertised.listeners"]
+            cluster_rel = self.cluster.relation
+            self.relation_data.set(
+                cluster_rel, self.unit, "mds_url",
+                server_props["confluent.metadata.server.advertised.listeners"])
             # Now read each of the units' in the cluster relation
             # Inform listener requirers of MDS endpoint
             self.listener.set_mds_endpoint(
                 ",".join(
-                    [cluster_data[u]["mds_url"]
-                     for u in self.cluster.relation.units]),
+                    [self.relation_data.databag(cluster_rel, u)["mds_url"]
+                     for u in cluster_rel.units]),
                 self.config["mds_user"], self.config["mds_password"]
             )
             # Finish MDS configuration
@@ -826,7 +1760,7 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                              "server.ssl.key.password"] = self.ks.ks_password
                 server_props["confluent.metadata."
                              "server.ssl.keystore.location"] = \
-                    self.get_ssl_keystore()
+                    self.get_ssl_keystore_location()
                 server_props["confluent.metadata."
                              "server.ssl.keystore.password"] = \
                     self.ks.ks_password
@@ -858,7 +1792,7 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             # Listener logic
             # Convert it to dict and then back to string after the loop below
             listeners_d = json.loads(self.listener.get_unit_listener(
-                self.get_ssl_keystore(),
+                self.get_ssl_keystore_location(),
                 self.ks.ks_password,
                 get_default=True,
                 clientauth=self.config.get("clientAuth", False)))
@@ -901,41 +1835,21 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             listeners = json.dumps(listeners_d)
             logger.debug("Listener changed auth"
                          "methods to: {}".format(listeners))
-            # update peers
-            self.cluster.set_listeners(listeners)
         else:
             listeners = self.cluster.get_listener_template()
         listener_opts = self.listener._generate_opts(
             listeners,
-            self.get_ssl_keystore(),
+            self.get_ssl_keystore_location(),
             self.ks.ks_password,
             self.config["oauth-public-key-path"],
             get_default=True,
             clientauth=self.config.get("clientAuth", False),
             internal_extra_binding=self._reconcile_extra_biding("internal-listener"),
             external_extra_binding=self._reconcile_extra_biding("external-listener", ingress=False),
-            cluster_binding=self.cluster.binding_addr)
+            cluster_binding=self.cluster.binding_addr,
+            ssl_opts=self._tls_profile_opts())
 
-        # Now, open the ports
-        prts = []
-        e_lst = self.listener._convert_listener_template(
-            listeners,
-            internal_extra_binding=self._reconcile_extra_biding("internal-listener"),
-            external_extra_binding=self._reconcile_extra_biding("external-listener", ingress=False),
-            cluster_binding=self.cluster.binding_addr)
-        for k, v in e_lst.items():
-            open_port(v["port"])
-            prts.append(v["port"])
-        self.ks.ports = prts
-        # Update NRPE endpoints
-        endpoints = \
-            [v["endpoint"].split("://")[1] for k, v in e_lst.items()]
-        self.nrpe.recommit_checks(
-            svcs=[],
-            endpoints=endpoints
-        )
-        # This is used in the restart logic
-        self.ks.endpoints = endpoints
+        self._sync_listeners(listeners)
 
         if len(self.listener.get_sasl_mechanisms_list()) > 0:
             server_props["sasl.enabled.mechanisms"] = ",".join(
@@ -947,8 +1861,14 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                     listeners["broker"]["SASL"]
 
         self.listener_info = listeners
+        self.ks.listener_info = listeners
         logger.debug("Found listeners: {}".format(listeners))
         server_props = {**server_props, **listener_opts}
+        # Only offer the cipher suites that match the certificate's key
+        if any(k.endswith(".ssl.keystore.location") for k in listener_opts):
+            suites = cipher_suites_for_cert(self.get_ssl_cert())
+            if suites:
+                server_props["ssl.cipher.suites"] = ",".join(suites)
 
         # Zookeeper options:
         self.model.unit.status = \
@@ -1024,6 +1944,10 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
             # -changed event will rerun config_changed logic.
             self.model.unit.status = BlockedStatus(str(e))
             return
+        # Kafka only accepts passwords through kafka-configs, e.g. the
+        # keystore password of a listener added without restart, if set
+        server_props["password.encoder.secret"] = \
+            self.ks.password_encoder_secret
         logger.debug("Finished server.properties, options: "
                      "{}".format(",".join(server_props)))
         # Back to server.properties, render it
@@ -1120,10 +2044,10 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
 }};
 """.format(self.keytab, self.kerberos_principal) # noqa
         self.set_folders_and_permissions([os.path.dirname(jaas_file)])
-        with open(jaas_file, "w") as f:
-            f.write(content)
-        setFilePermissions(jaas_file, self.config.get("user", "root"),
-                           self.config.get("group", "root"), 0o640)
+        write_file(jaas_file, content,
+                   owner=self.config.get("user", "root"),
+                   group=self.config.get("group", "root"),
+                   perms=0o640)
         return content
 
     def _render_kafka_log4j_properties(self):
@@ -1147,6 +2071,92 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
                })
         return root_logger
 
+    def _on_upgrade_charm(self, event):
+        """Templates may change across charm revisions, rebuild all."""
+        self.reconciler.invalidate()
+        self._mark_dirty(event)
+
+    def _config_inputs(self, keys):
+        """Returns the values of a list of config options."""
+        return {k: self.config.get(k) for k in keys}
+
+    def _relation_inputs(self, relation_name, exclude=None):
+        """Returns the content of the databags of a given relation.
+
+        This unit's own databag is not considered, as it is written by the
+        charm itself while rendering the artifacts.
+
+        exclude: optional, keys to be ignored, e.g. the restart bookkeeping
+        """
+        exclude = set(exclude or [])
+        result = {}
+        for r in self.model.relations[relation_name]:
+            bags = {}
+            for u in r.units:
+                if u == self.unit:
+                    continue
+                bags[u.name] = self.relation_data.databag(r, u)
+            if r.app:
+                bags[r.app.name] = self.relation_data.databag(r, r.app)
+            result[str(r.id)] = {
+                name: {k: v for k, v in bag.items() if k not in exclude}
+                for name, bag in bags.items()}
+        return result
+
+    def _cert_inputs(self):
+        """Returns the fingerprints of all the certs and keys in use."""
+        return {
+            "ssl_crt": fingerprint(self.get_ssl_cert()),
+            "ssl_key": fingerprint(self.get_ssl_key()),
+            "zk_crt": fingerprint(self.get_zk_cert()),
+            "zk_key": fingerprint(self.get_zk_key()),
+            "extra_cas": fingerprint(sorted(self.ks.ssl_certs)),
+        }
+
+    def _server_properties_inputs(self):
+        """Inputs of server.properties and the truststores it manages."""
+        return {
+            "config": dict(self.config),
+            "relations": {
+                # The restart scheduler writes on the cluster relation
+                # during a rollout, none of it is rendered
+                r: self._relation_inputs(
+                    r, exclude=SCHEDULER_KEYS if r == "cluster" else None)
+                for r in SERVER_PROPERTIES_RELATION_INPUTS
+            },
+            "certificates": self._cert_inputs(),
+            "ssl_keystore": self.get_ssl_keystore_location(),
+            "passwords": fingerprint([
+                self.ks.ks_password, self.ks.ts_password,
+                self.ks.ks_zookeeper_pwd, self.ks.ts_zookeeper_pwd,
+                self.ks.password_encoder_secret]),
+            "is_leader": self.unit.is_leader(),
+            "rack_id": self.ks.rack_id,
+            "az": os.environ.get("JUJU_AVAILABILITY_ZONE", None),
+            "log_dirs": self.sm.lst_volumes(),
+            "bindings": [
+                self.ks.internal_listener, self.ks.external_listener,
+                self.cluster.binding_addr, self.listener.binding_addr,
+                self.listener.advertise_addr, self.zk.binding_addr
+            ],
+        }
+
+    def _check_binding_changes(self):
+        """Drops the cached hostnames if any binding address changed."""
+        bindings = json.dumps({
+            "cluster": self.cluster.binding_addr,
+            "listeners": self.listener.binding_addr,
+            "listeners_advertise": self.listener.advertise_addr,
+            "zookeeper": self.zk.binding_addr,
+            "internal": self.ks.internal_listener,
+            "external": self.ks.external_listener
+        }, sort_keys=True)
+        if self.ks.binding_addrs != bindings:
+            logger.debug("Binding addresses changed, clean hostname cache")
+            invalidate_hostname_cache()
+            self.ks.binding_addrs = bindings
+
+    @profiled("config-changed")
     def _on_config_changed(self, event):
         """Do the configuration change.
 
@@ -1163,30 +2173,43 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         ctx = {}
 
         logger.debug("Event triggered config change: {}".format(event))
+        self._check_binding_changes()
         # 1) Check Kerberos and ZK
-        try:
-            if self.is_sasl_kerberos_enabled() and not self.keytab:
+        with self.profiler.stage("check-kerberos-zk"):
+            try:
+                if self.is_sasl_kerberos_enabled() and not self.keytab:
+                    self.model.unit.status = \
+                        BlockedStatus("Kerberos set, waiting for keytab "
+                                      "upload action")
+                    # We can drop this event given that an action will happen
+                    # or a config change
+                    return
+            except KafkaCharmBaseMissingConfigError as e:
+                # This error is raised if some but not all the configs
+                # needed for Kerberos were enabled
                 self.model.unit.status = \
-                    BlockedStatus("Kerberos set, waiting for keytab "
-                                  "upload action")
-                # We can drop this event given that an action will happen
-                # or a config change
+                    BlockedStatus("Kerberos config missing: {}".format(str(e)))
+                return
+            parent_config, _ = self.reconciler.reconcile(
+                "kerberos",
+                inputs={
+                    "config": self._config_inputs(KERBEROS_CONFIG_INPUTS),
+                    "keytab": self.keytab,
+                    "zookeeper": self._relation_inputs("zookeeper"),
+                },
+                build=lambda: super(KafkaBrokerCharm, self)._on_config_changed(
+                    event),
+                targets=["/etc/krb5.conf", self.config["filepath-jaas-conf"]]
+                if self.is_sasl_kerberos_enabled() else [])
+            if not self.zk.relation:
+                # It does not make sense to progress until zookeeper is set
+                self.model.unit.status = \
+                    BlockedStatus("Waiting for Zookeeper")
                 return
-        except KafkaCharmBaseMissingConfigError as e:
-            # This error is raised if some but not all the configs needed for
-            # Kerberos were enabled
-            self.model.unit.status = \
-                BlockedStatus("Kerberos config missing: {}".format(str(e)))
-            return
-        parent_config = super()._on_config_changed(event)
-        if not self.zk.relation:
-            # It does not make sense to progress until zookeeper is set
-            self.model.unit.status = \
-                BlockedStatus("Waiting for Zookeeper")
-            return
 
         # 2) Manage the volumes
-        self.manage_volumes()
+        with self.profiler.stage("manage-volumes"):
+            self.manage_volumes()
 
         # 3) Generate Keystores
         self.model.unit.status = \
@@ -1195,79 +2218,142 @@ class KafkaBrokerCharm(KafkaJavaCharmBase):
         self.model.unit.status = \
             MaintenanceStatus("Render server.properties")
         # 4) Manage AZs
-        self.cluster.enable_az = self.config.get(
-            "customize-failure-domain", False)
+        with self.profiler.stage("manage-azs"):
+            self.cluster.enable_az = self.config.get(
+                "customize-failure-domain", False)
 
         # 5) Generate the config files
-        try:
-            server_opts = self._generate_server_properties(event)
-        except KafkaRelationBaseNotUsedError:
+        with self.profiler.stage("render-config"):
+            try:
+                server_opts = self._render_server_properties(event)
+            except KafkaRelationBaseNotUsedError:
+                self.model.unit.status = \
+                    BlockedStatus("Relation not ready yet")
+                return
+            except KafkaListenerRelationEmptyListenerDictError:
+                logger.info("Listener info not published, deferring event")
+                return
             self.model.unit.status = \
-                BlockedStatus("Relation not ready yet")
-            return
-        except KafkaListenerRelationEmptyListenerDictError:
-            logger.info("Listener info not published, deferring event")
-            return
-        self.model.unit.status = \
-            MaintenanceStatus("Render client properties")
-        client_opts = self._generate_client_properties()
-        self.model.unit.status = \
-            MaintenanceStatus("Render service override.conf")
-        if self.distro == "apache_snap":
-            svc_opts = self.render_service_override_file(
-                target="/etc/systemd/system/"
-                       "{}.service.d/override.conf".format(self.service),
-                jmx_jar_folder="/snap/kafka/current/jar/",
-                jmx_file_name="/var/snap/kafka/common/prometheus.yaml")
-        else:
-            svc_opts = self.render_service_override_file(
-                target="/etc/systemd/system/"
-                       "{}.service.d/override.conf".format(self.service))
-        # Reload service
-        daemon_reload()
-
-        log4j_opts = self._render_kafka_log4j_properties()
-
-        ctx = hashlib.md5(json.dumps({
-            "init_config": parent_config,
-            "server_opts": server_opts,
-            "log4j_opts": log4j_opts,
-            "svc_opts": svc_opts,
-            "client_opts": client_opts,
-            "keytab_opts": self.keytab_b64,
-            "certificates": {
-                "ssl_crt": self.get_ssl_cert(),
-                "ssl_key": self.get_ssl_key(),
-                "ssl_ks": self.get_ssl_keystore(),
-                "ssl_ts": self.get_ssl_truststore(),
-                "zk_crt": self.get_zk_cert(),
-                "zk_key": self.get_zk_key(),
-                "zk_ks": self.get_zk_keystore(),
-                "zk_ts": self.get_zk_truststore(),
-            }
-        }).encode('utf-8')).hexdigest()
+                MaintenanceStatus("Render client properties")
+            client_opts, _ = self.reconciler.reconcile(
+                "client.properties",
+                inputs={
+                    "config": self._config_inputs(
+                        CLIENT_PROPERTIES_CONFIG_INPUTS),
+                    "keytab": self.keytab,
+                    "ts_password": fingerprint(self.ks.ts_password),
+                    "zookeeper": self._relation_inputs("zookeeper"),
+                },
+                build=self._generate_client_properties,
+                targets=[self.config["filepath-kafka-client-properties"]])
+            self.model.unit.status = \
+                MaintenanceStatus("Render service override.conf")
+            svc_opts = self._render_service_override()
+
+            log4j_opts, _ = self.reconciler.reconcile(
+                "log4j.properties",
+                inputs=self._config_inputs(LOG4J_CONFIG_INPUTS),
+                build=self._render_kafka_log4j_properties,
+                targets=[self.config["filepath-log4j-properties"]])
 
         # 6) Restart Strategy
         # Now, service is operational. Restart service with an event to
         # avoid any conflicts with other running units.
-        self.model.unit.status = \
-            MaintenanceStatus("Building context...")
-        logger.debug("Context: {}, saved state is: {}".format(
-            ctx, self.ks.config_state))
+        with self.profiler.stage("restart-strategy"):
+            logger.debug("Files changed on this hook: {}".format(
+                get_changed_files()))
+            # The listeners' cert, key and keystore are accounted apart:
+            # if only them changed, try to apply them without a restart.
+            tls_keys, tls_state = self._tls_material(server_opts)
+            # server.properties changes are classified per dynamic update
+            # mode: only read-only changes need a restart, the others are
+            # applied to the running broker. Listeners added or removed,
+            # e.g. for a new listeners relation, are applied as well.
+            props = {k: v for k, v in (server_opts or {}).items()
+                     if k not in tls_keys}
+            restart_props = json.loads(
+                self.ks.server_props_restart or "null") or props
+            last_props = json.loads(
+                self.ks.server_props or "null") or restart_props
+            # The ZooKeeper client settings are accounted apart, with the
+            # certificate used against ZooKeeper, see _zk_client_state
+            zk_state = self.ks.zk_client_state
+            # server.properties is not rendered while blocked, e.g. waiting
+            # for relations: keep the last render as the baseline
+            if server_opts is not None:
+                zk_state = self._zk_client_state(server_opts)
+                inter_broker = props.get(
+                    "inter.broker.listener.name", "BROKER")
+                changes = classify_changes(
+                    last_props, props,
+                    exclude=[k for k in set(last_props) | set(props)
+                             if k.startswith("zookeeper.")],
+                    inter_broker_listener=inter_broker)
+                if changes[READ_ONLY] or \
+                   ((changes[PER_BROKER] or changes[CLUSTER_WIDE] or
+                     changes[LISTENERS]) and
+                        not self._apply_dynamic_configs(
+                            changes, server_opts,
+                            listeners=listener_changes(
+                                last_props, props, inter_broker))):
+                    restart_props = props
+
+            def _ctx(tls_restart_state):
+                return hashlib.md5(json.dumps({
+                    "init_config": parent_config,
+                    "server_opts": {
+                        k: v for k, v in restart_props.items()
+                        if not k.startswith("zookeeper.")},
+                    "zookeeper": zk_state,
+                    "log4j_opts": log4j_opts,
+                    "svc_opts": svc_opts,
+                    "client_opts": client_opts,
+                    "keytab_opts": self.keytab_b64,
+                    "certificates": {
+                        "ssl_ks": self.get_ssl_keystore(),
+                        "ssl_ts": self.get_ssl_truststore(),
+                        "zk_crt": self.get_zk_cert(),
+                        "zk_key": self.get_zk_key(),
+                        "zk_ks": self.get_zk_keystore(),
+                        "zk_ts": self.get_zk_truststore(),
+                    },
+                    "tls": tls_restart_state
+                }).encode('utf-8')).hexdigest()
+
+            if tls_state != self.ks.tls_state:
+                if not self._rotate_tls_dynamically(
+                        server_opts, tls_keys,
+                        _ctx(self.ks.tls_restart_state)):
+                    # Fallback to a restart
+                    self.ks.tls_restart_state = tls_state
+                self.ks.tls_state = tls_state
+            ctx = _ctx(self.ks.tls_restart_state)
+            if self.ks.zk_client_state and \
+               zk_state != self.ks.zk_client_state:
+                logger.info("ZooKeeper client settings changed, restart")
+            self.ks.zk_client_state = zk_state
+            if server_opts is not None:
+                self.ks.server_props = json.dumps(props)
+                self.ks.server_props_restart = json.dumps(restart_props)
 
-        if self._check_if_ready_to_start(ctx):
-            self.on.restart_event.emit(ctx, services=self.services)
-            self.ks.need_restart = True
-            self.model.unit.status = \
-                BlockedStatus("Waiting for restart event")
-        elif service_running(self.service):
-            self.model.unit.status = \
-                ActiveStatus("Service is running")
-        else:
             self.model.unit.status = \
-                BlockedStatus("Service not running that "
-                              "should be: {}".format(self.services))
-        self.ks.config_state = ctx
+                MaintenanceStatus("Building context...")
+            logger.debug("Context: {}, saved state is: {}".format(
+                ctx, self.ks.config_state))
+
+            if self._check_if_ready_to_start(ctx):
+                self.on.restart_event.emit(ctx, services=self.services)
+                self.ks.need_restart = True
+                self.model.unit.status = \
+                    BlockedStatus("Waiting for restart event")
+            elif service_running(self.service):
+                self.model.unit.status = \
+                    ActiveStatus("Service is running")
+            else:
+                self.model.unit.status = \
+                    BlockedStatus("Service not running that "
+                                  "should be: {}".format(self.services))
+            self.ks.config_state = ctx
 
 
 if __name__ == "__main__":
@@ -60,17 +60,11 @@ class KafkaBrokerCluster(KafkaRelationBase):
                      ssl_cert):
         """Pass the unit certificate via relation."""
         if self.relation:
-            if ssl_cert != self.relation.data[self.unit].get("cert", ""):
-                self.relation.data[self.unit]["cert"] = ssl_cert
+            self.relation_data.set(self.relation, self.unit, "cert", ssl_cert)
 
     def get_all_certs(self):
         """Capture all certificates from units."""
-        crt_list = []
-        for r in self.relations:
-            for u in r.units:
-                if "cert" in r.data[u]:
-                    crt_list.append(r.data[u]["cert"])
-        return crt_list
+        return self.relation_data.values(self.relations, "cert")
 
     @property
     def truststore_pwd(self):
@@ -85,11 +79,12 @@ class KafkaBrokerCluster(KafkaRelationBase):
     def _get_all_tls_certs(self):
         """Get TLS certificates published on "cert" relation."""
         crt_list = []
+        data = self.relation_data
         # Cluster relation uses "cert" tag instead of "tls_cert"
         for u in self.relation.units:
-            if "tls_cert" in self.relation.data[u] or \
-               "cert" in self.relation.data[u]:
-                crt_list.append(self.relation.data[u]["cert"])
+            bag = data.databag(self.relation, u)
+            if "tls_cert" in bag or "cert" in bag:
+                crt_list.append(bag["cert"])
         super()._get_all_tls_cert(crt_list)
 
     @property
@@ -112,13 +107,14 @@ class KafkaBrokerCluster(KafkaRelationBase):
         """If leader, transfers the listener template to each peer unit."""
         if not self.unit.is_leader() or not self.relation:
             return
-        if listeners != self.relation.data[
-           self.model.app].get("listeners", "{}"):
-            self.relation.data[self.model.app]["listeners"] = listeners
+        if listeners != self.get_listener_template():
+            self.relation_data.set(
+                self.relation, self.model.app, "listeners", listeners)
 
     def get_listener_template(self):
         """Get the listener template."""
-        return self.relation.data[self.model.app].get("listeners", "{}")
+        return self.relation_data.get(
+            self.relation, self.model.app, "listeners", "{}")
 
     @property
     def is_joined(self):
@@ -138,9 +134,10 @@ class KafkaBrokerCluster(KafkaRelationBase):
         """Recover the certificates and checks AZ per unit."""
         self._get_all_tls_certs()
         if self.enable_az:
-            self.relation.data[self.unit]["az"] = \
-                os.environ.get("JUJU_AVAILABILITY_ZONE")
+            self.relation_data.set(
+                self.relation, self.unit, "az",
+                os.environ.get("JUJU_AVAILABILITY_ZONE"))
             az_set = set()
             for u in self.relation.units:
-                az_set.add(self.relation.data[u]["az"])
+                az_set.add(self.relation_data.databag(self.relation, u)["az"])
             self.state.peer_num_azs = len(az_set)
@@ -38,6 +38,7 @@ listener.name.internal.ssl.keystore.location=/var/ssl/private/ssl-ks.jks
 listener.name.internal.ssl.keystore.password=confluentkeystorepass
 listener.name.internal.ssl.client.auth=none
 listener.name.internal.ssl.key.password=confluentkeystorepass
+ssl.cipher.suites=TLS_AES_128_GCM_SHA256,TLS_AES_256_GCM_SHA384,TLS_CHACHA20_POLY1305_SHA256,TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256,TLS_ECDHE_RSA_WITH_AES_256_GCM_SHA384,TLS_ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256
 listeners=INTERNAL://vm.maas:9092,EXTERNAL://vm.maas:9093,BROKER://vm.maas:9094
 listener.security.protocol.map=internal:SSL,external:SSL,broker:SSL
 advertised.listeners=INTERNAL://vm.maas:9092,EXTERNAL://vm.maas:9093,BROKER://vm.maas:9094
@@ -50,6 +51,7 @@ zookeeper.ssl.keystore.location=/var/ssl/private/zk-ks.jks
 zookeeper.ssl.keystore.password=confluentkeystorepass
 zookeeper.ssl.truststore.location=/var/ssl/private/zk-ts.jks
 zookeeper.ssl.truststore.password=confluentkeystorepass
+password.encoder.secret=confluentkeystorepass
 """ # noqa
 
 SERVER_PROPS_LISTENERS="""group.initial.rebalance.delay.ms=3000
@@ -92,6 +94,7 @@ listener.name.internal.ssl.keystore.location=/var/ssl/private/ssl-ks.jks
 listener.name.internal.ssl.keystore.password=confluentkeystorepass
 listener.name.internal.ssl.client.auth=none
 listener.name.internal.ssl.key.password=confluentkeystorepass
+ssl.cipher.suites=TLS_AES_128_GCM_SHA256,TLS_AES_256_GCM_SHA384,TLS_CHACHA20_POLY1305_SHA256,TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256,TLS_ECDHE_RSA_WITH_AES_256_GCM_SHA384,TLS_ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256
 listener.name.kafka_connect.ssl.client.auth=none
 listener.name.kafka_connect.ssl.key.password=confluentkeystorepass
 listener.name.kafka_connect.ssl.keystore.location=/var/ssl/private/ssl-ks.jks
@@ -116,4 +119,5 @@ zookeeper.ssl.keystore.location=/var/ssl/private/zk-ks.jks
 zookeeper.ssl.keystore.password=confluentkeystorepass
 zookeeper.ssl.truststore.location=/var/ssl/private/zk-ts.jks
 zookeeper.ssl.truststore.password=confluentkeystorepass
+password.encoder.secret=confluentkeystorepass
 """ # noqa
\ No newline at end of file
@@ -4,13 +4,17 @@
 """Unit test for Kafka broker charm."""
 
 import os
+import json
 import unittest
 import shutil
-from mock import patch
+import tempfile
+from mock import Mock, patch
 from mock import PropertyMock
 import base64
 
 from ops.testing import Harness
+from ops.framework import BoundEvent
+from ops.model import ActiveStatus, BlockedStatus
 import charm as charm
 import cluster as cluster
 
@@ -305,6 +309,8 @@ class TestCharm(unittest.TestCase):
         # certificate events, then cluster-* will be deferred.
         # Run reemit to ensure they are run.
         kafka.framework.reemit()
+        # config-changed logic runs once, when the framework commits
+        kafka.framework.commit()
         args, kwargs = mock_render.call_args_list[-3]
         # Check server.properties rendering
         server_properties = SERVER_PROPS.split("\n")
@@ -313,6 +319,11 @@ class TestCharm(unittest.TestCase):
             kwargs["context"], templ_file="server.properties.j2").split("\n")
         render_server_props.sort()
         self.assertEqual(server_properties, render_server_props)
+        # Needed to add listeners with passwords without a restart
+        self.assertIn("password.encoder.secret=confluentkeystorepass",
+                      render_server_props)
+        self.assertEqual("confluentkeystorepass",
+                         kafka.ks.password_encoder_secret)
         # Assert client.properties was correctly rendered
         mock_render.assert_any_call(
             source='client.properties.j2',
@@ -551,6 +562,8 @@ class TestCharm(unittest.TestCase):
         # certificate events, then cluster-* will be deferred.
         # Run reemit to ensure they are run.
         kafka.framework.reemit()
+        # config-changed logic runs once, when the framework commits
+        kafka.framework.commit()
         args, kwargs = mock_render.call_args_list[-3]
         # Check server.properties rendering
         server_properties = SERVER_PROPS_LISTENERS.split("\n")
@@ -589,3 +602,564 @@ class TestCharm(unittest.TestCase):
                 '/var/ssl/private/zk-ts.jks',
                 'zookeeper.ssl.truststore.password': 'confluentkeystorepass'}}
         )
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm.KafkaBrokerCharm, "_on_config_changed")
+    @patch.object(charm, "reset_changed_files")
+    def test_single_reconcile_per_dispatch(self,
+                                           mock_reset_changed_files,
+                                           mock_config_changed,
+                                           mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        # Several handlers request the config-changed logic
+        kafka.on.config_changed.emit()
+        kafka.on.config_changed.emit()
+        kafka.on.upgrade_charm.emit()
+        mock_config_changed.assert_not_called()
+        # Runs once, at the end of the dispatch
+        kafka.framework.commit()
+        mock_config_changed.assert_called_once()
+        mock_reset_changed_files.assert_called_once()
+        # Nothing else requested, does not run again
+        kafka.framework.commit()
+        mock_config_changed.assert_called_once()
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(kafka.KafkaJavaCharmBaseNRPEMonitoring, "recommit_checks")
+    @patch.object(charm, "open_port")
+    @patch.object(kafka_listener.KafkaListenerProvidesRelation,
+                  "_convert_listener_template")
+    @patch.object(charm.KafkaBrokerCharm, "_reconcile_extra_biding")
+    @patch.object(charm.KafkaBrokerCharm, "_manage_listener_certs")
+    @patch.object(charm.KafkaBrokerCharm, "_generate_server_properties")
+    @patch.object(charm.KafkaBrokerCharm, "_server_properties_inputs")
+    def test_sync_listeners_on_every_render(self,
+                                            mock_inputs,
+                                            mock_generate,
+                                            mock_manage_listener_certs,
+                                            mock_reconcile_binding,
+                                            mock_convert_template,
+                                            mock_open_port,
+                                            mock_recommit_checks,
+                                            mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        mock_inputs.return_value = {"config": {}}
+        mock_reconcile_binding.return_value = None
+        mock_convert_template.return_value = {
+            "broker": {"port": 9092, "secprot": "SSL",
+                       "endpoint": "BROKER://broker-0:9092"}}
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        target = os.path.join(tmp_dir, "server.properties")
+        harness.update_config({"filepath-server-properties": target})
+        harness.begin()
+        kafka = harness.charm
+        listeners = '{"broker": {}}'
+
+        def _generate(event):
+            kafka.ks.listener_info = listeners
+            kafka._sync_listeners(listeners)
+            open(target, "w").close()
+            return {"log.dirs": "/var/lib/kafka"}
+        mock_generate.side_effect = _generate
+        self.assertEqual({"log.dirs": "/var/lib/kafka"},
+                         kafka._render_server_properties(None))
+        # A new client certificate arrives on the listeners relation:
+        # server.properties is unchanged, but the truststore is updated
+        with harness.hooks_disabled():
+            rel_id = harness.add_relation("listeners", "app")
+            harness.add_relation_unit(rel_id, "app/0")
+            harness.update_relation_data(
+                rel_id, "app/0", {"tls_cert": "crt"})
+        kafka.ks.bootstrap_server = ""
+        self.assertEqual({"log.dirs": "/var/lib/kafka"},
+                         kafka._render_server_properties(None))
+        mock_generate.assert_called_once()
+        self.assertEqual(2, mock_manage_listener_certs.call_count)
+        self.assertEqual(listeners, kafka.listener_info)
+        mock_open_port.assert_called_with(9092)
+        mock_recommit_checks.assert_called_with(
+            svcs=[], endpoints=["broker-0:9092"])
+        self.assertEqual("broker-0:9092", kafka.ks.bootstrap_server)
+        self.assertEqual(["broker-0:9092"], kafka.ks.tls_endpoints)
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm, "daemon_reload")
+    @patch.object(charm.KafkaBrokerCharm, "render_service_override_file")
+    def test_tls_profile_renders_override(self,
+                                          mock_render_override,
+                                          mock_daemon_reload,
+                                          mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        target = os.path.join(tmp_dir, "override.conf")
+
+        def _render(target, **kwargs):
+            open(target, "w").close()
+            return {"KAFKA_OPTS": "tls-profile"}
+        mock_render_override.side_effect = _render
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        kafka._render_service_override(target)
+        kafka._render_service_override(target)
+        mock_render_override.assert_called_once()
+        # Each TLS performance option rewrites override.conf
+        harness.update_config({"tls-performance-profile": True})
+        kafka._render_service_override(target)
+        self.assertEqual(2, mock_render_override.call_count)
+        harness.update_config({"tls-session-cache-size": 4096})
+        kafka._render_service_override(target)
+        self.assertEqual(3, mock_render_override.call_count)
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm, "PKCS12CreateKeystore")
+    @patch.object(charm.KafkaBrokerCharm, "_on_config_changed")
+    def test_stable_keystore_passwords(self,
+                                       mock_config_changed,
+                                       mock_create_keystore,
+                                       mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        kafka.ks.ssl_cert, kafka.ks.ssl_key = "crt", "key"
+        kafka.ks.zk_cert, kafka.ks.zk_key = "zkcrt", "zkkey"
+        ks_pwd, ts_pwd = kafka.ks.ks_password, kafka.ks.ts_password
+        # Keystores regenerated, e.g. on cert renewal: same passwords
+        kafka._build_keystores()
+        kafka._build_keystores()
+        self.assertEqual(4, mock_create_keystore.call_count)
+        self.assertEqual(ks_pwd, kafka.ks.ks_password)
+        # Passwords only change through the action
+        harness.run_action("rotate-keystore-passwords")
+        self.assertNotEqual(ks_pwd, kafka.ks.ks_password)
+        self.assertEqual(ts_pwd, kafka.ks.ts_password)
+        self.assertEqual(6, mock_create_keystore.call_count)
+        kafka.framework.commit()
+        mock_config_changed.assert_called_once()
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm, "wait_for_certificate")
+    @patch.object(charm, "read_broker_id")
+    @patch.object(charm, "alter_broker_configs")
+    @patch.object(charm, "service_running")
+    @patch.object(charm.KafkaBrokerCharm, "get_ssl_cert")
+    def test_rotate_tls_dynamically(self,
+                                    mock_get_ssl_cert,
+                                    mock_service_running,
+                                    mock_alter_broker_configs,
+                                    mock_read_broker_id,
+                                    mock_wait_for_certificate,
+                                    mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        crt, _ = security.generateSelfSigned(
+            tmp_dir, "broker", key_algorithm="ecdsa-p256")
+        mock_get_ssl_cert.return_value = crt
+        mock_service_running.return_value = True
+        mock_read_broker_id.return_value = "1001"
+        mock_wait_for_certificate.return_value = True
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        kafka.ks.tls_state = "old"
+        kafka.ks.config_state = "ctx"
+        server_opts = {
+            "advertised.listeners":
+                "BROKER://broker-0:9092,EXTERNAL://broker-0.ext:9093",
+            "inter.broker.listener.name": "BROKER",
+            "log.dirs": "/var/lib/kafka",
+            "listener.name.broker.ssl.keystore.location": "/ks.1.jks",
+            "listener.name.external.ssl.keystore.location": "/ks.1.jks",
+        }
+        tls_keys = ["listener.name.broker.ssl.keystore.location",
+                    "listener.name.external.ssl.keystore.location"]
+        self.assertTrue(kafka._rotate_tls_dynamically(
+            server_opts, tls_keys, "ctx"))
+        mock_alter_broker_configs.assert_called_once()
+        self.assertEqual(
+            "broker-0:9092",
+            mock_alter_broker_configs.call_args[1]["bootstrap_server"])
+        self.assertEqual(2, mock_wait_for_certificate.call_count)
+        # Other changes pending: restart instead
+        self.assertFalse(kafka._rotate_tls_dynamically(
+            server_opts, tls_keys, "another-ctx"))
+        # New cert not served: restart instead
+        mock_wait_for_certificate.return_value = False
+        self.assertFalse(kafka._rotate_tls_dynamically(
+            server_opts, tls_keys, "ctx"))
+        # No parseable cert: restart, with no change on the broker
+        mock_get_ssl_cert.return_value = "not a cert"
+        mock_alter_broker_configs.reset_mock()
+        self.assertFalse(kafka._rotate_tls_dynamically(
+            server_opts, tls_keys, "ctx"))
+        mock_alter_broker_configs.assert_not_called()
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm.KafkaBrokerCharm, "get_ssl_keystore")
+    def test_keep_running_keystore(self,
+                                   mock_get_ssl_keystore,
+                                   mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        mock_get_ssl_keystore.return_value = os.path.join(tmp_dir, "ks.jks")
+        stores = {v: charm.versioned_store_path(
+                      mock_get_ssl_keystore.return_value, v)
+                  for v in ["a", "b", "c"]}
+        for path in stores.values():
+            open(path, "w").close()
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        # The rotation to "b" fell back to a restart still pending: the
+        # broker runs with "a" while "c" is built
+        kafka.ks.ssl_keystore_running = stores["a"]
+        kafka.ks.ssl_keystore_active = stores["b"]
+        kafka._remove_stale_keystores(stores["c"])
+        self.assertTrue(all(os.path.exists(p) for p in stores.values()))
+        # The restart loads "c", the older versions are removed
+        kafka.ks.ssl_keystore_active = stores["c"]
+        kafka._keystore_loaded()
+        self.assertEqual(stores["c"], kafka.ks.ssl_keystore_running)
+        self.assertEqual([stores["c"]],
+                         [p for p in stores.values() if os.path.exists(p)])
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm, "read_broker_id")
+    @patch.object(charm, "alter_broker_configs")
+    @patch.object(charm, "service_running")
+    def test_apply_dynamic_configs(self,
+                                   mock_service_running,
+                                   mock_alter_broker_configs,
+                                   mock_read_broker_id,
+                                   mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        mock_service_running.return_value = True
+        mock_read_broker_id.return_value = "1001"
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        kafka.ks.bootstrap_server = "broker-0:9092"
+        changes = charm.classify_changes(
+            {"num.io.threads": "8", "log.cleaner.threads": "1"},
+            {"num.io.threads": "16",
+             "listener.name.broker.ssl.cipher.suites": "A,B"})
+        self.assertTrue(kafka._apply_dynamic_configs(
+            changes, {"log.dirs": "/var/lib/kafka"}))
+        self.assertEqual(2, mock_alter_broker_configs.call_count)
+        per_broker, cluster_wide = mock_alter_broker_configs.call_args_list
+        self.assertEqual(
+            {"listener.name.broker.ssl.cipher.suites": "A,B"},
+            per_broker[0][0])
+        self.assertFalse(per_broker[1]["entity_default"])
+        self.assertEqual({"num.io.threads": "16"}, cluster_wide[0][0])
+        self.assertEqual(["log.cleaner.threads"],
+                         cluster_wide[1]["delete"])
+        self.assertTrue(cluster_wide[1]["entity_default"])
+        # Update failed: restart instead
+        mock_alter_broker_configs.side_effect = \
+            charm.KafkaDynamicConfigError()
+        self.assertFalse(kafka._apply_dynamic_configs(
+            changes, {"log.dirs": "/var/lib/kafka"}))
+        # Broker not running yet: restart
+        mock_alter_broker_configs.side_effect = None
+        mock_service_running.return_value = False
+        self.assertFalse(kafka._apply_dynamic_configs(
+            changes, {"log.dirs": "/var/lib/kafka"}))
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm.RackRestartScheduler, "done")
+    @patch.object(charm, "read_broker_id")
+    @patch.object(charm, "describe_partitions")
+    @patch.object(charm.KafkaBrokerCharm, "is_jmxexporter_enabled")
+    def test_broker_recovered(self,
+                              mock_jmxexporter_enabled,
+                              mock_describe_partitions,
+                              mock_read_broker_id,
+                              mock_done,
+                              mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        mock_jmxexporter_enabled.return_value = False
+        mock_read_broker_id.return_value = "1"
+        # Only the partitions replicated on this broker are accounted
+        mock_describe_partitions.return_value = [["1", "2"], ["2", "3"]]
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        self.assertEqual({charm.UNDER_REPLICATED_PARTITIONS: 1},
+                         kafka._broker_metrics())
+        kafka.ks.restart_health_since = charm.time.time()
+        self.assertFalse(kafka._broker_recovered())
+        self.assertIn("1 under-replicated",
+                      kafka.unit.status.message)
+        mock_describe_partitions.return_value = [["2", "3"]]
+        # A single check per dispatch
+        self.assertFalse(kafka._broker_recovered())
+        self.assertEqual(0, kafka.ks.restart_health_checks)
+        for _ in range(charm.HEALTH_STABLE_CHECKS - 1):
+            kafka._health_checked = False
+            self.assertFalse(kafka._broker_recovered())
+        mock_done.assert_not_called()
+        kafka._health_checked = False
+        self.assertTrue(kafka._broker_recovered())
+        mock_done.assert_called_once()
+        self.assertEqual(0.0, kafka.ks.restart_health_since)
+        self.assertEqual(ActiveStatus("service running"), kafka.unit.status)
+        # Timeout: blocked, the next units restart anyway
+        mock_describe_partitions.return_value = [["1", "2"]]
+        kafka.ks.restart_health_since = charm.time.time() - 601
+        kafka.ks.restart_health_checks = 0
+        kafka._health_checked = False
+        self.assertTrue(kafka._broker_recovered())
+        self.assertEqual(2, mock_done.call_count)
+        self.assertIsInstance(kafka.unit.status, BlockedStatus)
+
+    @patch.object(charm, "OpsCoordinator")
+    def test_relation_inputs_skip_restart_keys(self, mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        with harness.hooks_disabled():
+            rel_id = harness.add_relation("cluster", "kafka-broker")
+            harness.add_relation_unit(rel_id, "kafka-broker/1")
+            harness.update_relation_data(rel_id, "kafka-broker/1", {
+                "url": "broker-1:9092"})
+        kafka = harness.charm
+
+        def _inputs():
+            # A new snapshot, as on the next dispatch
+            kafka.relation_data = charm.RelationSnapshot(
+                kafka, charm.SNAPSHOT_RELATIONS)
+            return kafka._relation_inputs(
+                "cluster", exclude=charm.SCHEDULER_KEYS)
+
+        inputs = _inputs()
+        self.assertEqual({"url": "broker-1:9092"},
+                         inputs[str(rel_id)]["kafka-broker/1"])
+        # The restart bookkeeping does not re-render server.properties
+        with harness.hooks_disabled():
+            harness.update_relation_data(rel_id, "kafka-broker/1", {
+                "restart_request": "1.0", "rack": "rack-1",
+                "broker_id": "1002"})
+            harness.update_relation_data(rel_id, "kafka-broker", {
+                "restart_rollout": '{"active": true}'})
+        self.assertEqual(inputs, _inputs())
+        with harness.hooks_disabled():
+            harness.update_relation_data(rel_id, "kafka-broker/1", {
+                "url": "broker-1:9093"})
+        self.assertNotEqual(inputs, _inputs())
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm, "read_broker_id")
+    @patch.object(charm.KafkaBrokerCharm, "_schedule_restarts")
+    @patch.object(charm.KafkaBrokerCharm, "_is_local_controller")
+    def test_lock_waits_for_recovering_units(self,
+                                             mock_is_local_controller,
+                                             mock_schedule_restarts,
+                                             mock_read_broker_id,
+                                             mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        mock_is_local_controller.return_value = False
+        mock_read_broker_id.return_value = "1"
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        with harness.hooks_disabled():
+            rel_id = harness.add_relation("cluster", "kafka-broker")
+            harness.add_relation_unit(rel_id, "kafka-broker/1")
+            # Both units requested the lock, kafka-broker/1 got it first
+            # and its replicas still catch up
+            harness.update_relation_data(rel_id, "kafka-broker/1", {
+                "restart_request": "1.0", "restart_recovering": "1.0"})
+        kafka = harness.charm
+        event = MockEvent(relations=[])
+        event.restart = Mock(return_value=True)
+        self.assertFalse(kafka._restart_granted(event))
+        event.restart.assert_not_called()
+        self.assertIn("kafka-broker/1", kafka.unit.status.message)
+        # Every attempt checks again, even with the lock already requested
+        self.assertFalse(kafka._restart_granted(event))
+        event.restart.assert_not_called()
+        # Once recovered, the lock is requested on the next dispatch
+        with harness.hooks_disabled():
+            harness.update_relation_data(rel_id, "kafka-broker/1", {
+                "restart_done": "1.0"})
+        kafka.relation_data = charm.RelationSnapshot(
+            kafka, charm.SNAPSHOT_RELATIONS)
+        self.assertTrue(kafka._restart_granted(event))
+        event.restart.assert_called_once_with(kafka.coordinator)
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm.RackRestartScheduler, "others_pending")
+    def test_controller_yields(self, mock_others_pending, mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        mock_others_pending.return_value = ["kafka-broker/1"]
+        self.assertFalse(kafka._controller_yields(False))
+        # The controller lets the other units restart first
+        self.assertTrue(kafka._controller_yields(True))
+        self.assertGreater(kafka.ks.controller_yield_since, 0)
+        # Up to CONTROLLER_YIELD_TIMEOUT
+        kafka.ks.controller_yield_since -= charm.CONTROLLER_YIELD_TIMEOUT + 1
+        self.assertFalse(kafka._controller_yields(True))
+        # No one else waiting
+        mock_others_pending.return_value = []
+        self.assertFalse(kafka._controller_yields(True))
+        self.assertEqual(0.0, kafka.ks.controller_yield_since)
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm, "active_controller")
+    @patch.object(charm.RackRestartScheduler, "track_rollout")
+    @patch.object(charm.RackRestartScheduler, "rollout",
+                  new_callable=PropertyMock)
+    @patch.object(charm.RackRestartScheduler, "requests")
+    def test_active_controller_once_per_dispatch(self,
+                                                 mock_requests,
+                                                 mock_rollout,
+                                                 mock_track_rollout,
+                                                 mock_active_controller,
+                                                 mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        mock_active_controller.return_value = ("1001", 7)
+        mock_rollout.return_value = {"active": True}
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.set_leader(True)
+        kafka = harness.charm
+        kafka.ks.server_props = json.dumps(
+            {"zookeeper.connect": "zk-0:2182"})
+        # No restart pending: the rollout is closed with no lookup
+        mock_requests.return_value = {}
+        kafka._schedule_restarts()
+        mock_active_controller.assert_not_called()
+        mock_track_rollout.assert_called_once_with()
+        # Restarts pending: a single lookup for the whole dispatch
+        mock_requests.return_value = {"kafka-broker/1": "rack-1"}
+        kafka._schedule_restarts()
+        kafka._schedule_restarts()
+        self.assertEqual(("1001", 7), kafka._active_controller())
+        mock_active_controller.assert_called_once()
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm.KafkaBrokerCharm, "get_zk_key")
+    @patch.object(charm.KafkaBrokerCharm, "get_zk_cert")
+    @patch.object(zookeeper.ZookeeperRequiresRelation,
+                  "on_zookeeper_relation_changed")
+    @patch.object(charm, "service_resume")
+    @patch.object(charm, "service_restart")
+    @patch.object(charm, "service_running")
+    def test_zookeeper_relation_changed(self,
+                                        mock_service_running,
+                                        mock_service_restart,
+                                        mock_service_resume,
+                                        mock_zk_relation_changed,
+                                        mock_get_zk_cert,
+                                        mock_get_zk_key,
+                                        mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        mock_get_zk_cert.return_value = ""
+        mock_get_zk_key.return_value = ""
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        opts = {"zookeeper.connect": "zk-0:2182,zk-1:2182",
+                "num.io.threads": "8"}
+        kafka.ks.zk_client_state = kafka._zk_client_state(opts)
+        # Only the zookeeper.* configs are accounted
+        self.assertEqual(
+            kafka.ks.zk_client_state,
+            kafka._zk_client_state(dict(opts, **{"num.io.threads": "16"})))
+        self.assertNotEqual(
+            kafka.ks.zk_client_state,
+            kafka._zk_client_state(dict(opts, **{
+                "zookeeper.connect": "zk-0:2182,zk-1:2182,zk-2:2182"})))
+        # A fresh unit has no fingerprint in use: the first join differs
+        self.assertNotEqual("", kafka._zk_client_state(opts))
+        # Only unrelated ZooKeeper relation data changes, e.g. a new
+        # ZooKeeper unit not yet in zookeeper.connect: no restart is
+        # requested, config-changed compares the fingerprints
+        with patch.object(kafka, "_mark_dirty") as mock_mark_dirty, \
+                patch.object(BoundEvent, "emit") as mock_emit:
+            mock_service_running.return_value = True
+            kafka._on_zookeeper_relation_changed(MockEvent(relations=[]))
+            mock_mark_dirty.assert_called_once()
+            mock_emit.assert_not_called()
+            self.assertFalse(kafka.ks.need_restart)
+            mock_service_restart.assert_not_called()
+            # A stopped broker is started right away
+            mock_service_running.return_value = False
+            kafka._on_zookeeper_relation_changed(MockEvent(relations=[]))
+            mock_emit.assert_not_called()
+            mock_service_resume.assert_called_once_with(kafka.service)
+            mock_service_restart.assert_called_once_with(kafka.service)
+
+    @patch.object(charm, "OpsCoordinator")
+    @patch.object(charm, "broker_endpoints")
+    @patch.object(charm, "read_broker_id")
+    @patch.object(charm, "alter_broker_configs")
+    @patch.object(charm, "service_running")
+    @patch.object(charm.KafkaListenerProvidesRelation, "set_bootstrap_data")
+    def test_apply_dynamic_listeners(self,
+                                     mock_set_bootstrap_data,
+                                     mock_service_running,
+                                     mock_alter_broker_configs,
+                                     mock_read_broker_id,
+                                     mock_broker_endpoints,
+                                     mock_coordinator):
+        mock_coordinator.return_value = MockOpsCoordinator()
+        mock_service_running.return_value = True
+        mock_read_broker_id.return_value = "1001"
+        mock_broker_endpoints.return_value = [
+            "BROKER://broker-0:9092", "EXTERNAL://broker-0.ext:9094"]
+        harness = Harness(charm.KafkaBrokerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        kafka = harness.charm
+        kafka.ks.bootstrap_server = "broker-0:9092"
+        kafka.listener_info = '{"broker": {}, "external": {}}'
+        old = {"listeners": "BROKER://:9092",
+               "advertised.listeners": "BROKER://broker-0:9092",
+               "listener.security.protocol.map": "BROKER:SSL",
+               "log.dirs": "/var/lib/kafka",
+               "zookeeper.connect": "zk-0:2182"}
+        new = dict(old, **{
+            "listeners": "BROKER://:9092,EXTERNAL://:9094",
+            "advertised.listeners":
+                "BROKER://broker-0:9092,EXTERNAL://broker-0.ext:9094",
+            "listener.security.protocol.map": "BROKER:SSL,EXTERNAL:SSL",
+            "listener.name.external.ssl.keystore.location": "/ks.1.jks"})
+        changes = charm.classify_changes(
+            old, new,
+            exclude=["listener.name.external.ssl.keystore.location"],
+            inter_broker_listener="BROKER")
+        self.assertTrue(kafka._apply_dynamic_configs(
+            changes, new, listeners=(["external"], [])))
+        per_broker = mock_alter_broker_configs.call_args_list[0]
+        # The keystore of the new listener is set on the same update
+        self.assertEqual(
+            "/ks.1.jks",
+            per_broker[0][0]["listener.name.external.ssl.keystore.location"])
+        self.assertEqual(new["listeners"], per_broker[0][0]["listeners"])
+        mock_set_bootstrap_data.assert_called_once_with(kafka.listener_info)
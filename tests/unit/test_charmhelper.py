@@ -0,0 +1,68 @@
+"""Test the charmhelper lib."""
+
+import os
+import grp
+import pwd
+import shutil
+import tempfile
+import unittest
+
+import charms.kafka_broker.v0.charmhelper as charmhelper
+
+TEMPLATE = "listeners={{ listeners }}\n"
+
+
+class TestCharmHelper(unittest.TestCase):
+    """Unit test class."""
+
+    def setUp(self):
+        """Set up the unit test class."""
+        super(TestCharmHelper, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.user = pwd.getpwuid(os.getuid()).pw_name
+        self.group = grp.getgrgid(os.getgid()).gr_name
+        with open(os.path.join(self.tmpdir, "test.j2"), "w") as f:
+            f.write(TEMPLATE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_render_from_string_compiles_once(self):
+        charmhelper._string_templates.clear()
+        for listeners in ["PLAINTEXT://:9092", "SSL://:9093"]:
+            content = charmhelper.render_from_string(
+                source=TEMPLATE, target=None,
+                context={"listeners": listeners},
+                templates_dir=self.tmpdir)
+            self.assertEqual(content, "listeners={}".format(listeners))
+        self.assertEqual(len(charmhelper._string_templates), 1)
+
+    def test_render_reuses_environment(self):
+        target = os.path.join(self.tmpdir, "out", "server.properties")
+        for _ in range(2):
+            content = charmhelper.render(
+                source="test.j2", target=target,
+                context={"listeners": "SSL://:9093"},
+                owner=self.user, group=self.group,
+                templates_dir=self.tmpdir)
+        self.assertEqual(content, "listeners=SSL://:9093")
+        with open(target) as f:
+            self.assertEqual(f.read(), content)
+        env = charmhelper._get_template_env(self.tmpdir)
+        self.assertIs(env, charmhelper._get_template_env(self.tmpdir))
+
+    def test_write_file_only_if_changed(self):
+        target = os.path.join(self.tmpdir, "override.conf")
+        charmhelper.reset_changed_files()
+        self.assertTrue(charmhelper.write_file(
+            target, "[Service]\n", self.user, self.group, 0o640))
+        self.assertTrue(charmhelper.file_changed(target))
+        charmhelper.reset_changed_files()
+        self.assertFalse(charmhelper.write_file(
+            target, "[Service]\n", self.user, self.group, 0o640))
+        self.assertFalse(charmhelper.file_changed(target))
+        self.assertEqual(charmhelper.get_changed_files(), [])
+        self.assertEqual(os.stat(target).st_mode & 0o777, 0o640)
+        # No temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["override.conf", "test.j2"])
@@ -0,0 +1,113 @@
+"""Test the import time of the charm and its libs.
+
+Every hook dispatch imports src/charm.py and all the libs it depends on,
+even update-status, which runs every 5 minutes. Heavy modules must only be
+loaded on first use. This test runs "python -X importtime" on a clean
+interpreter and checks both the modules loaded and the cumulative time.
+"""
+
+import os
+import sys
+import subprocess
+import unittest
+
+# Modules that are only needed by some of the code paths and, therefore,
+# must be imported on first use.
+LAZY_MODULES = [
+    "OpenSSL",
+    "python_hosts",
+    "jinja2",
+    "netifaces",
+    "netaddr",
+    "dns",
+]
+
+# Per event type: modules imported at dispatch, modules that must not be
+# loaded and the cumulative import time budget, in microseconds.
+# The budgets are generous, they are meant to catch regressions such as
+# a heavy module being imported at module level again.
+IMPORT_BUDGETS = {
+    "update-status": {
+        "modules": ["charm"],
+        # ca_client is only loaded with the certificates relation
+        "lazy": LAZY_MODULES + ["cryptography",
+                                "interface_tls_certificates"],
+        "budget": 1500000,
+    },
+    "libs": {
+        "modules": [
+            "charms.kafka_broker.v0.charmhelper",
+            "charms.kafka_broker.v0.kafka_security",
+            "charms.kafka_broker.v0.kafka_linux",
+            "charms.kafka_broker.v0.kafka_listener",
+            "charms.kafka_broker.v0.kafka_mds",
+            "charms.kafka_broker.v0.kafka_storage_manager",
+            "charms.kafka_broker.v0.kafka_prometheus_monitoring",
+            "charms.kafka_broker.v0.kafka_reconciler",
+            "charms.kafka_broker.v0.kafka_profiler",
+            "charms.kafka_broker.v0.kafka_network",
+            "charms.kafka_broker.v0.kafka_relation_snapshot",
+            "charms.kafka_broker.v0.kafka_dynamic_config",
+            "charms.kafka_broker.v0.kafka_tls_benchmark",
+            "charms.kafka_broker.v0.kafka_restart_scheduler",
+            "charms.kafka_broker.v0.kafka_metrics",
+            "charms.kafka_broker.v0.kafka_endpoint_probe",
+            "charms.kafka_broker.v0.kafka_zookeeper_metadata",
+            "charms.zookeeper.v0.zookeeper",
+            "cluster",
+        ],
+        "lazy": LAZY_MODULES + ["cryptography"],
+        "budget": 1000000,
+    },
+}
+
+
+def _importtime(modules):
+    """Returns {module: cumulative import time in us} for modules."""
+    root = os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", ".."))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([
+        root, os.path.join(root, "lib"), os.path.join(root, "src")])
+    env.pop("PYTHONIMPORTTIME", None)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "import " + ", ".join(modules)],
+        env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None, proc.stderr.strip().split("\n")[-1]
+    result = {}
+    for line in proc.stderr.split("\n"):
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            # Header line
+            continue
+        result[name.strip()] = int(cumulative)
+    return result, None
+
+
+class TestImportTime(unittest.TestCase):
+    """Unit test class."""
+
+    maxDiff = None
+
+    def _check_budget(self, event):
+        b = IMPORT_BUDGETS[event]
+        times, err = _importtime(b["modules"])
+        if times is None:
+            self.skipTest("Dependencies not available: {}".format(err))
+        loaded = [m for m in times
+                  if m.split(".")[0] in b["lazy"]]
+        self.assertEqual(loaded, [], "Modules should be lazy loaded")
+        total = sum(times[m] for m in b["modules"])
+        self.assertLess(
+            total, b["budget"],
+            "{} import time above budget: {}us".format(event, total))
+
+    def test_update_status_import_budget(self):
+        self._check_budget("update-status")
+
+    def test_libs_import_budget(self):
+        self._check_budget("libs")
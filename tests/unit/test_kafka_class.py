@@ -13,12 +13,11 @@
 """Test the Kafka Base class."""
 
 import socket
-import builtins
 import unittest
 import logging
 import os
 import shutil
-from mock import patch, mock_open
+from mock import patch
 
 from ops.testing import Harness
 from charms.kafka_broker.v0.kafka_linux import getCurrentUserAndGroup
@@ -136,6 +135,15 @@ CONFIG_YAML = """options:
   service-environment-overrides:
     type: string
     default: ""
+  generate-root-ca:
+    type: boolean
+    default: false
+  ssl_cert:
+    type: string
+    default: ""
+  ssl_key:
+    type: string
+    default: ""
 """ # noqa
 
 
@@ -347,17 +355,16 @@ class TestAppKafka(unittest.TestCase):
     @patch("os.makedirs")
     @patch.object(kafka.KafkaJavaCharmBase, "_render_krb5_conf")
     @patch.object(socket, "gethostname")
-    @patch.object(kafka, "setFilePermissions")
+    @patch.object(kafka, "write_file")
     @patch.object(kafka.KafkaJavaCharmBase, "set_folders_and_permissions")
     def test_kerberos_jaas_config(self,
                                   mock_set_folder_perms,
-                                  mock_set_files_perms,
+                                  mock_write_file,
                                   mock_gethostname,
                                   mock_render_krb5_conf,
                                   mock_os_makedirs):
         """Test the jaas config for kerberos."""
         mock_gethostname.return_value = "test"
-        mock_set_files_perms.return_value = None
         harness = Harness(
             kafka.KafkaJavaCharmBase, config=CONFIG_YAML)
         self.addCleanup(harness.cleanup)
@@ -382,12 +389,10 @@ class TestAppKafka(unittest.TestCase):
             "service-environment-overrides": SVC_ENV_OVERRIDE,
         })
         # Test the config changed routine:
-        m_open = mock_open()
-        with patch.object(builtins, 'open', m_open):
-            k._on_config_changed(None)
-            m_open.assert_called_once_with("/etc/kafka/jaas.conf", "w")
-            handle = m_open()
-            handle.write.assert_called_once_with(KERBEROS_JAAS_CONF)
+        k._on_config_changed(None)
+        mock_write_file.assert_called_once_with(
+            "/etc/kafka/jaas.conf", KERBEROS_JAAS_CONF,
+            owner="test", group="test", perms=0o640)
 
     @patch("pwd.getpwnam")
     @patch("grp.getgrnam")
@@ -439,3 +444,38 @@ class TestAppKafka(unittest.TestCase):
             ctx=mock_render_string.call_args.kwargs["context"],
             templ_file="krb5.conf.j2")
         self.assertEqual(KRB5_CONF, rendered)
+
+    @patch.object(kafka.KafkaJavaCharmBase, "_load_ssl_key")
+    @patch.object(kafka.KafkaJavaCharmBase, "_load_ssl_cert")
+    def test_ssl_cert_cache(self,
+                            mock_load_ssl_cert,
+                            mock_load_ssl_key):
+        """Test the cert material is loaded once per CN and source."""
+        harness = Harness(
+            kafka.KafkaJavaCharmBase, config=CONFIG_YAML)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        k = harness.charm
+        # Certificates not ready yet, result is not cached
+        mock_load_ssl_cert.return_value = ""
+        self.assertEqual(k._get_ssl_cert("test.maas"), "")
+        mock_load_ssl_cert.return_value = "cert"
+        mock_load_ssl_key.return_value = "key"
+        for _ in range(3):
+            self.assertEqual(k._get_ssl_cert("test.maas"), "cert")
+            self.assertEqual(k._get_ssl_key("test.maas"), "key")
+        self.assertEqual(mock_load_ssl_cert.call_count, 2)
+        self.assertEqual(mock_load_ssl_key.call_count, 1)
+        # Different CNs are cached separately
+        k._get_ssl_cert("zk.maas")
+        self.assertEqual(mock_load_ssl_cert.call_count, 3)
+        # Changing the config changes the source
+        harness._update_config(key_values={
+            "ssl_cert": "Y2VydA==",
+            "ssl_key": "a2V5",
+        })
+        k._get_ssl_cert("test.maas")
+        self.assertEqual(mock_load_ssl_cert.call_count, 4)
+        k.invalidate_cert_cache()
+        k._get_ssl_cert("test.maas")
+        self.assertEqual(mock_load_ssl_cert.call_count, 5)
@@ -0,0 +1,173 @@
+"""Test the kafka_dynamic_config lib."""
+
+import os
+import ssl
+import shutil
+import tempfile
+import unittest
+import subprocess
+from mock import patch
+
+import charms.kafka_broker.v0.kafka_dynamic_config as dynamic_config
+import charms.kafka_broker.v0.kafka_security as security
+
+
+class TestKafkaDynamicConfig(unittest.TestCase):
+    """Unit test class."""
+
+    def test_versioned_store_path(self):
+        self.assertEqual(
+            "/var/ssl/private/ks.abc123.jks",
+            dynamic_config.versioned_store_path(
+                "/var/ssl/private/ks.jks", "abc123"))
+
+    def test_read_broker_id(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, "meta.properties"), "w") as f:
+            f.write("version=0\nbroker.id=1001\n")
+        self.assertEqual("1001", dynamic_config.read_broker_id(
+            "/nonexistent," + tmpdir))
+        self.assertIsNone(dynamic_config.read_broker_id("/nonexistent"))
+
+    @patch.object(dynamic_config.subprocess, "check_output")
+    def test_alter_broker_configs(self, mock_check_output):
+        dynamic_config.alter_broker_configs(
+            {"listener.name.broker.ssl.keystore.location": "/ks.1.jks",
+             "listener.name.broker.ssl.cipher.suites": "A,B"},
+            broker_id=1001, bootstrap_server="broker-0:9092",
+            command_config="/etc/kafka/client.properties")
+        mock_check_output.assert_called_once_with(
+            ["kafka-configs", "--bootstrap-server", "broker-0:9092",
+             "--entity-type", "brokers", "--entity-name", "1001",
+             "--alter", "--add-config",
+             "listener.name.broker.ssl.cipher.suites=[A,B],"
+             "listener.name.broker.ssl.keystore.location=/ks.1.jks",
+             "--command-config", "/etc/kafka/client.properties"],
+            stderr=subprocess.STDOUT)
+        mock_check_output.side_effect = subprocess.CalledProcessError(
+            1, "kafka-configs", output=b"Invalid config")
+        self.assertRaises(
+            dynamic_config.KafkaDynamicConfigError,
+            dynamic_config.alter_broker_configs,
+            {"a": "b"}, broker_id=1001, bootstrap_server="broker-0:9092")
+        self.assertRaises(
+            dynamic_config.KafkaDynamicConfigError,
+            dynamic_config.alter_broker_configs,
+            {"a": "b"}, broker_id=None, bootstrap_server="broker-0:9092")
+
+    @patch.object(dynamic_config.subprocess, "check_output")
+    def test_alter_broker_configs_default(self, mock_check_output):
+        dynamic_config.alter_broker_configs(
+            {"num.io.threads": 16}, broker_id=None,
+            bootstrap_server="broker-0:9092",
+            delete=["log.cleaner.threads"], entity_default=True)
+        mock_check_output.assert_called_once_with(
+            ["kafka-configs", "--bootstrap-server", "broker-0:9092",
+             "--entity-type", "brokers", "--entity-default",
+             "--alter", "--add-config", "num.io.threads=16",
+             "--delete-config", "log.cleaner.threads"],
+            stderr=subprocess.STDOUT)
+
+    def test_classify_changes(self):
+        old = {"num.io.threads": 8, "log.cleaner.threads": "1",
+               "log.dirs": "/var/lib/kafka",
+               "listener.name.broker.ssl.cipher.suites": "A",
+               "follower.replication.throttled.rate": "100"}
+        new = {"num.io.threads": "16", "log.cleaner.threads": "1",
+               "log.dirs": "/data/kafka",
+               "listener.name.broker.ssl.cipher.suites": "A,B",
+               "listeners": "BROKER://:9092"}
+        self.assertEqual({
+            dynamic_config.READ_ONLY: {
+                "listeners": "BROKER://:9092",
+                "log.dirs": "/data/kafka"},
+            dynamic_config.PER_BROKER: {
+                "follower.replication.throttled.rate": None,
+                "listener.name.broker.ssl.cipher.suites": "A,B"},
+            dynamic_config.CLUSTER_WIDE: {
+                "num.io.threads": "16"},
+            dynamic_config.LISTENERS: {},
+        }, dynamic_config.classify_changes(old, new))
+        self.assertEqual(
+            {}, dynamic_config.classify_changes(
+                old, new, exclude=list(new) + list(old))[
+                    dynamic_config.READ_ONLY])
+        self.assertEqual(
+            dynamic_config.PER_BROKER,
+            dynamic_config.config_update_mode(
+                "listener.name.sasl_ssl.scram-sha-512.sasl.jaas.config"))
+        self.assertEqual(
+            dynamic_config.READ_ONLY,
+            dynamic_config.config_update_mode(
+                "listener.name.broker.num.io.threads"))
+        # Security configs are only dynamic per listener
+        for key in ["ssl.cipher.suites", "sasl.jaas.config"]:
+            self.assertEqual(dynamic_config.READ_ONLY,
+                             dynamic_config.config_update_mode(key))
+
+    def test_listener_changes(self):
+        old = {
+            "listeners": "BROKER://:9092,INTERNAL://:9093",
+            "advertised.listeners":
+                "BROKER://broker-0:9092,INTERNAL://broker-0:9093",
+            "listener.security.protocol.map": "BROKER:SSL,INTERNAL:SSL",
+            "listener.name.broker.ssl.keystore.location": "/ks.jks",
+            "listener.name.internal.ssl.keystore.location": "/ks.jks",
+            "num.io.threads": "8"}
+        new = {
+            "listeners": "BROKER://:9092,EXTERNAL://:9094",
+            "advertised.listeners":
+                "BROKER://broker-0:9092,EXTERNAL://broker-0.ext:9094",
+            "listener.security.protocol.map":
+                "BROKER:SSL,EXTERNAL:SASL_SSL",
+            "listener.name.broker.ssl.keystore.location": "/ks.jks",
+            "listener.name.external.ssl.keystore.location": "/ks.jks",
+            "listener.name.external.oauthbearer.sasl.server.callback"
+            ".handler.class": "Handler",
+            "num.io.threads": "8"}
+        self.assertEqual(
+            (["external"], ["internal"]),
+            dynamic_config.listener_changes(old, new, "BROKER"))
+        changes = dynamic_config.classify_changes(
+            old, new, inter_broker_listener="BROKER")
+        self.assertEqual({}, changes[dynamic_config.READ_ONLY])
+        self.assertEqual(
+            ["advertised.listeners",
+             "listener.name.external.oauthbearer.sasl.server.callback"
+             ".handler.class",
+             "listener.name.external.ssl.keystore.location",
+             "listener.name.internal.ssl.keystore.location",
+             "listener.security.protocol.map",
+             "listeners"],
+            sorted(changes[dynamic_config.LISTENERS]))
+        self.assertIsNone(changes[dynamic_config.LISTENERS][
+            "listener.name.internal.ssl.keystore.location"])
+        # Without the inter-broker listener, listeners are read-only
+        self.assertIn(
+            "listeners", dynamic_config.classify_changes(
+                old, new)[dynamic_config.READ_ONLY])
+        # Endpoint of an existing listener changed: restart
+        moved = dict(new, listeners="BROKER://:9095,EXTERNAL://:9094")
+        self.assertIsNone(
+            dynamic_config.listener_changes(new, moved, "BROKER"))
+        # The inter-broker listener cannot be added or removed
+        self.assertIsNone(
+            dynamic_config.listener_changes(old, new, "INTERNAL"))
+
+    @patch.object(dynamic_config.time, "sleep")
+    @patch.object(dynamic_config, "get_served_certificate")
+    def test_wait_for_certificate(self, mock_get_cert, mock_sleep):
+        crt, _ = security.generateSelfSigned("/tmp", "testcert")
+        old, _ = security.generateSelfSigned("/tmp", "testcert-old")
+        mock_get_cert.side_effect = [
+            OSError("Connection refused"),
+            ssl.PEM_cert_to_DER_cert(old),
+            ssl.PEM_cert_to_DER_cert(crt)]
+        self.assertTrue(dynamic_config.wait_for_certificate(
+            "broker-0", 9093, crt))
+        self.assertEqual(3, mock_get_cert.call_count)
+        mock_get_cert.side_effect = None
+        mock_get_cert.return_value = ssl.PEM_cert_to_DER_cert(old)
+        self.assertFalse(dynamic_config.wait_for_certificate(
+            "broker-0", 9093, crt, timeout=0))
@@ -0,0 +1,90 @@
+"""Test the kafka_endpoint_probe lib."""
+
+import os
+import ssl
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import charms.kafka_broker.v0.kafka_endpoint_probe as probe
+import charms.kafka_broker.v0.kafka_security as security
+
+
+class TestKafkaEndpointProbe(unittest.TestCase):
+    """Unit test class."""
+
+    def _server(self, tls=False, delay=0):
+        """Starts listening on localhost after delay seconds.
+
+        Returns the endpoint.
+        """
+        ctx = None
+        if tls:
+            tmpdir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, tmpdir)
+            security.generateSelfSigned(
+                tmpdir, "server", cn="localhost", key_algorithm="ecdsa-p256")
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(os.path.join(tmpdir, "server.crt"),
+                                os.path.join(tmpdir, "server.key"))
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        self.addCleanup(sock.close)
+
+        def _serve():
+            time.sleep(delay)
+            sock.listen(16)
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except OSError:
+                    return
+                try:
+                    if ctx:
+                        conn = ctx.wrap_socket(conn, server_side=True)
+                    conn.close()
+                except (OSError, ssl.SSLError):
+                    pass
+
+        threading.Thread(target=_serve, daemon=True).start()
+        return "127.0.0.1:{}".format(port)
+
+    def test_split_endpoint(self):
+        self.assertEqual(("10.0.0.1", 9092),
+                         probe.split_endpoint("10.0.0.1:9092"))
+        self.assertEqual(("fe80::1", 9092),
+                         probe.split_endpoint("[fe80::1]:9092"))
+
+    def test_probe_endpoints(self):
+        plain = self._server()
+        tls = self._server(tls=True)
+        late = self._server(delay=1)
+        results = probe.probe_endpoints(
+            [plain, tls, late, plain], deadline=10, tls_endpoints=[tls])
+        self.assertEqual([plain, tls, late], list(results))
+        for r in results.values():
+            self.assertTrue(r["ready"])
+            self.assertIsNone(r["error"])
+        self.assertGreater(results[late]["attempts"], 1)
+        self.assertGreaterEqual(results[late]["latency"], 0.5)
+        self.assertEqual({}, probe.probe_endpoints([]))
+
+    def test_probe_deadline(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        closed = "127.0.0.1:{}".format(sock.getsockname()[1])
+        sock.close()
+        plain = self._server()
+        start = time.monotonic()
+        results = probe.probe_endpoints(
+            [closed, plain], deadline=1, tls_endpoints=[plain])
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertFalse(results[closed]["ready"])
+        self.assertIsNotNone(results[closed]["error"])
+        # Plain TCP server does not complete the TLS handshake
+        self.assertFalse(results[plain]["ready"])
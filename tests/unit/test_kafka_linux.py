@@ -2,6 +2,9 @@
 
 import os
 import unittest
+from mock import patch
+
+from python_hosts import Hosts
 
 import charms.kafka_broker.v0.kafka_linux as linux
 
@@ -55,3 +58,69 @@ class TestContribLinux(unittest.TestCase):
             f.close()
         self.assertEqual(result, FINALETCDHOSTS)
         __cleanup()
+
+    def test_fix_maybe_hosts_skips_write_if_correct(self):
+        """Test /etc/hosts is not rewritten if the entry is correct."""
+        with open("/tmp/3niofetchosts", "w") as f:
+            f.write(FINALETCDHOSTS)
+        with patch.object(Hosts, "write") as mock_write:
+            removed = linux.fixMaybeLocalhost(
+                hosts_path="/tmp/3niofetchosts",
+                hostname="nodetest.maas",
+                IP="1.1.1.1")
+            mock_write.assert_not_called()
+        self.assertEqual(removed, [])
+        os.remove("/tmp/3niofetchosts")
+
+    @patch.object(linux, "fixMaybeLocalhost")
+    @patch.object(linux.charmhelper, "get_hostname")
+    def test_get_hostname_cache(self,
+                                mock_get_hostname,
+                                mock_fix_hosts):
+        """Test hostnames are cached until TTL expires or invalidated."""
+        linux.invalidate_hostname_cache()
+        mock_get_hostname.return_value = "nodetest.maas"
+        self.assertEqual(linux.get_hostname("1.1.1.1"), "nodetest.maas")
+        self.assertEqual(linux.get_hostname("1.1.1.1"), "nodetest.maas")
+        self.assertEqual(mock_get_hostname.call_count, 1)
+        self.assertEqual(mock_fix_hosts.call_count, 1)
+        # Expired entries are resolved again
+        linux.get_hostname("1.1.1.1", ttl=0)
+        self.assertEqual(mock_get_hostname.call_count, 2)
+        linux.invalidate_hostname_cache("1.1.1.1")
+        linux.get_hostname("1.1.1.1")
+        self.assertEqual(mock_get_hostname.call_count, 3)
+        linux.invalidate_hostname_cache()
+
+    @patch.object(linux.charmhelper, "get_hostname")
+    def test_get_hostname_cache_fixes_hosts(self, mock_get_hostname):
+        """Test a cached hostname still fixes /etc/hosts if it changed."""
+        path = "/tmp/3niofetchosts"
+        self.addCleanup(os.remove, path)
+        linux.invalidate_hostname_cache()
+        self.addCleanup(linux.invalidate_hostname_cache)
+        mock_get_hostname.return_value = "nodetest.maas"
+        with open(path, "w") as f:
+            f.write(ETCHOSTS)
+        linux.get_hostname("1.1.1.1", hosts_path=path)
+        # The entry is changed back, e.g. by cloud-init
+        with open(path, "w") as f:
+            f.write(ETCHOSTS)
+        self.assertEqual(
+            linux.get_hostname("1.1.1.1", hosts_path=path), "nodetest.maas")
+        self.assertEqual(mock_get_hostname.call_count, 1)
+        with open(path, "r") as f:
+            self.assertEqual(f.read(), FINALETCDHOSTS)
+
+    def test_has_aes_ni(self):
+        """Test AES instructions detection on x86 and arm64 cpuinfo."""
+        path = "/tmp/3niofetchcpuinfo"
+        self.addCleanup(os.remove, path)
+        for content, expected in [
+                ("processor\t: 0\nflags\t\t: fpu sse2 aes avx\n", True),
+                ("processor\t: 0\nflags\t\t: fpu sse2 avx\n", False),
+                ("processor\t: 0\nFeatures\t: fp asimd aes pmull\n", True)]:
+            with open(path, "w") as f:
+                f.write(content)
+            self.assertEqual(expected, linux.has_aes_ni(path))
+        self.assertFalse(linux.has_aes_ni("/nonexistent"))
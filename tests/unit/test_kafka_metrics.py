@@ -0,0 +1,77 @@
+"""Test the kafka_metrics lib."""
+
+import unittest
+from mock import patch
+
+import charms.kafka_broker.v0.kafka_metrics as metrics
+
+SCRAPE = """# HELP kafka_server_replicamanager_underreplicatedpartitions
+# TYPE kafka_server_replicamanager_underreplicatedpartitions gauge
+kafka_server_replicamanager_underreplicatedpartitions 3.0
+kafka_server_kafkaserver_brokerstate 3.0
+kafka_server_socketservermetrics_connections{listener="BROKER",\
+client_software_name="a b"} 2.0
+kafka_server_socketservermetrics_connections{listener="EXTERNAL",\
+client_software_name="c"} 5.0
+"""
+
+
+class TestKafkaMetrics(unittest.TestCase):
+    """Unit test class."""
+
+    def test_parse_metrics(self):
+        m = metrics.parse_metrics(SCRAPE)
+        self.assertEqual(3.0, m[metrics.UNDER_REPLICATED_PARTITIONS])
+        self.assertEqual(3.0, m[metrics.BROKER_STATE])
+        # Values with different labels are summed up
+        self.assertEqual(
+            7.0, m["kafka_server_socketservermetrics_connections"])
+
+    def test_broker_health(self):
+        self.assertEqual(
+            {"healthy": False, "under_replicated": 3, "broker_state": 3},
+            metrics.broker_health(metrics.parse_metrics(SCRAPE)))
+        self.assertTrue(metrics.broker_health(
+            {metrics.UNDER_REPLICATED_PARTITIONS: 0})["healthy"])
+        # Still starting up
+        self.assertFalse(metrics.broker_health(
+            {metrics.UNDER_REPLICATED_PARTITIONS: 0,
+             metrics.BROKER_STATE: 2})["healthy"])
+        self.assertFalse(metrics.broker_health({})["healthy"])
+
+    def test_check_broker_health(self):
+        urp = metrics.UNDER_REPLICATED_PARTITIONS
+        state, count = metrics.check_broker_health(lambda: {urp: 0}, 1)
+        self.assertTrue(state["healthy"])
+        self.assertEqual(2, count)
+
+        def _source():
+            raise OSError("Connection refused")
+
+        state, count = metrics.check_broker_health(_source, 1)
+        self.assertFalse(state["healthy"])
+        self.assertEqual(0, count)
+
+    @patch.object(metrics.time, "sleep")
+    def test_wait_for_broker_health(self, mock_sleep):
+        urp = metrics.UNDER_REPLICATED_PARTITIONS
+        source = iter([OSError("Connection refused"), {urp: 5}, {urp: 0},
+                       {urp: 1}, {urp: 0}, {urp: 0}])
+
+        def _source():
+            m = next(source)
+            if isinstance(m, Exception):
+                raise m
+            return m
+
+        seen = []
+        healthy, state = metrics.wait_for_broker_health(
+            _source, timeout=60,
+            progress=lambda s, e: seen.append(s["under_replicated"]))
+        self.assertTrue(healthy)
+        # A single healthy check is not stable yet
+        self.assertEqual([None, 5, 0, 1, 0, 0], seen)
+        healthy, state = metrics.wait_for_broker_health(
+            lambda: {urp: 2}, timeout=0)
+        self.assertFalse(healthy)
+        self.assertEqual(2, state["under_replicated"])
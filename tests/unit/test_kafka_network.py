@@ -0,0 +1,80 @@
+"""Test the kafka_network lib."""
+
+import unittest
+from mock import patch
+
+import netaddr
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+import charms.kafka_broker.v0.kafka_network as kafka_network
+from charms.kafka_broker.v0.kafka_network import (
+    NetworkSnapshot,
+    binding_address
+)
+
+METADATA = """
+name: test
+peers:
+  cluster:
+    interface: cluster
+requires:
+  zookeeper:
+    interface: zookeeper
+provides:
+  listeners:
+    interface: listeners
+"""
+
+
+class _Charm(CharmBase):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.network = NetworkSnapshot(self)
+
+
+class TestKafkaNetwork(unittest.TestCase):
+    """Unit test class."""
+
+    def setUp(self):
+        """Set up the unit test class."""
+        super(TestKafkaNetwork, self).setUp()
+        self.harness = Harness(_Charm, meta=METADATA)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.add_network("10.0.0.10", endpoint="cluster")
+        self.harness.add_network("10.0.1.10", endpoint="zookeeper")
+        self.harness.add_network(
+            "192.168.0.10", endpoint="listeners",
+            ingress_addresses=["192.168.100.10"])
+        self.harness.begin()
+
+    def test_prefetch_all_bindings_once(self):
+        backend = self.harness.charm.model._backend
+        with patch.object(backend, "network_get",
+                          wraps=backend.network_get) as mock_network_get:
+            charm = self.harness.charm
+            self.assertEqual(
+                str(binding_address(charm, "cluster")), "10.0.0.10")
+            self.assertEqual(
+                str(binding_address(charm, "listeners", ingress=True)),
+                "192.168.100.10")
+            self.assertEqual(
+                str(charm.network.bind_address("zookeeper")), "10.0.1.10")
+            # One network-get per binding, all of them on the first access
+            self.assertEqual(mock_network_get.call_count, 3)
+
+    @patch.object(kafka_network, "get_interface_networks")
+    def test_address_in_network(self, mock_get_interface_networks):
+        mock_get_interface_networks.return_value = [
+            netaddr.IPNetwork("127.0.0.1/8"),
+            netaddr.IPNetwork("192.168.0.10/24")
+        ]
+        snapshot = self.harness.charm.network
+        self.assertEqual(
+            snapshot.address_in_network("192.168.0.0/16"), "192.168.0.10")
+        self.assertEqual(
+            snapshot.address_in_network("192.168.0.0/16"), "192.168.0.10")
+        self.assertIsNone(snapshot.address_in_network("10.0.0.0/8"))
+        self.assertIsNone(snapshot.address_in_network(""))
+        mock_get_interface_networks.assert_called_once()
@@ -0,0 +1,99 @@
+"""Test the kafka_profiler lib."""
+
+import os
+import shutil
+import tempfile
+import subprocess
+import concurrent.futures
+import unittest
+
+from charms.kafka_broker.v0.kafka_profiler import (
+    HookProfiler,
+    profiled,
+    percentile
+)
+import charms.kafka_broker.v0.kafka_profiler as kafka_profiler
+
+
+class _Charm(object):
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    @profiled("server-properties")
+    def render(self):
+        subprocess.check_call(["true"])
+        return 1
+
+
+class TestKafkaProfiler(unittest.TestCase):
+    """Unit test class."""
+
+    def setUp(self):
+        """Set up the unit test class."""
+        super(TestKafkaProfiler, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "state", "hook-profile.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_stage_counts_subprocesses(self):
+        p = HookProfiler(self.path, hook="config-changed")
+        charm = _Charm(p)
+        self.assertEqual(charm.render(), 1)
+        with p.stage("server-properties"):
+            pass
+        self.assertEqual(p.stages["server-properties"]["calls"], 2)
+        self.assertEqual(p.stages["server-properties"]["subprocesses"], 1)
+        # Popen is only replaced until the end of the dispatch
+        p.flush()
+        self.assertIs(subprocess.Popen, kafka_profiler._ORIGINAL_POPEN)
+        count = kafka_profiler._SUBPROCESS_COUNTER[0]
+        subprocess.check_call(["true"])
+        self.assertEqual(count, kafka_profiler._SUBPROCESS_COUNTER[0])
+
+    def test_stage_counts_threaded_subprocesses(self):
+        p = HookProfiler(self.path, hook="update-status")
+        with p.stage("network-snapshot"):
+            with concurrent.futures.ThreadPoolExecutor(8) as pool:
+                list(pool.map(lambda _: subprocess.check_call(["true"]),
+                              range(32)))
+        self.assertEqual(p.stages["network-snapshot"]["subprocesses"], 32)
+        p.flush()
+
+    def test_record(self):
+        profiler = HookProfiler(hook="restart")
+        profiler.record("endpoint-ready:10.0.0.1:9092", 1.5)
+        profiler.record("endpoint-ready:10.0.0.1:9092", 0.5)
+        self.assertEqual(
+            {"wall": 2.0, "subprocesses": 0, "calls": 2},
+            profiler.stages["endpoint-ready:10.0.0.1:9092"])
+
+    def test_flush_rolling_history_and_report(self):
+        for i in range(5):
+            hook = "config-changed" if i % 2 else "update-status"
+            p = HookProfiler(self.path, max_entries=3, hook=hook)
+            with p.stage("manage-volumes"):
+                pass
+            p.flush()
+            # Only flushes once per dispatch
+            p.flush()
+        history = HookProfiler(self.path).load()
+        self.assertEqual(len(history), 3)
+        report = HookProfiler(self.path).report()
+        self.assertEqual(report["stages"]["manage-volumes"]["count"], 3)
+        self.assertEqual(
+            report["hooks"]["update-status"]["total"]["count"], 2)
+        report = HookProfiler(self.path).report(hook="config-changed")
+        self.assertEqual(list(report["hooks"]), ["config-changed"])
+
+    def test_flush_skips_empty_dispatch(self):
+        HookProfiler(self.path).flush()
+        self.assertFalse(os.path.exists(self.path))
@@ -0,0 +1,83 @@
+"""Test the kafka_reconciler lib."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from charms.kafka_broker.v0.kafka_reconciler import (
+    ArtifactReconciler,
+    fingerprint
+)
+
+
+class _State(object):
+    """Mimics StoredState: attributes set on the object."""
+
+    artifacts = "{}"
+
+
+class TestKafkaReconciler(unittest.TestCase):
+    """Unit test class."""
+
+    def setUp(self):
+        """Set up the unit test class."""
+        super(TestKafkaReconciler, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmpdir, "server.properties")
+        self.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _build(self):
+        self.builds += 1
+        with open(self.target, "w") as f:
+            f.write("broker.id=1")
+        return {"broker.id": 1}
+
+    def test_fingerprint_ignores_key_order(self):
+        self.assertEqual(fingerprint({"a": 1, "b": 2}),
+                         fingerprint({"b": 2, "a": 1}))
+        self.assertNotEqual(fingerprint({"a": 1}), fingerprint({"a": 2}))
+
+    def test_reconcile_skips_unchanged_inputs(self):
+        r = ArtifactReconciler(_State())
+        inputs = {"config": {"log-dir": "/data"}}
+        result, changed = r.reconcile(
+            "server.properties", inputs, self._build, [self.target])
+        self.assertTrue(changed)
+        result, changed = r.reconcile(
+            "server.properties", inputs, self._build, [self.target])
+        self.assertFalse(changed)
+        self.assertEqual(result, {"broker.id": 1})
+        self.assertEqual(self.builds, 1)
+        # Changing the inputs triggers a rebuild
+        _, changed = r.reconcile(
+            "server.properties", {"config": {"log-dir": "/data2"}},
+            self._build, [self.target])
+        self.assertTrue(changed)
+        self.assertEqual(self.builds, 2)
+
+    def test_reconcile_rebuilds_missing_target(self):
+        r = ArtifactReconciler(_State())
+        r.reconcile("server.properties", {}, self._build, [self.target])
+        os.remove(self.target)
+        _, changed = r.reconcile(
+            "server.properties", {}, self._build, [self.target])
+        self.assertTrue(changed)
+        self.assertEqual(self.builds, 2)
+
+    def test_reconcile_none_result_is_retried(self):
+        r = ArtifactReconciler(_State())
+        r.reconcile("client.properties", {}, lambda: None)
+        _, changed = r.reconcile("client.properties", {}, lambda: None)
+        self.assertTrue(changed)
+
+    def test_invalidate(self):
+        r = ArtifactReconciler(_State())
+        r.reconcile("server.properties", {}, self._build, [self.target])
+        r.invalidate("server.properties")
+        _, changed = r.reconcile(
+            "server.properties", {}, self._build, [self.target])
+        self.assertTrue(changed)
@@ -0,0 +1,96 @@
+"""Test the kafka_relation_snapshot lib."""
+
+import unittest
+from mock import patch
+
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+from charms.kafka_broker.v0.kafka_relation_snapshot import (
+    RelationSnapshot,
+    get_relation_snapshot
+)
+
+METADATA = """
+name: test
+peers:
+  cluster:
+    interface: cluster
+requires:
+  zookeeper:
+    interface: zookeeper
+"""
+
+
+class _Charm(CharmBase):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.relation_data = RelationSnapshot(self, ["cluster"])
+
+
+class TestKafkaRelationSnapshot(unittest.TestCase):
+    """Unit test class."""
+
+    def setUp(self):
+        """Set up the unit test class."""
+        super(TestKafkaRelationSnapshot, self).setUp()
+        self.harness = Harness(_Charm, meta=METADATA)
+        self.addCleanup(self.harness.cleanup)
+        self.rel_id = self.harness.add_relation("cluster", "test")
+        for i in range(1, 4):
+            self.harness.add_relation_unit(self.rel_id, "test/{}".format(i))
+            self.harness.update_relation_data(
+                self.rel_id, "test/{}".format(i), {"cert": "crt{}".format(i)})
+        self.harness.begin()
+
+    def test_load_databags_once(self):
+        charm = self.harness.charm
+        rel = charm.model.get_relation("cluster")
+        backend = charm.model._backend
+        with patch.object(backend, "relation_get",
+                          wraps=backend.relation_get) as mock_relation_get:
+            data = charm.relation_data
+            self.assertEqual(
+                sorted(data.values(rel, "cert")), ["crt1", "crt2", "crt3"])
+            self.assertEqual(
+                sorted(data.values(rel, "cert")), ["crt1", "crt2", "crt3"])
+            self.assertEqual(data.get(rel, charm.unit, "cert"), None)
+            # 3 peer units, this unit and the app, all loaded at once
+            self.assertEqual(mock_relation_get.call_count, 4)
+        with self.assertRaises(TypeError):
+            data.databag(rel, charm.unit)["cert"] = "crt0"
+
+    def test_buffered_writes(self):
+        charm = self.harness.charm
+        rel = charm.model.get_relation("cluster")
+        data = charm.relation_data
+        self.assertTrue(data.set(rel, charm.unit, "cert", "crt0"))
+        self.assertTrue(data.set(rel, charm.unit, "az", "az1"))
+        self.assertFalse(data.set(rel, charm.unit, "cert", "crt0"))
+        # Reads see the buffered values, the model does not
+        self.assertEqual(data.get(rel, charm.unit, "cert"), "crt0")
+        self.assertEqual(
+            self.harness.get_relation_data(self.rel_id, "test/0"), {})
+        backend = charm.model._backend
+        with patch.object(backend, "update_relation_data",
+                          wraps=backend.update_relation_data) as mock_update:
+            data.flush()
+            data.flush()
+            mock_update.assert_called_once()
+        self.assertEqual(
+            self.harness.get_relation_data(self.rel_id, "test/0"),
+            {"cert": "crt0", "az": "az1"})
+        self.assertFalse(data.has_pending_writes)
+
+    def test_unbuffered_fallback(self):
+        charm = self.harness.charm
+        rel = charm.model.get_relation("cluster")
+        charm.relation_data = None
+        data = get_relation_snapshot(charm)
+        self.assertTrue(data.set(rel, charm.unit, "cert", "crt0"))
+        self.assertEqual(
+            self.harness.get_relation_data(self.rel_id, "test/0"),
+            {"cert": "crt0"})
+        self.assertEqual(
+            data.values(rel, "cert", units=[charm.unit]), ["crt0"])
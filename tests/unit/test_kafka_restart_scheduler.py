@@ -0,0 +1,176 @@
+"""Test the kafka_restart_scheduler lib."""
+
+import json
+import unittest
+
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+import charms.kafka_broker.v0.kafka_restart_scheduler as scheduler
+from charms.kafka_broker.v0.kafka_relation_snapshot import RelationSnapshot
+
+METADATA = """
+name: test
+peers:
+  cluster:
+    interface: cluster
+"""
+
+DESCRIBE = """Topic: t1\tTopicId: abc\tPartitionCount: 2\tReplicationFactor: 2
+\tTopic: t1\tPartition: 0\tLeader: 1\tReplicas: 1,2\tIsr: 1,2
+\tTopic: t1\tPartition: 1\tLeader: 2\tReplicas: 2,3\tIsr: 2,3
+"""
+
+
+class _Charm(CharmBase):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.relation_data = RelationSnapshot(self, ["cluster"])
+        self.restart_scheduler = \
+            scheduler.RackRestartScheduler(self, "cluster")
+
+
+class TestKafkaRestartScheduler(unittest.TestCase):
+    """Unit test class."""
+
+    def test_plan_restarts(self):
+        requests = {"k/0": "az1", "k/1": "az1", "k/2": "az2",
+                    "k/10": "az1", "k/3": "unit:k/3"}
+        # All the units of the first rack at once
+        grants = scheduler.plan_restarts(requests, {})
+        self.assertEqual(
+            {"rack": "az1", "units": ["k/0", "k/1", "k/10"]}, grants)
+        # Limited concurrency, then the rack keeps going
+        grants = scheduler.plan_restarts(requests, {}, max_concurrency=2)
+        self.assertEqual(["k/0", "k/1"], grants["units"])
+        del requests["k/0"]
+        grants = scheduler.plan_restarts(requests, grants, max_concurrency=2)
+        self.assertEqual(
+            {"rack": "az1", "units": ["k/1", "k/10"]}, grants)
+        # Next rack once the current one is done
+        for u in ["k/1", "k/10"]:
+            del requests[u]
+        grants = scheduler.plan_restarts(requests, grants)
+        self.assertEqual({"rack": "az2", "units": ["k/2"]}, grants)
+        # Serial mode and units without rack restart alone
+        self.assertEqual(
+            ["k/0"], scheduler.plan_restarts(
+                {"k/0": "az1", "k/1": "az1"}, {}, parallel=False)["units"])
+        self.assertEqual(
+            ["k/3"], scheduler.plan_restarts(
+                {"k/3": "unit:k/3", "k/4": "unit:k/3"}, {})["units"])
+        self.assertEqual({"rack": None, "units": []},
+                         scheduler.plan_restarts({}, grants))
+
+    def test_partitions_span_racks(self):
+        partitions = scheduler.parse_topics_describe(DESCRIBE)
+        self.assertEqual([["1", "2"], ["2", "3"]], partitions)
+        self.assertTrue(scheduler.partitions_span_racks(
+            partitions, {"1": "az1", "2": "az2", "3": "az1"}))
+        self.assertFalse(scheduler.partitions_span_racks(
+            partitions, {"1": "az1", "2": "az2", "3": "az2"}))
+        # Unknown brokers count as their own rack
+        self.assertTrue(scheduler.partitions_span_racks(
+            partitions, {"1": "az1"}))
+
+    def test_schedule(self):
+        harness = Harness(_Charm, meta=METADATA)
+        self.addCleanup(harness.cleanup)
+        rel_id = harness.add_relation("cluster", "test")
+        racks = {"test/1": "az1", "test/2": "az2", "test/3": "az2"}
+        for u, rack in racks.items():
+            harness.add_relation_unit(rel_id, u)
+            harness.update_relation_data(rel_id, u, {
+                "rack": rack, "broker_id": u[-1], "restart_request": "1"})
+        harness.set_leader(True)
+        harness.begin()
+        charm = harness.charm
+        charm.restart_scheduler.request(rack="az1", broker_id="0")
+        checked = []
+
+        def _check(broker_racks):
+            checked.append(broker_racks)
+            return True
+
+        grants = charm.restart_scheduler.schedule(safety_check=_check)
+        self.assertEqual(
+            {"rack": "az1", "units": ["test/0", "test/1"],
+             "parallel": True}, grants)
+        self.assertEqual(
+            [{"0": "az1", "1": "az1", "2": "az2", "3": "az2"}], checked)
+        self.assertTrue(charm.restart_scheduler.is_granted())
+        charm.relation_data.flush()
+        self.assertEqual(grants, json.loads(
+            harness.get_relation_data(rel_id, "test")["restart_grants"]))
+        # Units of the rack finish, the next rack starts
+        charm.restart_scheduler.done()
+        charm.relation_data.flush()
+        harness.update_relation_data(rel_id, "test/1", {"restart_done": "1"})
+        charm.relation_data = RelationSnapshot(charm, ["cluster"])
+        self.assertFalse(charm.restart_scheduler.pending)
+        grants = charm.restart_scheduler.schedule(
+            safety_check=lambda r: False)
+        self.assertEqual(
+            {"rack": "az2", "units": ["test/2"], "parallel": False}, grants)
+        self.assertFalse(charm.restart_scheduler.is_granted())
+
+    def test_controller_restarts_last(self):
+        requests = {"k/0": "az1", "k/1": "az1", "k/2": "az2"}
+        # The controller's rack goes last, the controller last in its rack
+        grants = scheduler.plan_restarts(
+            requests, {}, max_concurrency=1,
+            rack_order=lambda r: (r == "az1", r), last_unit="k/0")
+        self.assertEqual({"rack": "az2", "units": ["k/2"]}, grants)
+        del requests["k/2"]
+        grants = scheduler.plan_restarts(
+            requests, grants, max_concurrency=1, last_unit="k/0")
+        self.assertEqual({"rack": "az1", "units": ["k/1"]}, grants)
+
+    def test_schedule_controller(self):
+        harness = Harness(_Charm, meta=METADATA)
+        self.addCleanup(harness.cleanup)
+        rel_id = harness.add_relation("cluster", "test")
+        for u in ["test/1", "test/2"]:
+            harness.add_relation_unit(rel_id, u)
+            harness.update_relation_data(rel_id, u, {
+                "broker_id": u[-1], "restart_request": "1"})
+        harness.update_relation_data(rel_id, "test/1", {"controller": "true"})
+        harness.update_relation_data(
+            rel_id, "test/2", {"restart_recovering": "1"})
+        harness.set_leader(True)
+        harness.begin()
+        charm = harness.charm
+        charm.restart_scheduler.request(broker_id="0")
+        self.assertEqual("test/1", charm.restart_scheduler.controller_unit())
+        self.assertEqual(
+            "test/2", charm.restart_scheduler.controller_unit("2"))
+        self.assertEqual(["test/1", "test/2"],
+                         charm.restart_scheduler.others_pending())
+        # Restarted, but its replicas still catch up
+        self.assertEqual(["test/2"],
+                         charm.restart_scheduler.others_recovering())
+        # Units without rack restart one at a time, the controller last
+        grants = charm.restart_scheduler.schedule(controller="test/1")
+        self.assertEqual(["test/0"], grants["units"])
+        self.assertEqual(
+            {"active": True, "controller": "test/1", "start_epoch": 7,
+             "failovers": 0},
+            charm.restart_scheduler.track_rollout("test/1", 7))
+
+    def test_update_rollout(self):
+        rollout = scheduler.update_rollout({}, False)
+        self.assertEqual({}, rollout)
+        rollout = scheduler.update_rollout(rollout, True, "k/0", 7)
+        self.assertEqual(0, rollout["failovers"])
+        rollout = scheduler.update_rollout(rollout, True, "k/1", 9)
+        self.assertEqual(2, rollout["failovers"])
+        rollout = scheduler.update_rollout(rollout, False, "k/1", 9)
+        self.assertEqual(
+            {"active": False, "controller": "k/1", "start_epoch": 7,
+             "failovers": 2}, rollout)
+        # Without epoch, count the changes of controller
+        rollout = scheduler.update_rollout({}, True, "k/0")
+        rollout = scheduler.update_rollout(rollout, True, "k/1")
+        rollout = scheduler.update_rollout(rollout, True, "k/1")
+        self.assertEqual(1, rollout["failovers"])
@@ -13,6 +13,8 @@
 """Unit Test for kafka_security."""
 
 import os
+import shutil
+import tempfile
 import unittest
 # from mock import patch
 # from mock import PropertyMock
@@ -74,3 +76,139 @@ class TestSecurity(unittest.TestCase):
         self.assertEqual(True, security._check_file_exists("/tmp/testks.jks"))
         self.assertEqual(True, security._check_file_exists("/tmp/testts.jks"))
         __cleanup()
+
+    @patch.object(security.subprocess, "check_call")
+    def test_create_keystore_in_process(self, mock_check_call):
+        """Test the keystore is built without openssl or keytool."""
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        ks_path = "/tmp/testks-in-process.p12"
+        ks_pwd = security.genRandomPassword()
+        crt, key = security.generateSelfSigned("/tmp", "testcert")
+        security.PKCS12CreateKeystore(ks_path, ks_pwd, crt, key, mode=0o640)
+        self.addCleanup(os.remove, ks_path)
+        mock_check_call.assert_not_called()
+        self.assertEqual(0o640, os.stat(ks_path).st_mode & 0o777)
+        with open(ks_path, "rb") as f:
+            ks = pkcs12.load_pkcs12(f.read(), ks_pwd.encode("utf-8"))
+        self.assertEqual(b"localhost", ks.cert.friendly_name)
+        self.assertIsNotNone(ks.key)
+        self.assertEqual(security._load_pem_certs(crt)[0],
+                         ks.cert.certificate)
+
+    @patch.object(security.subprocess, "check_call")
+    def test_create_truststore_dedup(self, mock_check_call):
+        """Test CAs are deduplicated and added in a single pass."""
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        ts_path = "/tmp/testts-in-process.p12"
+        ts_pwd = security.genRandomPassword()
+        crt1, _ = security.generateSelfSigned("/tmp", "testcert1")
+        crt2, _ = security.generateSelfSigned("/tmp", "testcert2")
+        crt3, _ = security.generateSelfSigned("/tmp", "testcert3")
+        security.CreateTruststore(ts_path, ts_pwd, [crt1, crt1, crt2],
+                                  ts_regenerate=True, extra_cas=[crt2])
+        self.addCleanup(os.remove, ts_path)
+
+        def _aliases():
+            with open(ts_path, "rb") as f:
+                ts = pkcs12.load_pkcs12(f.read(), ts_pwd.encode("utf-8"))
+            self.assertIsNone(ts.key)
+            return sorted(c.friendly_name for c in ts.additional_certs)
+
+        self.assertEqual(2, len(_aliases()))
+        # Without ts_regenerate, CAs already trusted are kept
+        security.CreateTruststore(ts_path, ts_pwd, [crt3])
+        self.assertEqual(3, len(_aliases()))
+        security.CreateTruststore(ts_path, ts_pwd, [crt3],
+                                  ts_regenerate=True)
+        self.assertEqual(1, len(_aliases()))
+        mock_check_call.assert_not_called()
+
+    def test_store_cache(self):
+        """Test stores are only rebuilt if their inputs change."""
+        ks_path = "/tmp/testks-cache.p12"
+        ts_path = "/tmp/testts-cache.p12"
+        pwd = security.genRandomPassword()
+        crt, key = security.generateSelfSigned("/tmp", "testcert")
+        crt2, _ = security.generateSelfSigned("/tmp", "testcert2")
+        self.addCleanup(security.invalidate_store_cache)
+        self.assertTrue(security.PKCS12CreateKeystore(ks_path, pwd, crt, key))
+        self.addCleanup(os.remove, ks_path)
+        self.assertTrue(security.CreateTruststore(ts_path, pwd, [crt], True))
+        self.addCleanup(os.remove, ts_path)
+        mtime = os.stat(ks_path).st_mtime_ns
+        self.assertFalse(
+            security.PKCS12CreateKeystore(ks_path, pwd, crt, key))
+        self.assertEqual(mtime, os.stat(ks_path).st_mtime_ns)
+        # Order and duplicates of the CAs do not change the truststore
+        self.assertFalse(security.CreateTruststore(
+            ts_path, pwd, [crt, crt], True))
+        # New inputs or password, rebuild
+        self.assertTrue(security.CreateTruststore(
+            ts_path, pwd, [crt, crt2], True))
+        self.assertTrue(security.PKCS12CreateKeystore(
+            ks_path, security.genRandomPassword(), crt, key))
+        # Files changed by someone else are rebuilt as well
+        with open(ts_path, "wb") as f:
+            f.write(b"")
+        self.assertTrue(security.CreateTruststore(
+            ts_path, pwd, [crt, crt2], True))
+
+    def test_iter_certificates(self):
+        """Test the PEM parser with CRLF, whitespace and DER inputs."""
+        import ssl
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes
+        crts = security._break_crt_chain(UBUNTU_COM_CERT)
+        bundle = "# Subject: ubuntu.com\r\n" + \
+            "\r\n".join("  " + line for line in UBUNTU_COM_CERT.split("\n"))
+        parsed = list(security.iter_certificates(bundle))
+        self.assertEqual(crts, [pem for _, pem in parsed])
+        for fp, pem in parsed:
+            self.assertEqual(
+                x509.load_pem_x509_certificate(pem.encode("utf-8"))
+                .fingerprint(hashes.SHA256()).hex(), fp)
+        der = ssl.PEM_cert_to_DER_cert(crts[0])
+        self.assertEqual([parsed[0]], list(security.iter_certificates(der)))
+        # Duplicates are merged by fingerprint
+        certs = {}
+        self.assertEqual(2, len(security.merge_certificates(
+            certs, UBUNTU_COM_CERT)))
+        self.assertEqual([], security.merge_certificates(certs, bundle))
+        self.assertEqual(2, len(certs))
+        self.assertEqual(
+            [parsed[0][0]],
+            list(security.index_cert_chains(
+                ["", UBUNTU_COM_CERT, bundle]).keys()))
+
+    def test_gen_self_signed_key_algorithms(self):
+        """Test cert generation with ECDSA, Ed25519 and pre-generated keys."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for alg, family in [("ecdsa-p256", "ecdsa"),
+                            ("ecdsa-p384", "ecdsa"),
+                            ("ed25519", "ed25519")]:
+            crt, key = security.generateSelfSigned(
+                tmpdir, alg, key_algorithm=alg)
+            self.assertEqual(family, security.key_algorithm_family(crt))
+            self.assertEqual(family, security.key_algorithm_family(key))
+        self.assertIn("TLS_ECDHE_ECDSA_WITH_AES_128_GCM_SHA256",
+                      security.cipher_suites_for_cert(crt))
+        self.assertNotIn("TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256",
+                         security.cipher_suites_for_cert(crt))
+        self.assertEqual([], security.cipher_suites_for_cert("invalid"))
+        self.assertEqual(
+            ["TLS_CHACHA20_POLY1305_SHA256",
+             "TLS_ECDHE_ECDSA_WITH_CHACHA20_POLY1305_SHA256"],
+            security.cipher_suites_for_cert(crt, prefer_chacha20=True)[:2])
+        self.assertRaises(ValueError, security.generateKey, "dsa-1024")
+        # Keys are consumed from the pool, then generated on demand
+        self.assertEqual(2, security.pregenerate_keys(tmpdir, "ecdsa-p256"))
+        self.assertEqual(0, security.pregenerate_keys(tmpdir, "ecdsa-p256"))
+        keys = [security.pop_pregenerated_key(tmpdir, "ecdsa-p256")
+                for _ in range(3)]
+        self.assertIsNone(keys[2])
+        self.assertNotEqual(keys[0], keys[1])
+        _, key = security.generateSelfSigned(
+            tmpdir, "pooled", key_algorithm="ecdsa-p256", key=keys[0])
+        self.assertEqual(keys[0], key)
+        self.assertIsNone(security.pop_pregenerated_key(tmpdir, "rsa-2048"))
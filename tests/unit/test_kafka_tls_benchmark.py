@@ -0,0 +1,83 @@
+"""Test the kafka_tls_benchmark lib."""
+
+import os
+import ssl
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import charms.kafka_broker.v0.kafka_tls_benchmark as benchmark
+import charms.kafka_broker.v0.kafka_security as security
+
+
+class TestKafkaTLSBenchmark(unittest.TestCase):
+    """Unit test class."""
+
+    def _tls_server(self):
+        """Starts a TLS server on localhost, returns its port."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        security.generateSelfSigned(
+            tmpdir, "server", cn="localhost", key_algorithm="ecdsa-p256")
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(os.path.join(tmpdir, "server.crt"),
+                            os.path.join(tmpdir, "server.key"))
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(16)
+        self.addCleanup(sock.close)
+
+        def _serve():
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except OSError:
+                    return
+                try:
+                    with ctx.wrap_socket(conn, server_side=True):
+                        pass
+                except (OSError, ssl.SSLError):
+                    pass
+
+        threading.Thread(target=_serve, daemon=True).start()
+        return sock.getsockname()[1]
+
+    def test_benchmark_listener(self):
+        port = self._tls_server()
+        results = benchmark.benchmark_listener(
+            "127.0.0.1", port, count=5,
+            profile_protocols=security.TLS_PERFORMANCE_PROTOCOLS,
+            profile_suites=security.TLS12_CIPHER_SUITES["ecdsa"])
+        self.assertEqual(["default", "profile"], sorted(results))
+        self.assertEqual("TLSv1.2", results["default"]["protocol"])
+        self.assertEqual("TLSv1.3", results["profile"]["protocol"])
+        for r in results.values():
+            self.assertEqual(5, r["handshakes"])
+            self.assertEqual(0, r["failures"])
+            self.assertGreater(r["handshakes_per_sec"], 0)
+            self.assertGreater(r["throughput_mbps"], 0)
+
+    def test_handshake_failures(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        r = benchmark.handshake_benchmark(
+            "127.0.0.1", port, benchmark.client_context(), count=2)
+        self.assertEqual(0, r["handshakes"])
+        self.assertEqual(2, r["failures"])
+        self.assertIsNone(r["cipher"])
+
+    def test_cipher_names(self):
+        self.assertEqual(
+            "ECDHE-RSA-AES128-GCM-SHA256:ECDHE-RSA-CHACHA20-POLY1305",
+            benchmark.openssl_cipher_names(
+                ["TLS_AES_128_GCM_SHA256",
+                 "TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256",
+                 "TLS_ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256"]))
+        self.assertIsNone(benchmark.openssl_cipher_names(None))
+        self.assertIsNone(benchmark.cipher_throughput("RC4-SHA"))
+        self.assertGreater(benchmark.cipher_throughput(
+            "TLS_CHACHA20_POLY1305_SHA256", total=1024 * 1024), 0)
@@ -0,0 +1,71 @@
+"""Test the kafka_zookeeper_metadata lib."""
+
+import unittest
+import subprocess
+from mock import Mock, patch
+
+import charms.kafka_broker.v0.kafka_zookeeper_metadata as zk_metadata
+
+BROKER_ZNODE = b"""Connecting to zk-0:2182
+
+WATCHER::
+
+WatchedEvent state:SyncConnected type:None path:null
+{"listener_security_protocol_map":{"BROKER":"SSL","EXTERNAL":"SASL_SSL"},\
+"endpoints":["BROKER://broker-0:9092","EXTERNAL://broker-0.ext:9094"],\
+"rack":"rack-1","jmx_port":-1,"port":-1,"host":null,"version":5}
+"""
+
+
+class TestKafkaZookeeperMetadata(unittest.TestCase):
+    """Unit test class."""
+
+    @patch.object(zk_metadata.subprocess, "check_output")
+    def test_broker_endpoints(self, mock_check_output):
+        mock_check_output.return_value = BROKER_ZNODE
+        self.assertEqual(
+            ["BROKER://broker-0:9092", "EXTERNAL://broker-0.ext:9094"],
+            zk_metadata.broker_endpoints(
+                "zk-0:2182", 1001,
+                zk_client_config="/etc/kafka/zk-tls.properties"))
+        mock_check_output.assert_called_once_with(
+            ["zookeeper-shell", "zk-0:2182",
+             "-zk-tls-config-file", "/etc/kafka/zk-tls.properties",
+             "get", "/brokers/ids/1001"],
+            stderr=subprocess.STDOUT)
+        mock_check_output.return_value = \
+            b"Connecting to zk-0:2182\nNode does not exist: /brokers/ids/1\n"
+        self.assertEqual([], zk_metadata.broker_endpoints("zk-0:2182", 1))
+        mock_check_output.side_effect = subprocess.CalledProcessError(
+            1, "zookeeper-shell", output=b"Connection refused")
+        self.assertRaises(
+            zk_metadata.KafkaZookeeperMetadataError,
+            zk_metadata.broker_endpoints, "zk-0:2182", 1001)
+
+    @patch.object(zk_metadata.subprocess, "check_output")
+    def test_active_controller(self, mock_check_output):
+        mock_check_output.side_effect = [
+            b'Connecting to zk-0:2182\n'
+            b'{"version":1,"brokerid":1002,"timestamp":"1700000000000"}\n',
+            b"Connecting to zk-0:2182\n12\n"]
+        self.assertEqual(("1002", 12),
+                         zk_metadata.active_controller("zk-0:2182"))
+        # During an election
+        mock_check_output.side_effect = [
+            b"Node does not exist: /controller\n", b"13\n"]
+        self.assertEqual((None, 13),
+                         zk_metadata.active_controller("zk-0:2182"))
+
+    @patch.object(zk_metadata.time, "sleep")
+    def test_wait_for_advertised_listeners(self, mock_sleep):
+        source = Mock(side_effect=[
+            zk_metadata.KafkaZookeeperMetadataError(),
+            ["BROKER://broker-0:9092", "INTERNAL://broker-0:9093"],
+            ["BROKER://broker-0:9092", "EXTERNAL://broker-0.ext:9094"]])
+        self.assertTrue(zk_metadata.wait_for_advertised_listeners(
+            source, added=["external"], removed=["internal"]))
+        self.assertEqual(3, source.call_count)
+        source = Mock(
+            return_value=["BROKER://broker-0:9092"])
+        self.assertFalse(zk_metadata.wait_for_advertised_listeners(
+            source, added=["external"], removed=[], timeout=0))